@@ -0,0 +1,69 @@
+"""
+Accounting for answers abandoned by their clients.
+
+A noticeable share of sessions is left mid-answer. The serving code now stops
+the LLM stream and the related-questions call when nobody reads the response
+any more (see `SingleFlight` in app.py and `RAG._raw_stream_response`), and
+records here how often that happens and how many tokens it saved.
+
+Streamed deltas are about one token each, so the tokens an answer produced
+are counted as its deltas. The tokens an abandoned answer would still have
+produced are estimated from the average length of recently completed answers.
+"""
+import os
+import threading
+
+# Seconds an answer keeps streaming after its last reader went away, so that a
+# page reload can pick it up again and a nearly finished answer still completes
+# into the answer cache.
+STREAM_ABANDON_GRACE = float(os.environ.get("STREAM_ABANDON_GRACE", "2"))
+
+# Weight of the newest completed answer in the average answer length.
+_EWMA_ALPHA = 0.05
+
+
+class AbandonmentStats:
+    """Thread-safe counts of completed and abandoned answers and the tokens saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.abandoned = 0
+        self.related_cancelled = 0
+        self.tokens_generated_abandoned = 0
+        self.tokens_saved = 0.0
+        self.answer_tokens_avg = 0.0
+
+    def record_completed(self, tokens: int) -> None:
+        with self._lock:
+            self.completed += 1
+            if self.completed == 1:
+                self.answer_tokens_avg = float(tokens)
+            else:
+                self.answer_tokens_avg += _EWMA_ALPHA * (tokens - self.answer_tokens_avg)
+
+    def record_abandoned(self, tokens: int, related_cancelled: bool = False) -> float:
+        """Records an answer stopped after `tokens` and returns the estimated tokens saved."""
+        with self._lock:
+            saved = max(0.0, self.answer_tokens_avg - tokens)
+            self.abandoned += 1
+            self.related_cancelled += int(related_cancelled)
+            self.tokens_generated_abandoned += tokens
+            self.tokens_saved += saved
+            return saved
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self.completed + self.abandoned
+            return {
+                "completed": self.completed,
+                "abandoned": self.abandoned,
+                "abandoned_ratio": self.abandoned / finished if finished else 0.0,
+                "related_cancelled": self.related_cancelled,
+                "tokens_generated_abandoned": self.tokens_generated_abandoned,
+                "tokens_saved_estimate": round(self.tokens_saved),
+                "answer_tokens_avg": self.answer_tokens_avg,
+            }
+
+
+abandonment_stats = AbandonmentStats()
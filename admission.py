@@ -0,0 +1,261 @@
+"""
+Admission control with per-upstream concurrency limits and load shedding.
+
+Nothing used to bound the calls in flight to the search provider or the LLM:
+during a spike every request started its calls at once, the upstreams slowed
+down for all of them, and requests queued invisibly until they timed out. Each
+`ConcurrencyLimiter` admits at most `max_concurrency` calls of one kind (search,
+answer streaming, related questions) and queues the rest in a bounded FIFO.
+Requests that cannot be served in time are shed right away instead:
+
+- When the queue is full, with `Overloaded` carrying status 429.
+- When the expected wait, from the queue length and the recent time a slot is
+  held, exceeds `queue_target`, with status 503.
+- When a queued request has waited `queue_target` seconds, with status 503.
+
+Each rejection carries a Retry-After estimate. Limiters are safe to use from
+coroutines on any event loop and from plain threads, like `AgentPool`.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import NamedTuple, Optional
+
+from metrics import queue_wait
+
+ADMISSION_SEARCH_CONCURRENCY = int(os.environ.get("ADMISSION_SEARCH_CONCURRENCY", "32"))
+ADMISSION_ANSWER_CONCURRENCY = int(os.environ.get("ADMISSION_ANSWER_CONCURRENCY", "32"))
+ADMISSION_RELATED_CONCURRENCY = int(os.environ.get("ADMISSION_RELATED_CONCURRENCY", "16"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TARGET = float(os.environ.get("ADMISSION_QUEUE_TARGET", "2.0"))
+
+# Weight of the newest sample in the moving averages of wait and hold times.
+_EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """Raised instead of admitting a request that would wait too long."""
+
+    def __init__(self, name: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"{name} is overloaded: {reason}")
+        self.name = name
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class _Waiter:
+    """A queued request: a future on its loop for coroutines, an event for threads."""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop]):
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+        self.queued_at = time.monotonic()
+
+
+class Permit:
+    """A slot of a limiter. Releasing it more than once is harmless."""
+
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        self._limiter = limiter
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter._release(time.monotonic() - self._acquired_at)
+
+
+class ConcurrencyLimiter:
+    """
+    Admits at most `max_concurrency` holders at a time, queues up to `max_queue`
+    more, and sheds requests that would wait longer than `queue_target` seconds.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_target: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_target = queue_target
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected_queue_full = 0
+        self.rejected_expected_wait = 0
+        self.rejected_timeout = 0
+        self.wait_seconds = 0.0
+        self.wait_ewma = 0.0
+        self.hold_ewma = 0.0
+
+    def _expected_wait(self, position: int) -> float:
+        """Seconds until the request at `position` in the queue (0: the next) gets a slot."""
+        return (position + 1) * self.hold_ewma / self.max_concurrency
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._expected_wait(len(self._waiters))))
+
+    def _overloaded(self, status_code: int, reason: str) -> Overloaded:
+        return Overloaded(self.name, status_code, self._retry_after(), reason)
+
+    def _admit_or_queue(self, loop) -> Optional[_Waiter]:
+        """Takes a free slot and returns None, or queues a waiter. Raises Overloaded to shed."""
+        with self._lock:
+            if self.in_flight < self.max_concurrency and not self._waiters:
+                self.in_flight += 1
+                self.admitted += 1
+                self._record_wait(0.0)
+                return None
+            self._check()
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            self.queued_total += 1
+            return waiter
+
+    def _check(self) -> None:
+        """Raises Overloaded if a request arriving now would be shed. Call with the lock held."""
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise self._overloaded(429, "queue is full")
+        if self._expected_wait(len(self._waiters)) > self.queue_target:
+            self.rejected_expected_wait += 1
+            raise self._overloaded(503, "expected queue wait exceeds target")
+
+    def check(self) -> None:
+        """
+        Raises Overloaded if a request arriving now would be shed, without taking
+        a slot; used to reject a request before work for a later stage is done.
+        """
+        with self._lock:
+            if self.in_flight >= self.max_concurrency or self._waiters:
+                self._check()
+
+    def _record_wait(self, seconds: float) -> None:
+        queue_wait.observe(seconds, self.name)
+        self.wait_seconds += seconds
+        self.wait_ewma += _EWMA_ALPHA * (seconds - self.wait_ewma)
+
+    def _timed_out(self, waiter: _Waiter) -> bool:
+        """Dequeues a waiter that gave up. False if it was granted a slot meanwhile. Call with the lock held."""
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return False
+        self._record_wait(time.monotonic() - waiter.queued_at)
+        return True
+
+    async def acquire(self) -> Permit:
+        waiter = self._admit_or_queue(asyncio.get_running_loop())
+        if waiter is None:
+            return Permit(self)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_target)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if self._timed_out(waiter):
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    self.rejected_timeout += 1
+                    raise self._overloaded(503, "queue wait exceeded target") from None
+            # Granted just as we gave up: the slot is ours after all.
+            await waiter.future
+            if isinstance(e, asyncio.CancelledError):
+                Permit(self).release()
+                raise
+        return Permit(self)
+
+    def acquire_sync(self) -> Permit:
+        waiter = self._admit_or_queue(None)
+        if waiter is None:
+            return Permit(self)
+        if not waiter.event.wait(self.queue_target):
+            with self._lock:
+                if self._timed_out(waiter):
+                    self.rejected_timeout += 1
+                    raise self._overloaded(503, "queue wait exceeded target")
+        return Permit(self)
+
+    def _release(self, held: float) -> None:
+        with self._lock:
+            self.hold_ewma += _EWMA_ALPHA * (held - self.hold_ewma)
+            # Hand the slot straight to the oldest live waiter; in_flight stays the same.
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if waiter.loop is None or not waiter.loop.is_closed():
+                    break
+            else:
+                self.in_flight -= 1
+                return
+            self.admitted += 1
+            self._record_wait(time.monotonic() - waiter.queued_at)
+        if waiter.event is not None:
+            waiter.event.set()
+        else:
+            waiter.loop.call_soon_threadsafe(waiter.future.set_result, None)
+
+    @asynccontextmanager
+    async def slot(self):
+        permit = await self.acquire()
+        try:
+            yield permit
+        finally:
+            permit.release()
+
+    @contextmanager
+    def slot_sync(self):
+        permit = self.acquire_sync()
+        try:
+            yield permit
+        finally:
+            permit.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "queue_depth": len(self._waiters),
+                "max_queue": self.max_queue,
+                "queue_target": self.queue_target,
+                "admitted": self.admitted,
+                "queued": self.queued_total,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_expected_wait": self.rejected_expected_wait,
+                "rejected_timeout": self.rejected_timeout,
+                "wait_seconds": self.wait_seconds,
+                "wait_seconds_avg": self.wait_ewma,
+                "hold_seconds_avg": self.hold_ewma,
+            }
+
+
+class Admission(NamedTuple):
+    """The limiters of the upstream calls a query makes."""
+    search: ConcurrencyLimiter
+    answer: ConcurrencyLimiter
+    related: ConcurrencyLimiter
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in self._asdict().items()}
+
+
+def admission_from_env() -> Admission:
+    """The limiters configured by ADMISSION_*."""
+    return Admission(*(
+        ConcurrencyLimiter(name, max_concurrency, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TARGET)
+        for name, max_concurrency in [
+            ("search", ADMISSION_SEARCH_CONCURRENCY),
+            ("answer", ADMISSION_ANSWER_CONCURRENCY),
+            ("related", ADMISSION_RELATED_CONCURRENCY),
+        ]
+    ))
@@ -0,0 +1,168 @@
+"""
+Bounded pool of Strands agents for the FastAPI app.
+
+A Strands `Agent` keeps its conversation in `agent.messages`, and it must not be
+invoked concurrently. Caching one agent per thread made every request carry the
+history of all earlier requests served by that thread, and let concurrent
+streams on the event loop thread share an agent. The pool hands each request an
+agent of its own, with the conversation reset, and bounds how many agents (and
+their model clients) exist at all.
+
+The pool is safe to use from coroutines on any event loop and from plain
+threads: idle agents and waiters are kept under a threading lock, and waiting
+coroutines are woken through their own loop.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Optional
+
+
+def reset_conversation(agent) -> None:
+    """Gives an agent a fresh conversation, so no request sees another one's messages."""
+    agent.messages = []
+    conversation_manager = getattr(agent, "conversation_manager", None)
+    if conversation_manager is not None and hasattr(conversation_manager, "removed_message_count"):
+        conversation_manager.removed_message_count = 0
+
+
+class AgentPool:
+    """
+    A pool of at most `max_size` objects built by `factory`. `reset` is applied to
+    an object every time it is checked out.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        max_size: int,
+        reset: Optional[Callable[[Any], None]] = reset_conversation,
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.reset = reset
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._waiters = deque()  # (loop, future) of coroutines waiting for an agent
+        self.size = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _create(self):
+        try:
+            return self.factory()
+        except BaseException:
+            with self._lock:
+                self.size -= 1
+            raise
+
+    def warm(self, count: Optional[int] = None) -> int:
+        """Builds up to `count` (default: max_size) idle agents ahead of traffic."""
+        count = self.max_size if count is None else min(count, self.max_size)
+        created = 0
+        while True:
+            with self._lock:
+                if self.size >= count:
+                    return created
+                self.size += 1
+            agent = self._create()
+            created += 1
+            self.release(agent, checked_out=False)
+
+    async def acquire(self):
+        with self._lock:
+            self.checkouts += 1
+            if self._idle:
+                agent = self._idle.pop()
+                self.in_use += 1
+                return self._checkout(agent)
+            if self.size < self.max_size:
+                self.size += 1
+                self.in_use += 1
+                create = True
+            else:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+                self.waits += 1
+                create = False
+        if create:
+            try:
+                return self._checkout(self._create())
+            except BaseException:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+        start = time.monotonic()
+        try:
+            agent = await future
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, future))
+                except ValueError:
+                    # An agent was handed to us just as we were cancelled; pass it on.
+                    if future.done() and not future.cancelled():
+                        self.in_use -= 1
+                        self._hand_over(future.result())
+            raise
+        finally:
+            with self._lock:
+                self.wait_seconds += time.monotonic() - start
+        return self._checkout(agent)
+
+    def _checkout(self, agent):
+        if self.reset is not None:
+            self.reset(agent)
+        return agent
+
+    def _hand_over(self, agent) -> None:
+        """Gives an agent to the next live waiter, or makes it idle. Call with the lock held."""
+        while self._waiters:
+            loop, future = self._waiters.popleft()
+            if loop.is_closed():
+                continue
+            self.in_use += 1
+            loop.call_soon_threadsafe(self._resolve, future, agent)
+            return
+        self._idle.append(agent)
+
+    def _resolve(self, future, agent) -> None:
+        if future.cancelled():
+            # The waiter went away after we picked it; give the agent to someone else.
+            with self._lock:
+                self.in_use -= 1
+                self._hand_over(agent)
+        else:
+            future.set_result(agent)
+
+    def release(self, agent, checked_out: bool = True) -> None:
+        with self._lock:
+            if checked_out:
+                self.in_use -= 1
+            self._hand_over(agent)
+
+    @asynccontextmanager
+    async def checkout(self):
+        agent = await self.acquire()
+        try:
+            yield agent
+        finally:
+            self.release(agent)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "waiting": len(self._waiters),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+            }
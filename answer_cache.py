@@ -0,0 +1,348 @@
+"""
+Near-duplicate full-answer cache.
+
+Much of the traffic is the same question asked with different casing,
+punctuation or a word more or less. Queries are reduced to a set of word
+shingles, their words and their pairs of adjacent words, so that word order
+counts: "is X faster than Y" and "is Y faster than X" are different
+questions. A MinHash signature of that set is indexed with locality-sensitive
+hashing (LSH), so that a lookup only compares the query with the few cached
+queries that share a band of the signature. A candidate is a hit if the
+Jaccard similarity of the shingle sets reaches the threshold and the queries
+differ only by added or dropped words, none of them a negation or a number:
+"how tall is the Eiffel Tower" hits "how tall is the Eiffel Tower in Paris"
+(0.73 with the default threshold of 0.65), but replacing a word, as in "the
+president of France" for "the president of the USA", never hits, and neither
+does "in 2020" for "in 2019" or "not" added. On a hit the stored contexts,
+answer and related questions are replayed without searching or calling the
+LLM.
+
+The index holds at most `max_entries` answers and evicts the least recently
+used ones, so memory stays bounded. With SHARED_CACHE_PATH set, the answers
+and the LSH buckets live in a SQLite database shared by all worker processes
+instead (`SharedAnswerCache`).
+"""
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+from shared_cache import SHARED_CACHE_PATH, connect
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Joins the words of a pair; never part of a \w+ word.
+_PAIR_JOINER = "+"
+# Words that turn a question around; "n't" is read as "not".
+_NEGATIONS = frozenset(("not", "no", "never", "without", "nor", "neither", "none", "nothing", "nobody", "cannot"))
+# "what's" is read as "what is"; other "'s" are mostly possessives.
+_IS_CONTRACTION_RE = re.compile(r"\b(what|who|where|when|how|why|which|it|that|there)['’]s\b")
+DEFAULT_THRESHOLD = 0.65
+
+
+def query_tokens(query: str) -> frozenset:
+    """
+    The shingle set of a query: its words and its pairs of adjacent words, in
+    lower case, without punctuation or [INST] tags.
+    """
+    query = re.sub(r"\[/?INST\]", "", query or "").lower()
+    query = _IS_CONTRACTION_RE.sub(r"\1 is", re.sub(r"n['’]t\b", " not", query))
+    words = _TOKEN_RE.findall(query)
+    return frozenset(words + [a + _PAIR_JOINER + b for a, b in zip(words, words[1:])])
+
+
+def _words(tokens: frozenset) -> frozenset:
+    return frozenset(token for token in tokens if _PAIR_JOINER not in token)
+
+
+def _may_match(a: frozenset, b: frozenset) -> bool:
+    """Whether two shingle sets differ only by added or dropped words, none of them a negation or number."""
+    a, b = _words(a), _words(b)
+    if not (a <= b or b <= a):
+        return False
+    return not any(word in _NEGATIONS or any(c.isdigit() for c in word) for word in a ^ b)
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class CachedAnswer(NamedTuple):
+    query: str
+    contexts: List[dict]
+    answer: str
+    related_questions: Optional[List[str]]
+    expires_at: float
+
+
+class AnswerCache:
+    """
+    A bounded TTL + LRU answer cache with MinHash-LSH lookup of near-duplicate queries.
+
+    - threshold: minimum Jaccard similarity of the shingle sets for a hit.
+    - bands / rows: LSH layout; the signature has bands * rows hashes.
+    - bucket_size: max queries kept per LSH bucket. Template-like queries all land
+      in the same buckets; keeping only the most recent ones bounds the number
+      of similarity checks per lookup to bands * bucket_size.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        threshold: float = DEFAULT_THRESHOLD,
+        bands: int = 8,
+        rows: int = 2,
+        bucket_size: int = 16,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.bucket_size = bucket_size
+        # Fixed coefficients, so that signatures are stable across processes.
+        num_hashes = bands * rows
+        self._coefficients = [
+            (zlib.crc32(b"a%d" % i) | 1, zlib.crc32(b"b%d" % i)) for i in range(num_hashes)
+        ]
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token set -> CachedAnswer
+        self._buckets = [dict() for _ in range(bands)]  # band -> band key -> token sets, oldest first
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _band_keys(self, tokens: frozenset) -> List[tuple]:
+        token_hashes = [zlib.crc32(token.encode("utf-8")) for token in tokens] or [0]
+        signature = [
+            min((a * h + b) % _MERSENNE_PRIME for h in token_hashes) for a, b in self._coefficients
+        ]
+        return [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def _remove(self, tokens: frozenset) -> None:
+        del self._entries[tokens]
+        for band, key in enumerate(self._band_keys(tokens)):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.pop(tokens, None)
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def get(self, query: str) -> Optional[CachedAnswer]:
+        tokens = query_tokens(query)
+        if not tokens:
+            return None
+        now = time.time()
+        with self._lock:
+            best, best_similarity = None, 0.0
+            entry = self._entries.get(tokens)
+            if entry is not None:
+                best, best_similarity = tokens, 1.0
+            else:
+                candidates = set()
+                for band, key in enumerate(self._band_keys(tokens)):
+                    candidates.update(self._buckets[band].get(key, ()))
+                for candidate in candidates:
+                    if not _may_match(tokens, candidate):
+                        continue
+                    similarity = jaccard(tokens, candidate)
+                    if similarity >= self.threshold and similarity > best_similarity:
+                        best, best_similarity = candidate, similarity
+            if best is None or self._entries[best].expires_at < now:
+                if best is not None:
+                    self._remove(best)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            if best_similarity < 1.0:
+                self.near_hits += 1
+            return self._entries[best]
+
+    def put(self, query: str, contexts: List[dict], answer: str, related_questions: Optional[List[str]]) -> None:
+        tokens = query_tokens(query)
+        if not tokens or not answer:
+            return
+        entry = CachedAnswer(query, contexts, answer, related_questions, time.time() + self.ttl)
+        band_keys = self._band_keys(tokens)
+        with self._lock:
+            if tokens in self._entries:
+                self._remove(tokens)
+            self._entries[tokens] = entry
+            for band, key in enumerate(band_keys):
+                bucket = self._buckets[band].setdefault(key, {})
+                bucket[tokens] = None
+                if len(bucket) > self.bucket_size:
+                    del bucket[next(iter(bucket))]
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+            }
+
+
+# Separates the tokens of a token set in its database key.
+_TOKEN_SEPARATOR = " "
+
+
+class SharedAnswerCache(AnswerCache):
+    """
+    The answer cache with its entries and LSH buckets in a SQLite database, so
+    that several processes share it. Lookups work as in `AnswerCache`: the
+    buckets of the query's bands give the candidates, which are compared by
+    Jaccard similarity.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " tokens TEXT PRIMARY KEY,"
+            " entry TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed_at ON answers (accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answer_buckets ("
+            " band INTEGER NOT NULL,"
+            " key TEXT NOT NULL,"
+            " tokens TEXT NOT NULL,"
+            " PRIMARY KEY (band, key, tokens))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answer_buckets_tokens ON answer_buckets (tokens)")
+
+    @staticmethod
+    def _tokens_key(tokens: frozenset) -> str:
+        # Words and pairs of words never contain the separator.
+        return _TOKEN_SEPARATOR.join(sorted(tokens))
+
+    def _delete(self, tokens_keys: List[str]) -> None:
+        for tokens_key in tokens_keys:
+            self._conn.execute("DELETE FROM answers WHERE tokens = ?", (tokens_key,))
+            self._conn.execute("DELETE FROM answer_buckets WHERE tokens = ?", (tokens_key,))
+
+    def get(self, query: str) -> Optional[CachedAnswer]:
+        tokens = query_tokens(query)
+        if not tokens:
+            return None
+        now = time.time()
+        tokens_key = self._tokens_key(tokens)
+        with self._lock:
+            best, best_similarity = None, 0.0
+            if self._conn.execute("SELECT 1 FROM answers WHERE tokens = ?", (tokens_key,)).fetchone():
+                best, best_similarity = tokens_key, 1.0
+            else:
+                candidates = set()
+                for band, key in enumerate(self._band_keys(tokens)):
+                    candidates.update(row[0] for row in self._conn.execute(
+                        "SELECT tokens FROM answer_buckets WHERE band = ? AND key = ?", (band, repr(key))
+                    ))
+                for candidate in candidates:
+                    candidate_tokens = frozenset(candidate.split(_TOKEN_SEPARATOR))
+                    if not _may_match(tokens, candidate_tokens):
+                        continue
+                    similarity = jaccard(tokens, candidate_tokens)
+                    if similarity >= self.threshold and similarity > best_similarity:
+                        best, best_similarity = candidate, similarity
+            row = None
+            if best is not None:
+                row = self._conn.execute(
+                    "SELECT entry, expires_at FROM answers WHERE tokens = ?", (best,)
+                ).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._delete([best])
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET accessed_at = ? WHERE tokens = ?", (now, best))
+            self.hits += 1
+            if best_similarity < 1.0:
+                self.near_hits += 1
+        query, contexts, answer, related_questions = json.loads(row[0])
+        return CachedAnswer(query, contexts, answer, related_questions, row[1])
+
+    def put(self, query: str, contexts: List[dict], answer: str, related_questions: Optional[List[str]]) -> None:
+        tokens = query_tokens(query)
+        if not tokens or not answer:
+            return
+        now = time.time()
+        tokens_key = self._tokens_key(tokens)
+        entry = json.dumps([query, contexts, answer, related_questions])
+        band_keys = self._band_keys(tokens)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete([tokens_key])
+                self._conn.execute(
+                    "INSERT INTO answers (tokens, entry, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (tokens_key, entry, now + self.ttl, now),
+                )
+                for band, key in enumerate(band_keys):
+                    self._conn.execute(
+                        "INSERT INTO answer_buckets (band, key, tokens) VALUES (?, ?, ?)", (band, repr(key), tokens_key)
+                    )
+                    # Keep the bucket_size most recent queries of the bucket.
+                    self._conn.execute(
+                        "DELETE FROM answer_buckets WHERE band = ? AND key = ? AND rowid NOT IN ("
+                        " SELECT rowid FROM answer_buckets WHERE band = ? AND key = ? ORDER BY rowid DESC LIMIT ?)",
+                        (band, repr(key), band, repr(key), self.bucket_size),
+                    )
+                evicted = [row[0] for row in self._conn.execute(
+                    "SELECT tokens FROM answers WHERE expires_at < ? OR tokens IN ("
+                    " SELECT tokens FROM answers ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (now, self.max_entries),
+                )]
+                self._delete(evicted)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "shared": True,
+            }
+
+
+def answer_cache_from_env() -> Optional[AnswerCache]:
+    """
+    Builds the answer cache configured by ANSWER_CACHE_SIZE (0 disables it),
+    ANSWER_CACHE_TTL (seconds) and ANSWER_CACHE_THRESHOLD (Jaccard similarity of shingles),
+    shared between processes through SHARED_CACHE_PATH if that is set.
+    """
+    max_entries = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+    if max_entries <= 0:
+        return None
+    if SHARED_CACHE_PATH:
+        return SharedAnswerCache(
+            SHARED_CACHE_PATH,
+            max_entries=max_entries,
+            ttl=float(os.environ.get("ANSWER_CACHE_TTL", "3600")),
+            threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", str(DEFAULT_THRESHOLD))),
+        )
+    return AnswerCache(
+        max_entries=max_entries,
+        ttl=float(os.environ.get("ANSWER_CACHE_TTL", "3600")),
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", str(DEFAULT_THRESHOLD))),
+    )
@@ -1,24 +1,59 @@
+from startup import StartupTimer
+# Created first, so the import phases are timed too.
+startup = StartupTimer()
+
+import asyncio
 import concurrent.futures
+import inspect
 import json
 import os
 import re
-import threading
-from typing import Generator, List, Optional
+from contextlib import asynccontextmanager
+from typing import Generator, List, Literal, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 import httpx
 import requests
+startup.mark("import_web")
 
-# Strands SDK imports
+# Strands SDK imports. The community tools are imported when first called (see lazy_tools.py).
 from strands import Agent
 from strands.models.openai import OpenAIModel
-from strands_tools import calculator, python_repl, http_request
+startup.mark("import_strands")
+
+from abandonment import STREAM_ABANDON_GRACE, abandonment_stats
+from admission import Overloaded, admission_from_env
+from agent_pool import AgentPool
+from answer_cache import answer_cache_from_env
+from context_packer import RELATED_CONTEXT_TOKEN_BUDGET, format_contexts, pack_contexts
+from lazy_tools import LAZY_TOOLS, lazy_tools, tool_stats
+from llm_clients import LLM_WARM_CONNECTION, close_clients, connection_stats, get_async_openai_client, warm_connection
+from local_index import LOCAL_INDEX_PATH, LocalIndex
+from metrics import (
+    CONTENT_TYPE, AnswerTimer, cache_hits, cache_misses, empty_contexts, errors, registry,
+    related_questions_latency, search_latency,
+)
+from page_fetcher import page_fetcher_from_env
+from prompt_layout import add_usage, prompt_cache_stats, split_prompt
+from reranker import candidate_count, reranker_from_env
+from replay_response import replay_response
+from replay_store import ReplayStore, replay_store_from_env
+from resilience import (
+    REQUEST_DEADLINE, CircuitOpen, Deadline, DeadlineExceeded, set_deadline, timeout_for, upstreams
+)
+from search_cache import NullSearchCache, normalize_query, search_cache_from_env
+from singleflight import SingleFlight
+from stream_encoder import MEDIA_TYPES, encode_stream
+from tool_sandbox import tool_sandbox_from_env
+from tracing import finish_when_done, mark, span, tracer_from_env
+startup.mark("import_modules")
 
 
 # Structured output model for related questions
@@ -31,10 +66,22 @@ class RelatedQuestions(BaseModel):
     )
 
 # Constants
-SERPER_SEARCH_ENDPOINT = "https://google.serper.dev/search"
+SERPER_SEARCH_ENDPOINT = os.environ.get("SERPER_SEARCH_ENDPOINT", "https://google.serper.dev/search")
 REFERENCE_COUNT = 8
+# With RERANK_CANDIDATES set, search over-fetches candidates and keeps the
+# REFERENCE_COUNT best of them by lexical relevance to the query.
+SEARCH_CANDIDATE_COUNT = candidate_count(REFERENCE_COUNT)
+reranker = reranker_from_env(REFERENCE_COUNT)
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
 
+# Connection pool for the shared async search client. Keep-alive connections are
+# reused across requests, so only the first search pays for TCP+TLS setup.
+SEARCH_HTTP2 = os.environ.get("SEARCH_HTTP2", "true").lower() == "true"
+SEARCH_MAX_CONNECTIONS = int(os.environ.get("SEARCH_MAX_CONNECTIONS", "100"))
+SEARCH_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("SEARCH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+SEARCH_KEEPALIVE_EXPIRY = float(os.environ.get("SEARCH_KEEPALIVE_EXPIRY", "30"))
+SEARCH_CONNECT_TIMEOUT = float(os.environ.get("SEARCH_CONNECT_TIMEOUT", "2"))
+
 _default_query = "Who said 'live long and prosper'?"
 
 _rag_query_text = """
@@ -61,21 +108,32 @@ Here are the contexts of the question:
 Remember, based on the original question and related contexts, suggest three such further questions. Do NOT repeat the original question. Each related question should be no longer than 20 words. Here is the original question:
 """
 
+# The instructions go in the system prompt, which is identical for every request so
+# that the provider can serve it from its prompt cache; contexts and query follow.
+_rag_layout = split_prompt(_rag_query_text)
+_more_questions_layout = split_prompt(_more_questions_prompt)
+
+# Optional `prompt_cache_key` sent to the LLM, so that requests sharing the static
+# prefix are routed to the same cache.
+LLM_PROMPT_CACHE_KEY = os.environ.get("LLM_PROMPT_CACHE_KEY", "")
+
 stop_words = ["<|im_end|>", "[End]", "[end]", "\nReferences:\n"]
 
 
-def search_with_serper(query: str, subscription_key: str):
-    payload = json.dumps({
+def _serper_payload(query: str) -> str:
+    return json.dumps({
         "q": query,
-        "num": REFERENCE_COUNT if REFERENCE_COUNT % 10 == 0 else (REFERENCE_COUNT // 10 + 1) * 10,
+        "num": SEARCH_CANDIDATE_COUNT if SEARCH_CANDIDATE_COUNT % 10 == 0 else (SEARCH_CANDIDATE_COUNT // 10 + 1) * 10,
     })
-    headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
-    response = requests.post(
-        SERPER_SEARCH_ENDPOINT, headers=headers, data=payload, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
-    )
-    if not response.ok:
-        raise HTTPException(response.status_code, "Search engine error.")
-    json_content = response.json()
+
+
+def _select_contexts(query: str, contexts: list) -> list:
+    if reranker is None:
+        return contexts[:REFERENCE_COUNT]
+    return reranker.rerank(query, contexts)
+
+
+def _parse_serper_response(json_content: dict) -> list:
     try:
         contexts = []
         if json_content.get("knowledgeGraph"):
@@ -89,183 +147,591 @@ def search_with_serper(query: str, subscription_key: str):
             if url and snippet:
                 contexts.append({"name": json_content["answerBox"].get("title", ""), "url": url, "snippet": snippet})
         contexts += [{"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")} for c in json_content["organic"]]
-        return contexts[:REFERENCE_COUNT]
+        return contexts[:SEARCH_CANDIDATE_COUNT]
     except KeyError:
         return []
 
 
-app = FastAPI()
+def search_with_serper(query: str, subscription_key: str):
+    headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
+    response = requests.post(
+        SERPER_SEARCH_ENDPOINT, headers=headers, data=_serper_payload(query),
+        timeout=timeout_for(DEFAULT_SEARCH_ENGINE_TIMEOUT),
+    )
+    if not response.ok:
+        raise HTTPException(response.status_code, "Search engine error.")
+    return _select_contexts(query, _parse_serper_response(response.json()))
 
-thread_local = threading.local()
 
-# Model configuration
-model_id = os.environ.get("LLM_MODEL", "gpt-4o-mini")
-should_do_related_questions = os.environ.get("RELATED_QUESTIONS", "true").lower() == "true"
+_search_client: Optional[httpx.AsyncClient] = None
 
 
-def get_main_response_agent():
-    """Get or create the main response Strands Agent with community tools."""
+def _http2_available() -> bool:
     try:
-        return thread_local.main_agent
-    except AttributeError:
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is required")
-        
-        model = OpenAIModel(
-            client_args={"api_key": api_key},
-            model_id=model_id,
-            params={
-                "max_tokens": 1024,
-                "temperature": 0.9,
-                "stop": stop_words[:4],  # OpenAI max 4 stop sequences
-            }
-        )
-        
-        thread_local.main_agent = Agent(
-            model=model,
-            tools=[calculator, python_repl, http_request],
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_search_client() -> httpx.AsyncClient:
+    """Get or create the process-wide pooled async client used for search calls."""
+    global _search_client
+    if _search_client is None or _search_client.is_closed:
+        _search_client = httpx.AsyncClient(
+            http2=SEARCH_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=SEARCH_MAX_CONNECTIONS,
+                max_keepalive_connections=SEARCH_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=SEARCH_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(DEFAULT_SEARCH_ENGINE_TIMEOUT, connect=SEARCH_CONNECT_TIMEOUT),
         )
-        return thread_local.main_agent
+    return _search_client
+
 
+async def close_search_client():
+    global _search_client
+    if _search_client is not None:
+        await _search_client.aclose()
+        _search_client = None
 
-def get_related_questions_agent():
-    """Get or create the related questions Strands Agent."""
+
+async def search_with_serper_async(query: str, subscription_key: str):
+    """Search with Serper on the shared async client, without blocking the event loop."""
+    headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
+    # Bounded by what is left of the request's deadline.
+    timeout = timeout_for(DEFAULT_SEARCH_ENGINE_TIMEOUT)
     try:
-        return thread_local.related_agent
-    except AttributeError:
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is required")
-        
-        model = OpenAIModel(
-            client_args={"api_key": api_key},
-            model_id=model_id,
-            params={
-                "max_tokens": 512,
-                "temperature": 0.7,
-            }
+        response = await get_search_client().post(
+            SERPER_SEARCH_ENDPOINT, headers=headers, content=_serper_payload(query),
+            timeout=httpx.Timeout(timeout, connect=min(SEARCH_CONNECT_TIMEOUT, timeout)),
         )
-        
-        thread_local.related_agent = Agent(model=model)
-        return thread_local.related_agent
+    except httpx.TimeoutException:
+        raise HTTPException(504, "Search engine timeout.")
+    except httpx.HTTPError:
+        raise HTTPException(502, "Search engine error.")
+    if not response.is_success:
+        raise HTTPException(response.status_code, "Search engine error.")
+    return _select_contexts(query, _parse_serper_response(response.json()))
+
+
+# SERPER, or LOCAL to search our own documents in the index at LOCAL_INDEX_PATH
+# (built with `python -m local_index build`).
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "SERPER").upper()
+local_index = LocalIndex(LOCAL_INDEX_PATH) if SEARCH_BACKEND == "LOCAL" else None
+
+
+async def search_with_local_index(query: str):
+    """Search the local index on a worker thread."""
+    return _select_contexts(query, await run_in_threadpool(local_index.search, query, SEARCH_CANDIDATE_COUNT))
+
+
+# Local searches are cheap and should see re-indexed documents right away.
+search_cache = search_cache_from_env(namespace="serper") if local_index is None else NullSearchCache()
+# Opened by the lifespan, so that importing app.py doesn't create the database.
+replay_store: Optional[ReplayStore] = None
+answer_cache = answer_cache_from_env()
+# Answers nobody reads any more are cancelled after STREAM_ABANDON_GRACE seconds.
+flights = SingleFlight(abandon_grace=STREAM_ABANDON_GRACE)
+# Per-upstream concurrency limits; requests that would queue too long are shed.
+admission = admission_from_env()
+# Optional: enrich the top results with passages from their pages (PAGE_FETCH_TOP_K).
+page_fetcher = page_fetcher_from_env()
+# Stage timelines of recent requests, served at /debug/trace/{search_uuid}.
+tracer = tracer_from_env()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global replay_store
+    replay_store = replay_store_from_env()
+    if tool_sandbox is not None:
+        # First, so the workers import the tools while the rest warms up.
+        with startup.phase("start_tool_workers"):
+            tool_sandbox.start()
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if LLM_WARM_CONNECTION and api_key:
+        try:
+            with startup.phase("warm_llm_connection"):
+                await warm_connection(get_async_openai_client(api_key))
+        except Exception as e:
+            print(f"Error warming up the LLM connection: {e}")
+    try:
+        with startup.phase("warm_main_agents"):
+            await run_in_threadpool(main_agent_pool.warm, AGENT_POOL_WARM)
+        with startup.phase("warm_related_agents"):
+            await run_in_threadpool(related_agent_pool.warm, AGENT_POOL_WARM)
+    except Exception as e:
+        print(f"Error warming up the agent pools: {e}")
+    startup.ready()
+    print(startup.summary())
+    yield
+    await close_search_client()
+    await close_clients()
+    search_cache.save()
+    if replay_store is not None:
+        replay_store.close()
+        replay_store = None
+    if page_fetcher is not None:
+        page_fetcher.close()
+    tracer.close()
+    if tool_sandbox is not None:
+        tool_sandbox.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(Overloaded)
+@app.exception_handler(CircuitOpen)
+@app.exception_handler(DeadlineExceeded)
+async def unavailable_handler(request: Request, exc):
+    return JSONResponse({"detail": str(exc)}, status_code=exc.status_code, headers=exc.headers)
+
+# Model configuration
+model_id = os.environ.get("LLM_MODEL", "gpt-4o-mini")
+should_do_related_questions = os.environ.get("RELATED_QUESTIONS", "true").lower() == "true"
+# Retries and the circuit breakers of the upstreams; answers and related questions
+# share the LLM endpoint.
+serper_upstream = upstreams.get("serper")
+llm_upstream = upstreams.get(f"llm:{model_id}")
+
+
+def _prompt_cache_params(kind: str) -> dict:
+    return {"prompt_cache_key": f"{LLM_PROMPT_CACHE_KEY}-{kind}"} if LLM_PROMPT_CACHE_KEY else {}
+
+
+def create_main_response_agent():
+    """Create a main response Strands Agent with community tools."""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is required")
+
+    model = OpenAIModel(
+        client=get_async_openai_client(api_key),
+        model_id=model_id,
+        params={
+            "max_tokens": 1024,
+            "temperature": 0.9,
+            "stop": stop_words[:4],  # OpenAI max 4 stop sequences
+            **_prompt_cache_params("answer"),
+        }
+    )
+
+    return Agent(
+        model=model,
+        system_prompt=_rag_layout.system,
+        tools=agent_tools,
+        # The answer is streamed to the client; don't also print it to stdout.
+        callback_handler=None,
+    )
+
 
+# Shared by all main agents; each tool is imported on its first call unless LAZY_TOOLS=false.
+community_tools = lazy_tools(lazy=LAZY_TOOLS)
+# With TOOL_SANDBOX_WORKERS > 0, python_repl and calculator calls run in worker
+# processes under CPU, time and memory limits instead of in this one.
+tool_sandbox = tool_sandbox_from_env()
+agent_tools = tool_sandbox.wrap(community_tools) if tool_sandbox is not None else community_tools
 
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=32)
 
+# Each request checks out an agent of its own with a fresh conversation; the pool
+# bounds how many agents exist over the life of the process.
+AGENT_POOL_SIZE = int(os.environ.get("AGENT_POOL_SIZE", "32"))
+AGENT_POOL_WARM = int(os.environ.get("AGENT_POOL_WARM", "4"))
+main_agent_pool = AgentPool(create_main_response_agent, max_size=AGENT_POOL_SIZE)
 
-def get_related_questions(query: str, contexts: list) -> List[str]:
+
+def create_related_questions_agent():
+    """Create a related questions Strands Agent."""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is required")
+
+    model = OpenAIModel(
+        client=get_async_openai_client(api_key),
+        model_id=model_id,
+        params={
+            "max_tokens": 512,
+            "temperature": 0.7,
+            **_prompt_cache_params("related"),
+        }
+    )
+
+    return Agent(model=model, system_prompt=_more_questions_layout.system, callback_handler=None)
+
+
+related_agent_pool = AgentPool(create_related_questions_agent, max_size=AGENT_POOL_SIZE)
+
+
+# Replay writes go to one SQLite file and serialize there anyway.
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="replay-writer")
+
+
+async def get_related_questions(query: str, contexts: list) -> List[str]:
     """
     Gets related questions based on the query and context using Strands structured output.
     """
     try:
-        # Build context string
-        context_str = "\n\n".join([c.get("snippet", "") for c in contexts])
-        
-        # Build system prompt
-        system_prompt = _more_questions_prompt.format(context=context_str)
-        
-        # Create agent with system prompt
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is required")
-        
-        model = OpenAIModel(
-            client_args={"api_key": api_key},
-            model_id=model_id,
-            params={
-                "max_tokens": 512,
-                "temperature": 0.7,
-            }
-        )
-        
-        agent = Agent(model=model, system_prompt=system_prompt)
-        
-        # Call agent with structured output
-        result = agent(query, structured_output_model=RelatedQuestions)
-        
+        # Build context string, deduplicated and within the related-questions token budget
+        context_str = format_contexts(pack_contexts(contexts, RELATED_CONTEXT_TOKEN_BUDGET), citations=False)
+
+        async def ask():
+            async with related_agent_pool.checkout() as agent:
+                # Call agent with structured output, within the request's deadline
+                return await asyncio.wait_for(agent.invoke_async(
+                    _more_questions_layout.user_message(context_str, query), structured_output_model=RelatedQuestions
+                ), timeout_for())
+
+        # Related questions are optional: when their limiter sheds the call or the
+        # LLM's circuit is open, the answer goes out without them.
+        async with admission.related.slot():
+            with related_questions_latency.time():
+                result = await llm_upstream.call(ask)
+        mark("related_questions_done")
+        invocation = getattr(result.metrics, "latest_agent_invocation", None)
+        if invocation is not None:
+            prompt_cache_stats.record("related", invocation.usage)
+
         # Return questions list (same format as before)
         return result.structured_output.questions[:5]
-        
+
     except Exception as e:
+        errors.inc("related")
+        mark("related_questions_failed", error=type(e).__name__)
         print(f"Error generating related questions: {e}")
         return []
 
 
-async def raw_stream_response(contexts, agent, system_prompt, query, related_questions_future):
+_llm_error_prefix = "Error generating response: "
+
+
+_empty_contexts_warning = "(The search engine returned nothing for this query. Please take the answer with a grain of salt.)\n\n"
+
+
+async def raw_stream_response(contexts, agent_pool, prompt, related_questions_future, on_complete=None):
+    """
+    Streams the contexts, the LLM answer to `prompt` and the related questions.
+    The agent brings the static system prompt. `prompt` may be an awaitable,
+    which is only awaited once the contexts were sent. If the answer
+    was generated without errors, `on_complete(answer, related_questions)` is
+    awaited at the end, with related_questions None if none were requested.
+    """
+    timer = AnswerTimer()
     yield json.dumps(contexts)
     yield "\n\n__LLM_RESPONSE__\n\n"
     if not contexts:
-        yield "(The search engine returned nothing for this query. Please take the answer with a grain of salt.)\n\n"
+        empty_contexts.inc()
+        yield _empty_contexts_warning
     
     # Stream response from Strands Agent using async streaming
+    answer_chunks = []
+    failed = False
+    usage = None
+    finished = False
     try:
-        # Combine system prompt and query
-        full_prompt = f"{system_prompt}\n\n{query}"
-        
-        # Use stream_async for async streaming
-        async for event in agent.stream_async(full_prompt):
-            # Strands stream_async yields event dictionaries with nested structure
-            if isinstance(event, dict):
-                # Extract text from contentBlockDelta events
-                if "event" in event and "contentBlockDelta" in event["event"]:
-                    delta = event["event"]["contentBlockDelta"].get("delta", {})
-                    if "text" in delta:
-                        yield delta["text"]
-            elif isinstance(event, str):
-                yield event
-    except Exception as e:
-        yield f"Error generating response: {str(e)}"
-    
-    # Wait for related questions to complete
-    if related_questions_future is not None:
         try:
-            # Use asyncio.wrap_future to properly await ThreadPoolExecutor future
-            import asyncio
-            related_questions = await asyncio.wrap_future(related_questions_future)
-            
-            # Convert to {question: string}[] format for frontend
-            related_objects = [{"question": q} for q in related_questions]
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
-            yield json.dumps(related_objects)
+            if inspect.isawaitable(prompt):
+                prompt = await prompt
+
+            async def answer_events():
+                # Use stream_async for async streaming
+                async with agent_pool.checkout() as agent:
+                    mark("agent_checkout")
+                    async for event in agent.stream_async(prompt):
+                        # Strands stream_async yields event dictionaries with nested structure
+                        if isinstance(event, dict):
+                            # Extract text from contentBlockDelta events
+                            if "event" in event and "contentBlockDelta" in event["event"]:
+                                delta = event["event"]["contentBlockDelta"].get("delta", {})
+                                if "text" in delta:
+                                    yield "text", delta["text"]
+                            # Token usage arrives once per model call, at its end
+                            elif "event" in event and "metadata" in event["event"]:
+                                yield "usage", event["event"]["metadata"].get("usage")
+                        elif isinstance(event, str):
+                            yield "text", event
+
+            # A call that fails before the first text is retried while the deadline allows.
+            timer.llm_call()
+            async for kind, value in llm_upstream.stream(answer_events):
+                if kind == "text":
+                    if not answer_chunks:
+                        mark("first_token")
+                    timer.token()
+                    answer_chunks.append(value)
+                    yield value
+                else:
+                    usage = add_usage(usage, value)
+            mark("last_token", deltas=len(answer_chunks))
         except Exception as e:
-            # If related questions fail, still send empty array
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
-            yield json.dumps([])
+            failed = True
+            errors.inc("answer")
+            mark("answer_failed", error=type(e).__name__)
+            yield f"{_llm_error_prefix}{str(e)}"
+        if usage is not None:
+            prompt_cache_stats.record("answer", usage)
+
+        # Wait for related questions to complete
+        related_questions = None
+        if related_questions_future is not None:
+            try:
+                related_questions = await related_questions_future
+                mark("related_questions_sent")
+
+                # Convert to {question: string}[] format for frontend
+                related_objects = [{"question": q} for q in related_questions]
+                yield "\n\n__RELATED_QUESTIONS__\n\n"
+                yield json.dumps(related_objects)
+            except Exception as e:
+                # If related questions fail, still send empty array
+                related_questions = []
+                yield "\n\n__RELATED_QUESTIONS__\n\n"
+                yield json.dumps([])
+
+        timer.done("failed" if failed else "completed")
+        if not failed:
+            abandonment_stats.record_completed(len(answer_chunks))
+            if on_complete is not None:
+                await on_complete("".join(answer_chunks), related_questions)
+        finished = True
+    finally:
+        if not finished:
+            timer.done("abandoned")
+            # Nobody reads the stream any more and SingleFlight cancelled it: stop the
+            # related questions too, and count what the abandoned answer saved.
+            related_cancelled = related_questions_future is not None and related_questions_future.cancel()
+            abandonment_stats.record_abandoned(len(answer_chunks), related_cancelled)
+
+
+async def cached_stream_response(cached_answer, generate_related_questions):
+    """Replays a cached answer with the same framing as raw_stream_response."""
+    yield json.dumps(cached_answer.contexts)
+    yield "\n\n__LLM_RESPONSE__\n\n"
+    if not cached_answer.contexts:
+        yield _empty_contexts_warning
+    yield cached_answer.answer
+    if generate_related_questions:
+        yield "\n\n__RELATED_QUESTIONS__\n\n"
+        yield json.dumps([{"question": q} for q in cached_answer.related_questions])
+
+
+async def release_when_done(stream, permit):
+    """Streams `stream` and then releases the admission permit it was started under."""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        permit.release()
+
+
+async def stream_and_record(stream, search_uuid):
+    """
+    Streams the result and stores it in the replay store once the stream has
+    finished. Failed generations are not stored, so that a shared link doesn't
+    replay an error forever.
+    """
+    all_yielded_results = []
+    async for result in stream:
+        all_yielded_results.append(result)
+        yield result
+    if any(result.startswith(_llm_error_prefix) for result in all_yielded_results):
+        return
+    _ = executor.submit(replay_store.put, search_uuid, "".join(all_yielded_results))
 
 
 class QueryRequest(BaseModel):
     query: str
     search_uuid: str
     generate_related_questions: Optional[bool] = True
+    # "text" keeps the __LLM_RESPONSE__ / __RELATED_QUESTIONS__ sentinel protocol;
+    # "ndjson" and "length" frame each section so clients need not scan for sentinels.
+    stream_format: Literal["text", "ndjson", "length"] = "text"
+
+
+def stream_response(stream, stream_format: str) -> StreamingResponse:
+    """Coalesces tiny chunks and encodes the stream in the requested format."""
+    return StreamingResponse(encode_stream(stream, stream_format), media_type=MEDIA_TYPES[stream_format])
 
 
 @app.post("/query")
-def query_function(request: QueryRequest) -> StreamingResponse:
+async def query_function(request: QueryRequest, http_request: Request) -> StreamingResponse:
+    # If the uuid was answered before, replay the stored result, so that shared
+    # links and page reloads don't run the search and the LLM again. Replays
+    # leave the trace of the original answer alone.
+    if replay_store is not None and request.search_uuid:
+        stored = await run_in_threadpool(replay_store.open_compressed, request.search_uuid)
+        if stored is not None:
+            cache_hits.inc("replay")
+            return replay_response(*stored, http_request.headers, request.stream_format)
+        cache_misses.inc("replay")
+
     query = request.query or _default_query
     query = re.sub(r"\[/?INST\]", "", query)
+    # Requests with a search_uuid leave a stage timeline behind, see /debug/trace.
+    trace = tracer.start(request.search_uuid, query=query)
+    try:
+        stream = await query_stream(request, query)
+    except Exception as e:
+        # Shed, timed out or failed before the stream started.
+        if trace is not None:
+            trace.attributes["status_code"] = getattr(e, "status_code", 500)
+        tracer.finish(trace, "rejected")
+        raise
+    if trace is not None:
+        stream = finish_when_done(stream, tracer, trace)
+    return stream_response(stream, request.stream_format)
+
+
+async def query_stream(request: QueryRequest, query: str):
+    """Returns the response stream to `request`, after searching if needed."""
+    # Near-duplicates of an already answered question are replayed from the
+    # answer cache, skipping both the search and the LLM calls.
+    with_related = should_do_related_questions and request.generate_related_questions
+    # With SHARED_CACHE_PATH the caches are SQLite queries that may wait for
+    # another process's write, so they run on worker threads.
+    cached_answer = await run_in_threadpool(answer_cache.get, query) if answer_cache is not None else None
+    if cached_answer is not None and (not with_related or cached_answer.related_questions is not None):
+        cache_hits.inc("answer")
+        mark("answer_cache_hit")
+        stream = cached_stream_response(cached_answer, with_related)
+        if replay_store is not None and request.search_uuid:
+            stream = stream_and_record(stream, request.search_uuid)
+        return stream
+    if answer_cache is not None:
+        cache_misses.inc("answer")
+
+    # Shed the request before searching if the LLM is backed up or failing.
+    admission.answer.check()
+    llm_upstream.breaker.check()
+    # Search, answer and related questions all share the request's deadline.
+    set_deadline(Deadline(REQUEST_DEADLINE))
+    if local_index is not None:
+        search = lambda: search_with_local_index(query)
+    else:
+        serper_key = os.environ.get("SERPER_SEARCH_API_KEY")
+        if not serper_key:
+            raise HTTPException(500, "SERPER_SEARCH_API_KEY environment variable is required")
+        search = lambda: serper_upstream.call(lambda: search_with_serper_async(query, serper_key))
+    # Identical queries that arrive while one is in flight share its search and
+    # its answer stream instead of calling the providers again.
+    flight_key = normalize_query(query)
+    with span("search") as stage:
+        contexts = await run_in_threadpool(search_cache.get, query)
+        stage["cached"] = contexts is not None
+        if contexts is None:
+            async def limited_search():
+                # A flight that ended while we looked may have just cached the results.
+                contexts = await run_in_threadpool(search_cache.get, query)
+                if contexts is not None:
+                    return contexts
+                async with admission.search.slot():
+                    with search_latency.time(SEARCH_BACKEND.lower()):
+                        try:
+                            contexts = await search()
+                        except Exception:
+                            errors.inc("search")
+                            raise
+                await run_in_threadpool(search_cache.put, query, contexts)
+                return contexts
+
+            contexts = await flights.do(flight_key, limited_search)
+        stage["results"] = len(contexts)
     
-    serper_key = os.environ.get("SERPER_SEARCH_API_KEY")
-    if not serper_key:
-        raise HTTPException(500, "SERPER_SEARCH_API_KEY environment variable is required")
-    contexts = search_with_serper(query, serper_key)
-    
-    system_prompt = _rag_query_text.format(
-        context="\n\n".join([f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)])
-    )
+    # Pack the snippets into the token budget; citation numbers stay those of `contexts`.
+    def build_prompt(prompt_contexts):
+        with span("prompt_build"):
+            return _rag_layout.user_message(format_contexts(pack_contexts(prompt_contexts)), query)
+
+    async def enriched_prompt():
+        # Page passages only go into the prompt; the client gets the search results.
+        with span("page_fetch"):
+            prompt_contexts = await page_fetcher.enrich(query, contexts)
+        return build_prompt(prompt_contexts)
     
     try:
-        agent = get_main_response_agent()
-        related_questions_future = None
-        if should_do_related_questions and request.generate_related_questions:
-            related_questions_future = executor.submit(get_related_questions, query, contexts)
+        # Make sure agents can be built before the stream starts.
+        await run_in_threadpool(main_agent_pool.warm, 1)
     except Exception as e:
         raise HTTPException(503, "Failed to initialize Strands Agent")
-    
-    return StreamingResponse(
-        raw_stream_response(contexts, agent, system_prompt, query, related_questions_future),
-        media_type="text/html"
-    )
+
+    async def cache_answer(answer, related_questions):
+        # Don't pin an answer whose related questions failed for a whole TTL.
+        if answer_cache is not None and (related_questions is None or related_questions):
+            await run_in_threadpool(answer_cache.put, query, contexts, answer, related_questions)
+
+    # Followers of an in-flight answer stream need no LLM slot of their own. A
+    # request whose flight finishes just before it subscribes streams without one.
+    stream_key = (flight_key, with_related)
+    if flights.streaming(stream_key):
+        mark("joined_stream")
+        permit = None
+    else:
+        with span("answer_admission"):
+            permit = await admission.answer.acquire()
+
+    def generate():
+        nonlocal permit
+        related_questions_future = None
+        if with_related:
+            # Generate related questions on the event loop while the answer streams.
+            related_questions_future = asyncio.ensure_future(get_related_questions(query, contexts))
+        # Pages are fetched after the contexts were sent, so slow sites never hold back the first byte.
+        prompt = build_prompt(contexts) if page_fetcher is None else enriched_prompt()
+        stream = raw_stream_response(
+            contexts, main_agent_pool, prompt, related_questions_future, on_complete=cache_answer
+        )
+        if permit is None:
+            return stream
+        answer_permit, permit = permit, None
+        return release_when_done(stream, answer_permit)
+
+    stream = flights.stream(stream_key, generate)
+    if permit is not None:
+        # Another request started the same stream while we waited for the slot.
+        permit.release()
+    if replay_store is not None and request.search_uuid:
+        stream = stream_and_record(stream, request.search_uuid)
+    return stream
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "agent_pool": main_agent_pool.stats(),
+        "related_agent_pool": related_agent_pool.stats(),
+        "llm_connections": connection_stats.snapshot(),
+        "search_cache": search_cache.stats(),
+        "replay_store": replay_store.stats() if replay_store is not None else None,
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "single_flight": flights.stats(),
+        "admission": admission.stats(),
+        "upstreams": upstreams.stats(),
+        "abandonment": abandonment_stats.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "page_fetcher": page_fetcher.stats() if page_fetcher is not None else None,
+        "local_index": local_index.stats() if local_index is not None else None,
+        "tracing": tracer.stats(),
+        "tools": tool_stats(community_tools),
+        "tool_sandbox": tool_sandbox.stats() if tool_sandbox is not None else None,
+        "startup": startup.stats(),
+    }
+
+
+@app.get("/debug/trace/{search_uuid}")
+def debug_trace(search_uuid: str):
+    """The stage timeline of a recent request."""
+    trace = tracer.get(search_uuid)
+    if trace is None:
+        raise HTTPException(404, "No trace for this search_uuid.")
+    return trace
+
+
+@app.get("/metrics")
+def metrics():
+    """Per-stage latencies and counters in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
 
 
 @app.get("/")
@@ -277,8 +743,10 @@ def index():
 import os.path
 if os.path.isdir("ui"):
     app.mount("/ui", StaticFiles(directory="ui", html=True), name="ui")
+startup.mark("module_setup")
 
 
 if __name__ == "__main__":
+    # A single process; serve.py runs WORKERS of them.
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,265 @@
+"""
+Load test of `/query` end to end: app.py, or the Lepton `RAG` photon, runs in a
+child process against local stand-ins of Serper and the OpenAI API and is
+driven at a fixed concurrency or at a fixed request rate. Needs no network
+access or API keys.
+
+    python -m benchmarks.bench_query_load --concurrency 16 --requests 200
+    python -m benchmarks.bench_query_load --rps 20 --duration 30 --ttft 0.3 --token-rate 50
+    python -m benchmarks.bench_query_load --target rag --concurrency 8 --json
+
+Reports time to first byte and full-stream latency percentiles, the error rate,
+throughput and the server's resident memory before and after the run. At a
+fixed rate, latency counts from when a request was due, so a server that falls
+behind shows it. With --max-p95-ms or --max-error-rate the exit status is 1
+when the run is worse, so that regressions can be checked from a script.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Callable, List, NamedTuple, Optional
+
+import httpx
+
+from benchmarks.standins import StandinServer, make_openai_app, make_serper_app
+
+# Marks an answer that failed after the stream started, with status 200.
+LLM_ERROR_MARKER = b"Error generating response: "
+
+
+class _MemoryKV:
+    """Stands in for Lepton's KV, which needs a workspace, inside the server process."""
+
+    def __init__(self, name, create_if_not_exists=True, error_if_exists=False):
+        self._values = {}
+
+    def get(self, key):
+        return self._values[key]
+
+    def put(self, key, value):
+        self._values[key] = value
+
+
+def app_target():
+    """app.py, configured through the environment."""
+    import app
+
+    return app.app
+
+
+def rag_target(serper_url: str, openai_url: str):
+    """The RAG photon, talking to the stand-ins, without a Lepton login or KV."""
+    import leptonai.api.v0.workspace
+
+    import search_with_lepton
+    from llm_clients import get_openai_client
+
+    class StandinRAG(search_with_lepton.RAG):
+        def local_client(self):
+            return get_openai_client(base_url=openai_url, api_key="bench-key")
+
+    leptonai.api.v0.workspace.login = lambda *args, **kwargs: None
+    search_with_lepton.KV = _MemoryKV
+    search_with_lepton.SERPER_SEARCH_ENDPOINT = serper_url
+    rag = StandinRAG()
+    rag._call_init_once()
+    return rag._create_app(load_mount=False)
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident memory of a process, from /proc; None where that is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Result(NamedTuple):
+    ttfb: Optional[float]
+    total: float
+    error: Optional[str]
+
+
+async def send_query(client: httpx.AsyncClient, url: str, body: dict, due: float) -> Result:
+    """Streams one answer; times count from `due`, the moment the request was due."""
+    ttfb, chunks = None, []
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            async for chunk in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - due
+                chunks.append(chunk)
+            if response.status_code != 200:
+                return Result(ttfb, time.perf_counter() - due, f"HTTP {response.status_code}")
+    except httpx.HTTPError as e:
+        return Result(ttfb, time.perf_counter() - due, type(e).__name__)
+    error = "LLM error" if LLM_ERROR_MARKER in b"".join(chunks) else None
+    return Result(ttfb, time.perf_counter() - due, error)
+
+
+async def closed_loop(send: Callable[[int, float], "asyncio.Future"], total: int, concurrency: int) -> List[Result]:
+    """`concurrency` users, each sending its next request as soon as the last one finished."""
+    indices = iter(range(total))
+    results = []
+
+    async def user():
+        for i in indices:
+            results.append(await send(i, time.perf_counter()))
+
+    await asyncio.gather(*[user() for _ in range(min(concurrency, total))])
+    return results
+
+
+async def open_loop(send: Callable[[int, float], "asyncio.Future"], rps: float, duration: float) -> List[Result]:
+    """Sends `rps` requests per second for `duration` seconds, however long they take."""
+    start = time.perf_counter()
+    tasks = []
+    for i in range(int(rps * duration)):
+        due = start + i / rps
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        tasks.append(asyncio.ensure_future(send(i, due)))
+    return await asyncio.gather(*tasks)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(results: List[Result], elapsed: float, rss_before: Optional[int], rss_after: Optional[int]) -> dict:
+    ok = [r for r in results if r.error is None]
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    ttfbs = [r.ttfb for r in ok if r.ttfb is not None]
+    totals = [r.total for r in ok]
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": len(results),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors,
+        "ttfb_ms": {f"p{q}": ms(percentile(ttfbs, q / 100)) for q in (50, 95, 99)},
+        "stream_ms": {f"p{q}": ms(percentile(totals, q / 100)) for q in (50, 95, 99)},
+        "rss_mb_before": None if rss_before is None else round(rss_before / 2 ** 20, 1),
+        "rss_mb_after": None if rss_after is None else round(rss_after / 2 ** 20, 1),
+    }
+
+
+def print_summary(target: str, summary: dict) -> None:
+    fmt = lambda value: "    n/a" if value is None else f"{value:7.1f}"
+    print(
+        f"{target}: {summary['requests']} requests in {summary['seconds']:.1f} s, "
+        f"{summary['throughput_rps']:.1f} ok/s, error rate {summary['error_rate']:.1%} {summary['errors'] or ''}"
+    )
+    for name in ("ttfb_ms", "stream_ms"):
+        p = summary[name]
+        print(f"  {name[:-3]:>6}: p50 {fmt(p['p50'])} ms  p95 {fmt(p['p95'])} ms  p99 {fmt(p['p99'])} ms")
+    if summary["rss_mb_before"] is not None:
+        growth = summary["rss_mb_after"] - summary["rss_mb_before"]
+        print(f"     rss: {summary['rss_mb_before']:.1f} MB -> {summary['rss_mb_after']:.1f} MB ({growth:+.1f} MB)")
+
+
+async def run_load(args, url: str, pid: int) -> dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        distinct = args.distinct_queries or max(args.requests, int(args.rps * args.duration)) + args.warmup
+
+        def send(i, due):
+            body = {
+                "query": f"{args.query} #{i % distinct}",
+                # RAG requires a uuid; app.py replays known ones, so a fresh one is never cached.
+                "search_uuid": uuid.uuid4().hex if args.target == "rag" else "",
+                "generate_related_questions": not args.no_related,
+            }
+            return send_query(client, url, body, due)
+
+        if args.warmup:
+            # Offset the warmup queries, so that measured queries don't hit caches it filled.
+            await closed_loop(lambda i, due: send(distinct - 1 - i, due), args.warmup, args.concurrency)
+        rss_before = rss_bytes(pid)
+        start = time.perf_counter()
+        if args.rps:
+            results = await open_loop(send, args.rps, args.duration)
+        else:
+            results = await closed_loop(send, args.requests, args.concurrency)
+        elapsed = time.perf_counter() - start
+        return summarize(results, elapsed, rss_before, rss_bytes(pid))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", choices=["app", "rag"], default="app")
+    parser.add_argument("--concurrency", type=int, default=16, help="users in the closed loop")
+    parser.add_argument("--requests", type=int, default=200, help="requests in the closed loop")
+    parser.add_argument("--rps", type=float, default=0.0, help="fixed request rate (open loop) instead")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of the open loop")
+    parser.add_argument("--warmup", type=int, default=10, help="requests before measuring")
+    parser.add_argument("--query", default="Who said live long and prosper?")
+    parser.add_argument("--distinct-queries", type=int, default=0, help="cycle through this many queries (default: all distinct)")
+    parser.add_argument("--no-related", action="store_true", help="don't ask for related questions")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--search-latency", type=float, default=0.3, help="stand-in search latency in seconds")
+    parser.add_argument("--search-jitter", type=float, default=0.1, help="random extra search latency, up to seconds")
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--ttft", type=float, default=0.2, help="stand-in LLM time to first token in seconds")
+    parser.add_argument("--token-rate", type=float, default=100.0, help="stand-in LLM tokens per second")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="words in the stand-in answer")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="fail if the full-stream p95 is slower")
+    parser.add_argument("--max-error-rate", type=float, help="fail if more requests fail")
+    args = parser.parse_args()
+
+    answer = " ".join(["Live long and prosper [citation:1]."] + ["word"] * max(0, args.answer_tokens - 6))
+    serper = StandinServer(
+        make_serper_app, latency=args.search_latency, jitter=args.search_jitter, error_rate=args.search_error_rate,
+    )
+    llm = StandinServer(
+        make_openai_app, answer=answer, ttft=args.ttft, token_delay=1 / args.token_rate if args.token_rate else 0.0,
+        error_rate=args.llm_error_rate,
+    )
+    with serper, llm:
+        if args.target == "app":
+            os.environ.update({
+                "SERPER_SEARCH_ENDPOINT": f"{serper.url}/search",
+                "SERPER_SEARCH_API_KEY": "bench-key",
+                "OPENAI_BASE_URL": f"{llm.url}/v1",
+                "OPENAI_API_KEY": "bench-key",
+            })
+            # Don't leave a replay database behind in the working directory.
+            os.environ.setdefault("REPLAY_STORE_PATH", "")
+            server = StandinServer(app_target)
+        else:
+            os.environ.update({
+                "BACKEND": "SERPER", "SERPER_SEARCH_API_KEY": "bench-key", "LLM_MODEL": "standin",
+                "KV_NAME": "bench", "RELATED_QUESTIONS": "true",
+            })
+            os.environ.setdefault("KV_SPILL_DIR", "")
+            server = StandinServer(rag_target, serper_url=f"{serper.url}/search", openai_url=f"{llm.url}/v1")
+        with server:
+            summary = asyncio.run(run_load(args, f"{server.url}/query", server.process.pid))
+
+    if args.json:
+        print(json.dumps({"target": args.target, **summary}))
+    else:
+        print_summary(args.target, summary)
+    failed = (args.max_p95_ms is not None and (summary["stream_ms"]["p95"] or float("inf")) > args.max_p95_ms) or \
+        (args.max_error_rate is not None and summary["error_rate"] > args.max_error_rate)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Times LexicalReranker over a pool of Serper-shaped candidates, to check that
+reranking an over-fetched pool costs under a millisecond per query (50
+candidates: about 0.5 ms at p50 and 0.75 ms at p99).
+
+    python -m benchmarks.bench_reranker --candidates 50 --iterations 2000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from benchmarks.standins import serper_payload
+from reranker import LexicalReranker
+
+QUERIES = [
+    "who said live long and prosper",
+    "how does the vulcan salute work",
+    "star trek original series episode amok time",
+]
+
+WORDS = (
+    "the of and a to in is was for on that with as by at from his her an were are which this be has had "
+    "star trek vulcan spock nimoy salute episode series television prosper live long gesture hand blessing"
+).split()
+
+
+def make_candidates(query: str, count: int, rng: random.Random) -> list:
+    results = serper_payload(query, count)["organic"]
+    return [
+        {"name": r["title"], "url": r["link"], "snippet": " ".join(rng.choice(WORDS) for _ in range(40))}
+        for r in results
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pools = [(query, make_candidates(query, args.candidates, rng)) for query in QUERIES]
+    reranker = LexicalReranker(args.limit, domain_priors={"example.com": 1.1})
+    for query, candidates in pools:
+        reranker.rerank(query, candidates)
+
+    timings = []
+    for i in range(args.iterations):
+        query, candidates = pools[i % len(pools)]
+        start = time.perf_counter()
+        reranker.rerank(query, candidates)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    p = lambda q: timings[min(len(timings) - 1, int(q * len(timings)))] * 1e6
+    print(
+        f"{args.candidates} candidates -> {args.limit}: "
+        f"p50 {p(0.50):7.1f} us  p95 {p(0.95):7.1f} us  p99 {p(0.99):7.1f} us  "
+        f"mean {statistics.mean(timings) * 1e6:7.1f} us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the old search path (per-request `requests.post` on a 40-thread pool,
+which is how Starlette runs a sync handler) with the pooled async client,
+against a local Serper stand-in served over TLS. Latency is measured from the
+moment a virtual user issues the search, so TLS setup and thread-pool queueing
+are both included.
+
+    python -m benchmarks.bench_search_client --requests 800 --concurrency 32
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import statistics
+import time
+
+from benchmarks.standins import StandinServer, make_serper_app
+
+# Starlette runs sync endpoints on anyio's default limiter of 40 threads.
+SYNC_HANDLER_THREADS = 40
+
+
+def _report(name: str, latencies: list, elapsed: float):
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(
+        f"{name:>10}: {len(latencies) / elapsed:8.1f} req/s  "
+        f"p50 {p(0.50):7.2f} ms  p95 {p(0.95):7.2f} ms  p99 {p(0.99):7.2f} ms  "
+        f"mean {statistics.mean(latencies) * 1000:7.2f} ms"
+    )
+
+
+async def _drive(search, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await search()
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[one() for _ in range(total)])
+    return latencies, time.perf_counter() - start
+
+
+async def bench_sync(app_module, total: int, concurrency: int):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_HANDLER_THREADS)
+    loop = asyncio.get_running_loop()
+
+    def search():
+        return loop.run_in_executor(pool, app_module.search_with_serper, "live long and prosper", "bench-key")
+
+    try:
+        return await _drive(search, total, concurrency)
+    finally:
+        pool.shutdown()
+
+
+async def bench_async(app_module, total: int, concurrency: int):
+    try:
+        return await _drive(
+            lambda: app_module.search_with_serper_async("live long and prosper", "bench-key"), total, concurrency
+        )
+    finally:
+        await app_module.close_search_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=800)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.3, help="stand-in search latency in seconds")
+    parser.add_argument("--no-tls", action="store_true", help="serve the stand-in over plain HTTP")
+    args = parser.parse_args()
+
+    with StandinServer(make_serper_app, tls=not args.no_tls, latency=args.latency) as server:
+        if server.ca_file:
+            os.environ["SSL_CERT_FILE"] = os.environ["REQUESTS_CA_BUNDLE"] = server.ca_file
+        import app as app_module
+        app_module.SERPER_SEARCH_ENDPOINT = f"{server.url}/search"
+        app_module.SEARCH_MAX_CONNECTIONS = args.concurrency
+        app_module.SEARCH_MAX_KEEPALIVE_CONNECTIONS = args.concurrency
+
+        _report("sync", *asyncio.run(bench_sync(app_module, args.requests, args.concurrency)))
+        _report("async", *asyncio.run(bench_async(app_module, args.requests, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Local stand-ins for the upstream services used by Evidence Search, so that
+benchmarks can run without network access or API keys.
+"""
+import asyncio
+import collections
+import datetime
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import time
+from typing import Optional
+
+import json
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serper_payload(query: str, num: int = 10, snippet_repeat: int = 4) -> dict:
+    """A Serper-shaped response with `num` organic results."""
+    return {
+        "searchParameters": {"q": query},
+        "organic": [
+            {
+                "title": f"Result {i} for {query}",
+                "link": f"https://example.com/{i}",
+                "snippet": f"Snippet {i} about {query}. " * snippet_repeat,
+            }
+            for i in range(num)
+        ],
+    }
+
+
+def make_serper_app(latency: float = 0.05, jitter: float = 0.0, snippet_repeat: int = 4,
+                    error_rate: float = 0.0) -> FastAPI:
+    """
+    A Serper-compatible `/search` endpoint that answers after `latency` seconds,
+    plus up to `jitter` seconds at random. `snippet_repeat` sets the payload
+    size, and a share `error_rate` of the calls fails with status 500.
+    """
+    standin = FastAPI()
+
+    @standin.post("/search")
+    async def search(request: Request):
+        body = json.loads(await request.body())
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+        if error_rate and random.random() < error_rate:
+            return Response(json.dumps({"message": "stand-in error"}), status_code=500, media_type="application/json")
+        payload = serper_payload(body.get("q", ""), body.get("num", 10), snippet_repeat)
+        return Response(json.dumps(payload), media_type="application/json")
+
+    return standin
+
+
+def _prompt_tokens(body: dict) -> list:
+    """
+    The prompt as the provider sees it, in ~4-byte tokens: tool definitions first,
+    then the messages in order.
+    """
+    parts = [json.dumps(body.get("tools") or [], sort_keys=True)]
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True)
+        parts.append(f"<|{message.get('role')}|>{content}")
+    prompt = "".join(parts).encode()
+    return [prompt[i:i + 4] for i in range(0, len(prompt), 4)]
+
+
+class PrefixCache:
+    """
+    Mimics provider prompt caching: the longest prefix shared with a recent
+    prompt is cached, counted in whole blocks and only from `min_tokens` on.
+    """
+
+    def __init__(self, block_tokens: int = 128, min_tokens: int = 1024, capacity: int = 256):
+        self.block_tokens = block_tokens
+        self.min_tokens = min_tokens
+        self._prompts = collections.deque(maxlen=capacity)
+
+    def lookup(self, tokens: list) -> int:
+        best = 0
+        for previous in self._prompts:
+            shared = 0
+            for a, b in zip(previous, tokens):
+                if a != b:
+                    break
+                shared += 1
+            best = max(best, shared)
+        self._prompts.append(tokens)
+        cached = best - best % self.block_tokens
+        return cached if cached >= self.min_tokens else 0
+
+
+def _usage(prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+# Arguments of the tool calls the stand-in makes: the related-questions tool of
+# search_with_lepton.py and the structured output of app.py.
+RELATED_QUESTIONS_CALL = {"questions": [
+    "Who first said live long and prosper?", "What does the Vulcan salute mean?", "Where is Vulcan?",
+]}
+DEFAULT_TOOL_ARGUMENTS = {"ask_related_questions": RELATED_QUESTIONS_CALL, "RelatedQuestions": RELATED_QUESTIONS_CALL}
+
+
+def _tool_to_call(body: dict, tool_arguments: dict) -> Optional[str]:
+    """The tool the model calls: the one `tool_choice` forces, or a known one it is offered."""
+    messages = body.get("messages") or []
+    if messages and messages[-1].get("role") == "tool":
+        return None  # the call was answered; reply with text
+    forced = body.get("tool_choice")
+    if isinstance(forced, dict):
+        return forced.get("function", {}).get("name")
+    names = [tool.get("function", {}).get("name") for tool in body.get("tools") or []]
+    return next((name for name in names if name in tool_arguments), None)
+
+
+def make_openai_app(
+    answer: str = "Live long and prosper [citation:1].",
+    ttft: float = 0.0,
+    token_delay: float = 0.0,
+    cache_block_tokens: int = 128,
+    cache_min_tokens: int = 1024,
+    tool_arguments: Optional[dict] = None,
+    error_rate: float = 0.0,
+) -> FastAPI:
+    """
+    An OpenAI-compatible `/v1/chat/completions` endpoint. It answers `answer`,
+    streamed word by word after `ttft` seconds with `token_delay` between
+    words, and reports prompt caching in `usage` like the hosted API does.
+
+    When offered a tool named in `tool_arguments` (default: the related-questions
+    tools), or forced to call a tool, it calls that tool with those arguments
+    instead, which is how structured output is requested. A share `error_rate`
+    of the calls fails with status 500.
+    """
+    standin = FastAPI()
+    cache = PrefixCache(cache_block_tokens, cache_min_tokens)
+    words = answer.split(" ")
+    tool_arguments = DEFAULT_TOOL_ARGUMENTS if tool_arguments is None else tool_arguments
+
+    @standin.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = json.loads(await request.body())
+        tokens = _prompt_tokens(body)
+        usage = _usage(len(tokens), cache.lookup(tokens), len(words))
+        base = {"id": "chatcmpl-standin", "created": int(time.time()), "model": body.get("model", "standin")}
+        await asyncio.sleep(ttft)
+        if error_rate and random.random() < error_rate:
+            error = {"error": {"message": "stand-in error", "type": "server_error"}}
+            return Response(json.dumps(error), status_code=500, media_type="application/json")
+        tool = _tool_to_call(body, tool_arguments)
+        arguments = json.dumps(tool_arguments.get(tool, {})) if tool else None
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": answer}
+            if tool:
+                message = {"role": "assistant", "content": None, "tool_calls": [{
+                    "id": "call_standin", "type": "function", "function": {"name": tool, "arguments": arguments},
+                }]}
+            return Response(json.dumps({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "tool_calls" if tool else "stop", "message": message}],
+                "usage": usage,
+            }), media_type="application/json")
+
+        def chunk(delta, finish_reason=None):
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            return f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [choice]})}\n\n"
+
+        async def events():
+            if tool:
+                yield chunk({"role": "assistant", "tool_calls": [{
+                    "index": 0, "id": "call_standin", "type": "function", "function": {"name": tool, "arguments": ""},
+                }]})
+                for i in range(0, len(arguments), 16):
+                    if token_delay:
+                        await asyncio.sleep(token_delay)
+                    yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": arguments[i:i + 16]}}]})
+                yield chunk({}, "tool_calls")
+            else:
+                for i, word in enumerate(words):
+                    if i and token_delay:
+                        await asyncio.sleep(token_delay)
+                    yield chunk({"role": "assistant", "content": word if i == 0 else " " + word})
+                yield chunk({}, "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return standin
+
+
+def make_self_signed_cert(directory: str) -> tuple:
+    """Writes a self-signed certificate for 127.0.0.1 and returns (certfile, keyfile)."""
+    import ipaddress
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certfile, keyfile = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+def _serve(app_factory, kwargs, port, certfile, keyfile):
+    uvicorn.run(
+        app_factory(**kwargs), host="127.0.0.1", port=port, log_level="warning", access_log=False,
+        ssl_certfile=certfile, ssl_keyfile=keyfile,
+    )
+
+
+class StandinServer:
+    """
+    Runs a stand-in app with uvicorn in a child process, so that the server does
+    not compete with the code under test for the GIL.
+
+    With `tls=True` the server uses a throwaway self-signed certificate, so that
+    clients pay a real TLS handshake per new connection like they do against the
+    hosted APIs. `ca_file` is the certificate to trust, e.g. through the
+    `SSL_CERT_FILE` / `REQUESTS_CA_BUNDLE` environment variables.
+    """
+
+    def __init__(self, app_factory, port: Optional[int] = None, tls: bool = False, **kwargs):
+        self.port = port or _free_port()
+        self.tls = tls
+        self._tmpdir = tempfile.TemporaryDirectory() if tls else None
+        certfile, keyfile = make_self_signed_cert(self._tmpdir.name) if tls else (None, None)
+        self.ca_file = certfile
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=_serve, args=(app_factory, kwargs, self.port, certfile, keyfile), daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f"{'https' if self.tls else 'http'}://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        self.process.start()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.process.kill()
+        raise RuntimeError(f"stand-in server on port {self.port} did not start")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join(timeout=5)
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
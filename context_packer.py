@@ -0,0 +1,125 @@
+"""
+Token-budgeted context packing between search and prompt building.
+
+Search snippets are joined into the prompt as they come back. Bing and Google
+results can carry long snippets, and mirrored pages carry the same text under
+different URLs, so the prompt grows without adding information. The packer
+walks the contexts in rank order, drops near-duplicate snippets, truncates
+long ones at sentence boundaries and stops once the token budget is filled.
+
+Citation numbers are those of the original contexts list, which is what the
+client receives, so [[citation:x]] always points at the same source even when
+earlier contexts were dropped.
+"""
+import math
+import os
+import re
+from typing import List, NamedTuple, Optional
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2000"))
+RELATED_CONTEXT_TOKEN_BUDGET = int(os.environ.get("RELATED_CONTEXT_TOKEN_BUDGET", "1000"))
+MAX_SNIPPET_TOKENS = int(os.environ.get("MAX_SNIPPET_TOKENS", "300"))
+DEDUPE_THRESHOLD = float(os.environ.get("CONTEXT_DEDUPE_THRESHOLD", "0.8"))
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?。！？])\s+|(?<=[。！？])")
+
+
+def _load_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding file may not be downloadable; fall back to the estimate.
+        return None
+
+
+_encoding = _load_encoding()
+
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with tiktoken if it is installed, or estimates ~4 bytes per token."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+class PackedContext(NamedTuple):
+    citation: int
+    snippet: str
+
+
+def _shingles(text: str) -> frozenset:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < 3:
+        return frozenset(words)
+    return frozenset(zip(words, words[1:], words[2:]))
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts `text` to at most `max_tokens`, at a sentence boundary if there is one that fits."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = ""
+    for sentence in _SENTENCE_END_RE.split(text):
+        candidate = f"{kept} {sentence}".strip() if kept else sentence
+        if count_tokens(candidate) > max_tokens:
+            break
+        kept = candidate
+    if kept:
+        return kept
+    # Not even the first sentence fits: cut at a word boundary instead.
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + " …") <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo]) + " …" if lo else ""
+
+
+def pack_contexts(
+    contexts: List[dict],
+    budget_tokens: int = CONTEXT_TOKEN_BUDGET,
+    max_snippet_tokens: Optional[int] = MAX_SNIPPET_TOKENS,
+    dedupe_threshold: float = DEDUPE_THRESHOLD,
+) -> List[PackedContext]:
+    """Packs context snippets, in rank order, into `budget_tokens`."""
+    packed = []
+    kept_shingles = []
+    remaining = budget_tokens
+    for citation, context in enumerate(contexts, start=1):
+        snippet = (context.get("snippet") or "").strip()
+        if not snippet:
+            continue
+        shingles = _shingles(snippet)
+        if any(_similarity(shingles, kept) >= dedupe_threshold for kept in kept_shingles):
+            continue
+        limit = min(remaining, max_snippet_tokens) if max_snippet_tokens else remaining
+        snippet = truncate_to_tokens(snippet, limit)
+        if not snippet:
+            break
+        kept_shingles.append(shingles)
+        packed.append(PackedContext(citation, snippet))
+        remaining -= count_tokens(snippet)
+        if remaining <= 0:
+            break
+    return packed
+
+
+def format_contexts(packed: List[PackedContext], citations: bool = True) -> str:
+    """Formats packed contexts for the prompt, with [[citation:x]] markers if `citations`."""
+    if citations:
+        return "\n\n".join(f"[[citation:{c.citation}]] {c.snippet}" for c in packed)
+    return "\n\n".join(c.snippet for c in packed)
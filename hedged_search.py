@@ -0,0 +1,262 @@
+"""
+Hedged fan-out over several search backends.
+
+A single search backend's tail latency becomes the tail latency of every
+answer. HedgedSearch sends the query to the primary backend and, only if that
+has not answered within a percentile of its own recent latency, sends a hedged
+request to the next backend. The first sufficient answer wins, or, in merge
+mode, the answers of every backend that was asked are merged and deduplicated
+by normalized URL. Since hedges only fire for the slowest few percent of
+requests, the average number of provider calls stays close to one.
+"""
+import bisect
+import concurrent.futures
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from loguru import logger
+
+from resilience import CircuitOpen, current_deadline
+
+
+class LatencyHistogram:
+    """
+    A thread-safe latency histogram with log-spaced buckets from 1 ms to ~65 s.
+    Percentiles are approximated by the upper bound of the matching bucket.
+    """
+
+    BOUNDS = [0.001 * 1.25 ** i for i in range(50)]
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds: float) -> None:
+        index = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank and count:
+                    return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+# Query parameters that only track the click. Only utm_ is a prefix; other
+# names must match exactly, so that real parameters such as eid or ref_id stay.
+_TRACKING_PREFIX = "utm_"
+_TRACKING_PARAMS = frozenset(("gclid", "fbclid", "ref", "ved", "ei"))
+
+
+def _is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name.startswith(_TRACKING_PREFIX) or name in _TRACKING_PARAMS
+
+
+def normalize_url(url: str) -> str:
+    """Normalizes a url for deduplication: scheme, www., fragment, tracking params, trailing slash."""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not _is_tracking_param(k)
+    ))
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+
+def to_common_context(c: dict) -> dict:
+    """Converts a bing/google/serper/searchapi result to the common {name,url,snippet} shape."""
+    return {
+        "name": c.get("name") or c.get("title", ""),
+        "url": c.get("url") or c.get("link", ""),
+        "snippet": c.get("snippet", ""),
+    }
+
+
+def merge_contexts(result_lists: List[List[dict]], limit: int) -> List[dict]:
+    """
+    Merges ranked result lists by interleaving them rank by rank, so that every
+    backend's best results make the cut, and drops duplicates by normalized url.
+    """
+    merged = []
+    seen = set()
+    for rank in range(max((len(results) for results in result_lists), default=0)):
+        for results in result_lists:
+            if rank >= len(results):
+                continue
+            context = to_common_context(results[rank])
+            key = normalize_url(context["url"])
+            if not context["url"] or key in seen:
+                continue
+            seen.add(key)
+            merged.append(context)
+            if len(merged) >= limit:
+                return merged
+    return merged
+
+
+class HedgedSearch:
+    """
+    Searches `backends` (name -> search function, in order of preference) with
+    percentile-delayed hedging.
+
+    - hedge_percentile: the primary's latency percentile after which a hedge is sent.
+    - default_hedge_delay: the hedge delay used until a backend has `min_samples`
+      recorded latencies.
+    - min_hedge_delay / max_hedge_delay: clamp for the adaptive delay.
+    - merge: if true, merge the results of all backends that were asked instead of
+      returning the first sufficient one.
+    - merge_grace: in merge mode, how long to wait for other in-flight backends
+      once the first sufficient answer arrived.
+    - min_results: the number of results that makes an answer sufficient.
+    - timeout: overall time limit for one search.
+    """
+
+    def __init__(
+        self,
+        backends: Dict[str, Callable[[str], List[dict]]],
+        limit: int,
+        hedge_percentile: float = 0.95,
+        default_hedge_delay: float = 1.0,
+        min_hedge_delay: float = 0.05,
+        max_hedge_delay: float = 5.0,
+        min_samples: int = 20,
+        merge: bool = False,
+        merge_grace: float = 0.2,
+        min_results: int = 1,
+        timeout: float = 10.0,
+        max_workers: int = 32,
+    ):
+        if not backends:
+            raise ValueError("HedgedSearch needs at least one backend.")
+        self.backends = backends
+        self.limit = limit
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.min_samples = min_samples
+        self.merge = merge
+        self.merge_grace = merge_grace
+        self.min_results = min_results
+        self.timeout = timeout
+        self.histograms = {name: LatencyHistogram() for name in backends}
+        self.calls = {name: 0 for name in backends}
+        self.errors = {name: 0 for name in backends}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        # Calls that lost the race keep running here until they finish, so they
+        # still contribute their latency to the histogram.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def hedge_delay(self, backend: str) -> float:
+        histogram = self.histograms[backend]
+        if histogram.count < self.min_samples:
+            return self.default_hedge_delay
+        delay = histogram.percentile(self.hedge_percentile)
+        return min(max(delay, self.min_hedge_delay), self.max_hedge_delay)
+
+    def _call(self, backend: str, query: str) -> List[dict]:
+        with self._lock:
+            self.calls[backend] += 1
+        start = time.monotonic()
+        try:
+            result = self.backends[backend](query)
+        except CircuitOpen:
+            # Failed without calling the backend, which says nothing about its latency.
+            with self._lock:
+                self.errors[backend] += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.errors[backend] += 1
+            self.histograms[backend].record(time.monotonic() - start)
+            raise
+        self.histograms[backend].record(time.monotonic() - start)
+        return result
+
+    def search(self, query: str) -> List[dict]:
+        deadline = time.monotonic() + self.timeout
+        request_deadline = current_deadline()
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline.expires_at)
+        pending_backends = list(self.backends)
+        futures = {}  # future -> backend
+        results = {}  # backend -> contexts
+        first_sufficient = None
+
+        def launch():
+            backend = pending_backends.pop(0)
+            # The calls see the request's deadline too.
+            futures[self.executor.submit(contextvars.copy_context().run, self._call, backend, query)] = backend
+            return backend
+
+        primary = launch()
+        next_hedge_at = time.monotonic() + self.hedge_delay(primary)
+        while futures:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            can_hedge = pending_backends and first_sufficient is None
+            # Hedge when the in-flight calls are slower than the percentile delay.
+            if can_hedge and now >= next_hedge_at:
+                hedged = launch()
+                with self._lock:
+                    self.hedges += 1
+                next_hedge_at = now + self.hedge_delay(hedged)
+            wait_until = min(deadline, next_hedge_at) if can_hedge else deadline
+            done, _ = concurrent.futures.wait(
+                futures, timeout=wait_until - now, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                backend = futures.pop(future)
+                try:
+                    results[backend] = future.result()
+                except Exception as e:
+                    logger.error(f"Search backend {backend} failed: {e}")
+                    continue
+                if first_sufficient is None and len(results[backend]) >= self.min_results:
+                    first_sufficient = backend
+                    # In merge mode, give the other in-flight calls a short grace period.
+                    deadline = min(deadline, time.monotonic() + self.merge_grace)
+            if first_sufficient is not None and not self.merge:
+                break
+            if not futures and pending_backends and first_sufficient is None:
+                # Everything in flight failed or came back empty, don't wait for the hedge delay.
+                launch()
+                with self._lock:
+                    self.hedges += 1
+
+        if first_sufficient is not None and first_sufficient != primary:
+            with self._lock:
+                self.hedge_wins += 1
+        ordered = [results[name] for name in self.backends if name in results]
+        if self.merge:
+            return merge_contexts(ordered, self.limit)
+        winner = results[first_sufficient] if first_sufficient is not None else (ordered[0] if ordered else [])
+        return [to_common_context(c) for c in winner[:self.limit]]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_delay": {name: self.hedge_delay(name) for name in self.backends},
+            }
@@ -0,0 +1,274 @@
+"""
+Write-behind persistence of finished streams to the Lepton KV.
+
+RAG stores every finished result in the KV, so that shared links replay it.
+Uploading each result from the executor the related questions run on let a
+slow KV back up user-facing work without limit, and every stream held its
+text as a list of small chunks. Instead, a stream now collects its text in a
+size-capped `ResultBuffer` and hands it to a `KVWriter`, which owns a bounded
+queue and a single worker thread. The worker takes the results in batches,
+compresses them and puts them into the KV. Results that waited longer than
+KV_SPILL_AFTER seconds, or whose put failed, are written to KV_SPILL_DIR
+instead and uploaded from there once the worker has caught up, so a slow KV
+costs disk rather than memory. When the queue is full, results are dropped and
+their links run the query again.
+
+Values are stored zlib-compressed behind a marker, so that replays can send
+them as they are (see replay_response.py); `decode_value` and
+`compressed_value` also read the plain text values stored before.
+"""
+import hashlib
+import os
+import queue
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Union
+
+from loguru import logger
+
+from metrics import kv_write_lag, kv_writes
+
+KV_WRITE_QUEUE_SIZE = int(os.environ.get("KV_WRITE_QUEUE_SIZE", "256"))
+KV_WRITE_BATCH_SIZE = int(os.environ.get("KV_WRITE_BATCH_SIZE", "16"))
+KV_SPILL_DIR = os.environ.get("KV_SPILL_DIR", "kv_spill")
+KV_SPILL_AFTER = float(os.environ.get("KV_SPILL_AFTER", "5"))
+KV_MAX_RESULT_KB = int(os.environ.get("KV_MAX_RESULT_KB", "1024"))
+
+# Marks compressed values. Stored results are JSON-led text, never a NUL byte.
+COMPRESSED_PREFIX = b"\x00z"
+# The Lepton KV rejects larger values.
+MAX_VALUE_BYTES = 256 * 1024
+
+_SPILL_SUFFIX = ".kv"
+
+
+def encode_value(result: bytes) -> bytes:
+    return COMPRESSED_PREFIX + zlib.compress(result)
+
+
+def decode_value(value: Union[str, bytes]) -> str:
+    """Returns the text of a stored value, compressed or not."""
+    if isinstance(value, str):
+        return value
+    if value.startswith(COMPRESSED_PREFIX):
+        value = zlib.decompress(value[len(COMPRESSED_PREFIX):])
+    return value.decode("utf-8")
+
+
+def compressed_value(value: Union[str, bytes]) -> bytes:
+    """Returns the zlib stream of a stored value, compressing values stored plain."""
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if value.startswith(COMPRESSED_PREFIX):
+        return value[len(COMPRESSED_PREFIX):]
+    return zlib.compress(value)
+
+
+class ResultBuffer:
+    """
+    A stream's text as UTF-8 in one growing bytearray. Past `max_bytes` the
+    buffer gives up, since a truncated result must not be replayed.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.overflowed = False
+
+    def append(self, text: str) -> None:
+        if self.overflowed:
+            return
+        encoded = text.encode("utf-8")
+        if len(self.data) + len(encoded) > self.max_bytes:
+            self.overflowed = True
+            self.data = bytearray()
+            return
+        self.data += encoded
+
+
+class KVWriter:
+    """Puts results into a KV from a bounded queue, spilling to disk when the KV is behind."""
+
+    def __init__(self, kv, queue_size: int = 256, batch_size: int = 16, spill_dir: str = "",
+                 spill_after: float = 5.0, max_value_bytes: int = MAX_VALUE_BYTES,
+                 idle_interval: float = 1.0):
+        self.kv = kv
+        self.batch_size = batch_size
+        self.spill_dir = spill_dir
+        self.spill_after = spill_after
+        self.max_value_bytes = max_value_bytes
+        self.idle_interval = idle_interval
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        # Results not written yet, so that a replay right after the stream finds them.
+        self._pending: Dict[str, bytes] = {}
+        self._closing = False
+        self.counts = {outcome: 0 for outcome in ("written", "spilled", "unspilled", "dropped", "failed", "too_large")}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._spilled = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            # Left over from the last run; uploaded when the worker is idle.
+            self._spilled = sum(1 for name in os.listdir(spill_dir) if name.endswith(_SPILL_SUFFIX))
+        self._thread = threading.Thread(target=self._run, name="kv-writer", daemon=True)
+        self._thread.start()
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+        kv_writes.inc(outcome)
+
+    def submit(self, key: str, result: Union[bytes, bytearray, ResultBuffer]) -> bool:
+        """Queues `result` for writing under `key`; returns False if it was dropped."""
+        if isinstance(result, ResultBuffer):
+            if result.overflowed:
+                self._count("too_large")
+                return False
+            result = result.data
+        data = bytes(result)
+        with self._lock:
+            self._pending[key] = data
+        try:
+            self._queue.put_nowait((key, data, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(key, None)
+            self._count("dropped")
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[bytes]:
+        """The value of a result that was submitted but is not in the KV yet, if any."""
+        with self._lock:
+            data = self._pending.get(key)
+        if data is not None:
+            return encode_value(data)
+        if self.spill_dir:
+            try:
+                with open(self._spill_path(key), "rb") as f:
+                    return f.read().split(b"\n", 1)[1]
+            except (OSError, IndexError):
+                pass
+        return None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                self._upload_spilled()
+                continue
+            batch, stop = [], item is None
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                stop = item is None
+            self._write_batch(batch)
+            if stop:
+                return
+            if self._queue.empty():
+                self._upload_spilled()
+
+    def _write_batch(self, batch) -> None:
+        for key, data, submitted_at in batch:
+            value = encode_value(data)
+            with self._lock:
+                self.bytes_in += len(data)
+                self.bytes_out += len(value)
+            if len(value) > self.max_value_bytes:
+                self._count("too_large")
+            elif self.spill_dir and (self._closing or time.monotonic() - submitted_at > self.spill_after):
+                # The KV is behind: park the result on disk and catch up from there.
+                self._spill(key, value)
+            else:
+                try:
+                    self.kv.put(key, value)
+                    self._count("written")
+                    kv_write_lag.observe(time.monotonic() - submitted_at)
+                except Exception as e:
+                    logger.error(f"KV write of {key} failed: {e}")
+                    if self.spill_dir:
+                        self._spill(key, value)
+                    else:
+                        self._count("failed")
+            with self._lock:
+                if self._pending.get(key) is data:
+                    del self._pending[key]
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + _SPILL_SUFFIX)
+
+    def _spill(self, key: str, value: bytes) -> None:
+        path = self._spill_path(key)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(key.encode("utf-8") + b"\n" + value)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.error(f"Spilling {key} failed: {e}")
+            self._count("failed")
+            return
+        with self._lock:
+            self._spilled += 1
+        self._count("spilled")
+
+    def _upload_spilled(self) -> None:
+        """Moves up to a batch of spilled results into the KV, stopping at the first failure."""
+        if not self._spilled or self._closing:
+            return
+        names = [name for name in os.listdir(self.spill_dir) if name.endswith(_SPILL_SUFFIX)]
+        if not names:
+            with self._lock:
+                self._spilled = 0
+            return
+        for name in names[:self.batch_size]:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    key, value = f.read().split(b"\n", 1)
+                spilled_at = os.path.getmtime(path)
+                self.kv.put(key.decode("utf-8"), value)
+                os.remove(path)
+            except Exception as e:
+                logger.error(f"Uploading spilled result {name} failed: {e}")
+                return
+            with self._lock:
+                self._spilled -= 1
+            self._count("unspilled")
+            kv_write_lag.observe(max(0.0, time.time() - spilled_at))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.counts,
+                "queued": self._queue.qsize(),
+                "spill_files": self._spilled,
+                "compression_ratio": self.bytes_out / self.bytes_in if self.bytes_in else None,
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Writes what is queued, to the spill directory if there is one, and stops the worker."""
+        self._closing = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+def kv_writer_from_env(kv) -> KVWriter:
+    """Builds the writer configured by the KV_WRITE_* and KV_SPILL_* variables."""
+    return KVWriter(
+        kv,
+        queue_size=KV_WRITE_QUEUE_SIZE,
+        batch_size=KV_WRITE_BATCH_SIZE,
+        spill_dir=KV_SPILL_DIR,
+        spill_after=KV_SPILL_AFTER,
+    )
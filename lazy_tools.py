@@ -0,0 +1,151 @@
+"""
+Community tools that are imported when the model first calls them.
+
+Importing `strands_tools.calculator`, `python_repl` and `http_request` takes
+longer than importing the rest of app.py together (sympy alone is a third of a
+second), and most requests never call a tool. An agent only needs the tools'
+names and specs up front, so `LazyTool` stands in for a tool with its spec
+and imports the module on the first call.
+
+The specs are read from TOOL_SPEC_CACHE, a JSON file keyed by the installed
+version of strands-agents-tools. When the file is missing or stale, the tools
+are imported once to write it; the Docker image writes it at build time with
+`python lazy_tools.py`.
+"""
+import asyncio
+import importlib
+import json
+import os
+import threading
+import time
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, Dict, List, Optional
+
+from strands.types.tools import AgentTool
+
+TOOL_SPEC_CACHE = os.environ.get("TOOL_SPEC_CACHE", "tool_specs.json")
+# false imports the tools at startup, as before.
+LAZY_TOOLS = os.environ.get("LAZY_TOOLS", "true").lower() == "true"
+
+# Modules of strands-agents-tools whose tool has the module's name.
+TOOL_MODULES = ("calculator", "python_repl", "http_request")
+_PACKAGE = "strands_tools"
+
+
+def _tools_version() -> str:
+    try:
+        return version("strands-agents-tools")
+    except PackageNotFoundError:
+        return ""
+
+
+def _load(module_name: str) -> AgentTool:
+    from strands.tools.loader import load_tools_from_module
+
+    module = importlib.import_module(f"{_PACKAGE}.{module_name}")
+    for tool in load_tools_from_module(module, module_name):
+        if tool.tool_name == module_name:
+            return tool
+    raise AttributeError(f"{_PACKAGE}.{module_name} has no tool named {module_name}")
+
+
+class LazyTool(AgentTool):
+    """A tool known by its spec until the first call imports it."""
+
+    def __init__(self, module_name: str, tool_spec: Dict[str, Any], tool_type: str):
+        super().__init__()
+        self.module_name = module_name
+        self._tool_spec = tool_spec
+        self._tool_type = tool_type
+        self._tool: Optional[AgentTool] = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def tool_name(self) -> str:
+        return self._tool_spec["name"]
+
+    @property
+    def tool_spec(self) -> Dict[str, Any]:
+        return self._tool_spec
+
+    @property
+    def tool_type(self) -> str:
+        return self._tool_type
+
+    @property
+    def loaded(self) -> bool:
+        return self._tool is not None
+
+    def load(self) -> AgentTool:
+        """Imports the tool, once."""
+        if self._tool is None:
+            with self._lock:
+                if self._tool is None:
+                    started = time.perf_counter()
+                    self._tool = _load(self.module_name)
+                    self.load_seconds = time.perf_counter() - started
+        return self._tool
+
+    async def stream(self, tool_use, invocation_state, **kwargs):
+        self.calls += 1
+        # The import takes a while; keep it off the event loop.
+        tool = self._tool or await asyncio.to_thread(self.load)
+        async for event in tool.stream(tool_use, invocation_state, **kwargs):
+            yield event
+
+
+def write_spec_cache(path: str = TOOL_SPEC_CACHE) -> Dict[str, Any]:
+    """Imports the tools and writes their specs to `path`; returns what was written."""
+    cache = {"version": _tools_version(), "tools": {}}
+    for name in TOOL_MODULES:
+        tool = _load(name)
+        cache["tools"][name] = {"spec": tool.tool_spec, "type": tool.tool_type}
+    if path:
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(cache, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Error writing the tool spec cache {path}: {e}")
+    return cache
+
+
+def _read_spec_cache(path: str) -> Optional[Dict[str, Any]]:
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != _tools_version() or set(cache.get("tools", ())) != set(TOOL_MODULES):
+        return None
+    return cache
+
+
+def lazy_tools(path: str = TOOL_SPEC_CACHE, lazy: bool = True) -> List[LazyTool]:
+    """The community tools, to be imported on their first call, or right away unless `lazy`."""
+    cache = _read_spec_cache(path) or write_spec_cache(path)
+    tools = [LazyTool(name, cache["tools"][name]["spec"], cache["tools"][name]["type"]) for name in TOOL_MODULES]
+    if not lazy:
+        for tool in tools:
+            tool.load()
+    return tools
+
+
+def tool_stats(tools: List[LazyTool]) -> dict:
+    return {
+        tool.tool_name: {
+            "loaded": tool.loaded,
+            "calls": tool.calls,
+            "load_ms": round(tool.load_seconds * 1000, 1) if tool.load_seconds is not None else None,
+        }
+        for tool in tools
+    }
+
+
+if __name__ == "__main__":
+    write_spec_cache()
+    print(f"Wrote the specs of {', '.join(TOOL_MODULES)} to {TOOL_SPEC_CACHE}")
@@ -0,0 +1,162 @@
+"""
+Process-wide pooled OpenAI-compatible clients, shared by app.py and
+search_with_lepton.py.
+
+Every search makes two LLM calls, one for the answer and one for the related
+questions. Building a new client per call means a new connection pool, and so a
+new TCP+TLS handshake, every time. Here each (base_url, api_key) gets one client
+over one pooled httpx client with keep-alive and optional HTTP/2, and the pool
+counts how many requests went out on a reused connection.
+
+The async clients must be used from the serving event loop; the sync clients
+are thread-safe and meant for thread-pool code such as RAG.
+"""
+import os
+import threading
+from typing import Optional
+
+import httpx
+import openai
+
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "true").lower() == "true"
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+# Open a connection to the LLM server at startup, so the first request finds one.
+LLM_WARM_CONNECTION = os.environ.get("LLM_WARM_CONNECTION", "true").lower() == "true"
+
+# Connect quickly, but give an overloaded inference server time to answer.
+DEFAULT_LLM_TIMEOUT = httpx.Timeout(connect=10, read=120, write=120, pool=10)
+# Retries are made by the callers, within the request's deadline and retry budget
+# (see resilience.py), rather than by the client on its own schedule.
+LLM_CLIENT_MAX_RETRIES = 0
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections; the rest reused a pooled connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_connection(self) -> None:
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+            }
+
+
+connection_stats = ConnectionStats()
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        connection_stats.record_request()
+        request.extensions["trace"] = self._trace
+        return super().handle_request(request)
+
+    @staticmethod
+    def _trace(name, info):
+        if name == "connection.connect_tcp.complete":
+            connection_stats.record_connection()
+
+
+class _CountingAsyncTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        connection_stats.record_request()
+        request.extensions["trace"] = self._trace
+        return await super().handle_async_request(request)
+
+    @staticmethod
+    async def _trace(name, info):
+        if name == "connection.connect_tcp.complete":
+            connection_stats.record_connection()
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _transport_args() -> dict:
+    return {
+        "http2": LLM_HTTP2 and _http2_available(),
+        "limits": httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _get_client(kind: str, base_url: Optional[str], api_key: Optional[str], timeout):
+    key = (kind, base_url, api_key)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if kind == "async":
+                http_client = httpx.AsyncClient(transport=_CountingAsyncTransport(**_transport_args()), timeout=timeout)
+                client = openai.AsyncOpenAI(
+                    base_url=base_url, api_key=api_key, http_client=http_client, timeout=timeout,
+                    max_retries=LLM_CLIENT_MAX_RETRIES,
+                )
+            else:
+                http_client = httpx.Client(transport=_CountingTransport(**_transport_args()), timeout=timeout)
+                client = openai.OpenAI(
+                    base_url=base_url, api_key=api_key, http_client=http_client, timeout=timeout,
+                    max_retries=LLM_CLIENT_MAX_RETRIES,
+                )
+            _clients[key] = client
+        return client
+
+
+def get_async_openai_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None, timeout=DEFAULT_LLM_TIMEOUT
+) -> openai.AsyncOpenAI:
+    """Gets the shared async client for `base_url` (default: OPENAI_BASE_URL or OpenAI)."""
+    return _get_client("async", base_url, api_key, timeout)
+
+
+def get_openai_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None, timeout=DEFAULT_LLM_TIMEOUT
+) -> openai.OpenAI:
+    """Gets the shared sync client for `base_url` (default: OPENAI_BASE_URL or OpenAI)."""
+    return _get_client("sync", base_url, api_key, timeout)
+
+
+async def warm_connection(client: openai.AsyncOpenAI, timeout: float = 5.0) -> None:
+    """Leaves a pooled connection to the client's server open, TLS handshake done."""
+    try:
+        await client.with_options(timeout=timeout, max_retries=0).models.list()
+    except openai.APIStatusError:
+        # Any answer means the connection is up, even from a server without /models.
+        pass
+
+
+async def close_clients() -> None:
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        if isinstance(client, openai.AsyncOpenAI):
+            await client.close()
+        else:
+            client.close()
@@ -0,0 +1,476 @@
+"""
+LOCAL search backend: an on-disk inverted index over our own documents.
+
+The index lives in a directory of immutable segments plus a `manifest.json`
+naming the live segments and the documents deleted from them. Each segment
+holds, as flat files that are memory-mapped when the index is opened:
+
+- terms.bin / term_offsets.npy: the sorted vocabulary, looked up by binary search.
+- postings.bin / postings_offsets.npy / df.npy: per term, the delta-coded
+  document ids followed by the term frequencies, compressed as variable-byte
+  integers and decoded with NumPy.
+- docs.bin / doc_offsets.npy / doc_lengths.npy: the zlib-compressed document
+  (url, name, text) used for generated snippets, and the token count of each.
+
+`build_index` is incremental: documents whose content hash did not change are
+left alone, changed and removed documents are marked deleted in their old
+segment, and new versions go to a fresh segment. The manifest is replaced
+atomically, and a running `LocalIndex` picks the new one up on a later search,
+so re-indexing never takes the backend down. Once there are more than
+`max_segments` segments they are merged into one from the stored documents.
+
+Build or update an index from a JSONL file (one {"url", "name"/"title",
+"text"/"content"/"snippet"} object per line) or a directory of .txt/.md/.html
+files with:
+
+    python -m local_index build corpus.jsonl local_index/
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from page_fetcher import extract_main_text, select_passages
+
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH", "local_index")
+LOCAL_INDEX_RELOAD_INTERVAL = float(os.environ.get("LOCAL_INDEX_RELOAD_INTERVAL", "5"))
+LOCAL_INDEX_MAX_SEGMENTS = int(os.environ.get("LOCAL_INDEX_MAX_SEGMENTS", "8"))
+
+MANIFEST = "manifest.json"
+TEXT_SUFFIXES = (".txt", ".md")
+HTML_SUFFIXES = (".html", ".htm")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall(text.lower())
+
+
+def vbyte_encode(values) -> bytes:
+    """Variable-byte encodes non-negative integers, 7 bits per byte, high bit set on all but the last byte."""
+    v = np.asarray(values, dtype=np.uint64)
+    if not len(v):
+        return b""
+    nbytes = np.ones(len(v), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += v >= np.uint64(1 << (7 * k))
+    owner = np.repeat(np.arange(len(v)), nbytes)
+    starts = np.cumsum(nbytes) - nbytes
+    k = np.arange(int(nbytes.sum())) - starts[owner]
+    out = ((v[owner] >> (7 * k).astype(np.uint64)) & np.uint64(127)).astype(np.uint8)
+    out[k != nbytes[owner] - 1] |= 128
+    return out.tobytes()
+
+
+def vbyte_decode(buf) -> np.ndarray:
+    """Decodes `vbyte_encode` output into a uint64 array."""
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if not len(b):
+        return np.zeros(0, dtype=np.uint64)
+    last = b < 128
+    starts = np.concatenate(([0], np.flatnonzero(last)[:-1] + 1))
+    group = np.concatenate(([0], np.cumsum(last)[:-1]))
+    k = np.arange(len(b)) - starts[group]
+    values = (b & 127).astype(np.uint64) << (7 * k).astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+class Document(NamedTuple):
+    key: str
+    url: str
+    name: str
+    text: str
+    version: str
+
+
+class SourceEntry(NamedTuple):
+    """A document of the source, by key and version; `load()` reads it in full."""
+    key: str
+    version: str
+    load: Callable[[], Document]
+
+
+def _sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def read_jsonl(path: str) -> Iterator[SourceEntry]:
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            url = record.get("url") or record.get("link") or f"local:{record.get('id', line_number)}"
+            text = record.get("text") or record.get("content") or record.get("snippet") or ""
+            name = record.get("name") or record.get("title") or url
+            doc = Document(str(record.get("id", url)), url, name, text, _sha1(line))
+            yield SourceEntry(doc.key, doc.version, lambda doc=doc: doc)
+
+
+def _load_file(key: str, url: str, path: str, version: str) -> Document:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        raw = f.read()
+    if path.lower().endswith(HTML_SUFFIXES):
+        title = _TITLE_RE.search(raw)
+        text = "\n\n".join(extract_main_text(raw))
+        name = " ".join(title.group(1).split()) if title else os.path.basename(path)
+    else:
+        text = raw
+        name = raw.strip().split("\n", 1)[0][:200] or os.path.basename(path)
+    return Document(key, url, name, text, version)
+
+
+def read_directory(root: str, url_prefix: Optional[str] = None) -> Iterator[SourceEntry]:
+    """
+    The text and HTML files under `root`. Versions are mtime and size, so that
+    unchanged files are never read.
+    """
+    root = os.path.abspath(root)
+    for directory, _, files in os.walk(root):
+        for filename in sorted(files):
+            if not filename.lower().endswith(TEXT_SUFFIXES + HTML_SUFFIXES):
+                continue
+            path = os.path.join(directory, filename)
+            key = os.path.relpath(path, root).replace(os.sep, "/")
+            stat = os.stat(path)
+            url = f"{url_prefix.rstrip('/')}/{key}" if url_prefix else f"file://{path}"
+            version = f"{stat.st_mtime_ns}:{stat.st_size}"
+            yield SourceEntry(key, version, lambda args=(key, url, path, version): _load_file(*args))
+
+
+def read_source(source: str, url_prefix: Optional[str] = None) -> Iterator[SourceEntry]:
+    if os.path.isdir(source):
+        return read_directory(source, url_prefix)
+    return read_jsonl(source)
+
+
+def _write_segment(directory: str, documents: List[Document]) -> None:
+    """Writes one immutable segment for `documents`; doc ids are list positions."""
+    os.makedirs(directory)
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    doc_lengths = np.zeros(len(documents), dtype=np.int32)
+    doc_offsets = [0]
+    with open(os.path.join(directory, "docs.bin"), "wb") as docs:
+        for doc_id, doc in enumerate(documents):
+            tokens = tokenize(f"{doc.name}\n{doc.text}")
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+            record = zlib.compress(json.dumps({"url": doc.url, "name": doc.name, "text": doc.text}).encode())
+            docs.write(record)
+            doc_offsets.append(doc_offsets[-1] + len(record))
+
+    terms = sorted(postings)
+    term_offsets, postings_offsets, df = [0], [0], np.zeros(len(terms), dtype=np.int32)
+    with open(os.path.join(directory, "terms.bin"), "wb") as terms_file, \
+            open(os.path.join(directory, "postings.bin"), "wb") as postings_file:
+        for i, term in enumerate(terms):
+            encoded = term.encode()
+            terms_file.write(encoded)
+            term_offsets.append(term_offsets[-1] + len(encoded))
+            entries = postings[term]
+            ids = np.fromiter((doc_id for doc_id, _ in entries), dtype=np.int64, count=len(entries))
+            deltas = np.diff(ids, prepend=0)
+            block = vbyte_encode(np.concatenate((deltas, [tf for _, tf in entries])))
+            postings_file.write(block)
+            postings_offsets.append(postings_offsets[-1] + len(block))
+            df[i] = len(entries)
+
+    np.save(os.path.join(directory, "term_offsets.npy"), np.asarray(term_offsets, dtype=np.int64))
+    np.save(os.path.join(directory, "postings_offsets.npy"), np.asarray(postings_offsets, dtype=np.int64))
+    np.save(os.path.join(directory, "df.npy"), df)
+    np.save(os.path.join(directory, "doc_offsets.npy"), np.asarray(doc_offsets, dtype=np.int64))
+    np.save(os.path.join(directory, "doc_lengths.npy"), doc_lengths)
+
+
+def _map(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment:
+    """A memory-mapped, immutable index segment."""
+
+    def __init__(self, directory: str, deleted: Iterable[int] = ()):
+        self.directory = directory
+        load = lambda name: np.load(os.path.join(directory, name), mmap_mode="r")
+        self.term_offsets = load("term_offsets.npy")
+        self.postings_offsets = load("postings_offsets.npy")
+        self.df = load("df.npy")
+        self.doc_offsets = load("doc_offsets.npy")
+        self.doc_lengths = load("doc_lengths.npy")
+        self.terms = _map(os.path.join(directory, "terms.bin"))
+        self.postings = _map(os.path.join(directory, "postings.bin"))
+        self.docs = _map(os.path.join(directory, "docs.bin"))
+        self.live = np.ones(len(self.doc_lengths), dtype=bool)
+        self.live[list(deleted)] = False
+
+    @property
+    def num_terms(self) -> int:
+        return len(self.df)
+
+    def _term(self, i: int) -> bytes:
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]]
+
+    def find(self, term: str) -> int:
+        """The index of `term` in the vocabulary, or -1."""
+        encoded = term.encode()
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.num_terms and self._term(lo) == encoded else -1
+
+    def postings_for(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(doc ids, term frequencies) of term `i`."""
+        values = vbyte_decode(self.postings[self.postings_offsets[i]:self.postings_offsets[i + 1]])
+        n = len(values) // 2
+        return np.cumsum(values[:n]).astype(np.int64), values[n:].astype(np.float64)
+
+    def document(self, doc_id: int) -> dict:
+        return json.loads(zlib.decompress(self.docs[self.doc_offsets[doc_id]:self.doc_offsets[doc_id + 1]]))
+
+
+def _read_manifest(index_dir: str) -> dict:
+    path = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"segments": [], "deleted": {}, "sources": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(index_dir: str, manifest: dict) -> None:
+    tmp = os.path.join(index_dir, f"{MANIFEST}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(index_dir, MANIFEST))
+
+
+def build_index(
+    source: str, index_dir: str, url_prefix: Optional[str] = None, max_segments: int = LOCAL_INDEX_MAX_SEGMENTS
+) -> dict:
+    """
+    Brings the index in `index_dir` up to date with `source` and returns counts
+    of the added, updated, removed and unchanged documents.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = _read_manifest(index_dir)
+    sources = manifest["sources"]
+    deleted = {segment: set(ids) for segment, ids in manifest["deleted"].items()}
+    seen, new_documents = set(), []
+    counts = Counter()
+
+    for entry in read_source(source, url_prefix):
+        if entry.key in seen:
+            continue
+        seen.add(entry.key)
+        previous = sources.get(entry.key)
+        if previous is not None and previous[2] == entry.version:
+            counts["unchanged"] += 1
+            continue
+        if previous is not None:
+            deleted.setdefault(previous[0], set()).add(previous[1])
+            counts["updated"] += 1
+        else:
+            counts["added"] += 1
+        new_documents.append(entry.load())
+
+    for key in set(sources) - seen:
+        segment, doc_id, _ = sources.pop(key)
+        deleted.setdefault(segment, set()).add(doc_id)
+        counts["removed"] += 1
+
+    segments = list(manifest["segments"])
+    if new_documents:
+        segment = uuid.uuid4().hex
+        _write_segment(os.path.join(index_dir, segment), new_documents)
+        segments.append(segment)
+        for doc_id, doc in enumerate(new_documents):
+            sources[doc.key] = [segment, doc_id, doc.version]
+
+    obsolete = []
+    if len(segments) > max_segments:
+        # Merge everything into one segment, from the stored documents.
+        merged, merged_sources = [], {}
+        by_location = {(segment, doc_id): (key, version) for key, (segment, doc_id, version) in sources.items()}
+        for segment in segments:
+            reader = Segment(os.path.join(index_dir, segment), deleted.get(segment, ()))
+            for doc_id in np.flatnonzero(reader.live):
+                key, version = by_location[(segment, int(doc_id))]
+                stored = reader.document(int(doc_id))
+                merged_sources[key] = [None, len(merged), version]
+                merged.append(Document(key, stored["url"], stored["name"], stored["text"], version))
+        segment = uuid.uuid4().hex
+        _write_segment(os.path.join(index_dir, segment), merged)
+        for location in merged_sources.values():
+            location[0] = segment
+        obsolete, segments, sources, deleted = segments, [segment], merged_sources, {}
+        counts["merged"] = len(obsolete)
+
+    manifest = {
+        "segments": segments,
+        "deleted": {segment: sorted(ids) for segment, ids in deleted.items() if segment in segments and ids},
+        "sources": sources,
+    }
+    _write_manifest(index_dir, manifest)
+    # Readers that still map obsolete segments keep working: the files are only unlinked.
+    for segment in obsolete:
+        shutil.rmtree(os.path.join(index_dir, segment), ignore_errors=True)
+    return dict(counts)
+
+
+class _Snapshot(NamedTuple):
+    segments: List[Segment]
+    num_docs: int
+    avg_length: float
+
+
+class LocalIndex:
+    """
+    Searches the index in `index_dir` with BM25 and returns `{name, url,
+    snippet}` contexts with query-relevant snippets. The manifest is checked
+    for a new version at most every `reload_interval` seconds.
+    """
+
+    def __init__(self, index_dir: str, reload_interval: float = LOCAL_INDEX_RELOAD_INTERVAL,
+                 k1: float = 1.2, b: float = 0.75, snippet_words: int = 60):
+        self.index_dir = index_dir
+        self.reload_interval = reload_interval
+        self.k1 = k1
+        self.b = b
+        self.snippet_words = snippet_words
+        self._lock = threading.Lock()
+        self._manifest_version = None
+        self._snapshot = _Snapshot([], 0, 1.0)
+        self.reloads = 0
+        self.reload()
+        self._checked_at = time.monotonic()
+
+    def _manifest_stamp(self):
+        try:
+            stat = os.stat(os.path.join(self.index_dir, MANIFEST))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def reload(self) -> bool:
+        """Opens the current manifest if it changed; returns whether it did."""
+        stamp = self._manifest_stamp()
+        if stamp == self._manifest_version:
+            return False
+        manifest = _read_manifest(self.index_dir)
+        segments = [
+            Segment(os.path.join(self.index_dir, segment), manifest["deleted"].get(segment, ()))
+            for segment in manifest["segments"]
+        ]
+        num_docs = sum(int(s.live.sum()) for s in segments)
+        total_length = sum(float(s.doc_lengths[s.live].sum()) for s in segments)
+        with self._lock:
+            self._snapshot = _Snapshot(segments, num_docs, total_length / num_docs if num_docs else 1.0)
+            self._manifest_version = stamp
+            self.reloads += 1
+        return True
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            self.reload()
+        except (OSError, ValueError, KeyError):
+            # Caught mid-update (e.g. a segment merged away); keep serving the old snapshot.
+            pass
+
+    def search(self, query: str, limit: int = 8) -> List[dict]:
+        self._maybe_reload()
+        snapshot = self._snapshot
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not snapshot.num_docs:
+            return []
+
+        found = [[(segment, segment.find(term)) for segment in snapshot.segments] for term in terms]
+        candidates = []
+        for term_postings in found:
+            df = sum(int(segment.df[i]) for segment, i in term_postings if i >= 0)
+            if not df:
+                continue
+            idf = np.log1p((snapshot.num_docs - df + 0.5) / (df + 0.5))
+            for segment, i in term_postings:
+                if i < 0:
+                    continue
+                doc_ids, tf = segment.postings_for(i)
+                norm = self.k1 * (1 - self.b + self.b * segment.doc_lengths[doc_ids] / snapshot.avg_length)
+                candidates.append((segment, doc_ids, idf * tf * (self.k1 + 1) / (tf + norm)))
+
+        scores = {}
+        for segment, doc_ids, term_scores in candidates:
+            total = scores.get(id(segment))
+            if total is None:
+                total = scores[id(segment)] = (segment, np.zeros(len(segment.doc_lengths)))
+            np.add.at(total[1], doc_ids, term_scores)
+
+        ranked = []
+        for segment, segment_scores in scores.values():
+            segment_scores[~segment.live] = 0
+            top = np.flatnonzero(segment_scores)
+            if len(top) > limit:
+                top = top[np.argpartition(-segment_scores[top], limit)[:limit]]
+            ranked.extend((segment_scores[doc_id], segment, int(doc_id)) for doc_id in top)
+        ranked.sort(key=lambda item: -item[0])
+        return [self._context(query, segment, doc_id) for _, segment, doc_id in ranked[:limit]]
+
+    def _context(self, query: str, segment: Segment, doc_id: int) -> dict:
+        doc = segment.document(doc_id)
+        paragraphs = [p for p in re.split(r"\n\s*\n", doc["text"]) if p.strip()] or [doc["text"]]
+        passages = select_passages(query, paragraphs, 1, max_words=self.snippet_words)
+        snippet = passages[0] if passages else " ".join(doc["text"].split()[:self.snippet_words])
+        return {"name": doc["name"], "url": doc["url"], "snippet": " ".join(snippet.split())}
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {"segments": len(snapshot.segments), "documents": snapshot.num_docs, "reloads": self.reloads}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build or incrementally update an index")
+    build.add_argument("source", help="a JSONL file or a directory of .txt/.md/.html files")
+    build.add_argument("index_dir", nargs="?", default=LOCAL_INDEX_PATH)
+    build.add_argument("--url-prefix", help="base url for files of a directory source (default: file:// paths)")
+    build.add_argument("--max-segments", type=int, default=LOCAL_INDEX_MAX_SEGMENTS)
+    search = commands.add_parser("search", help="query an index")
+    search.add_argument("query")
+    search.add_argument("index_dir", nargs="?", default=LOCAL_INDEX_PATH)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        counts = build_index(args.source, args.index_dir, args.url_prefix, args.max_segments)
+        print(f"{counts} in {time.perf_counter() - start:.2f}s")
+    else:
+        for context in LocalIndex(args.index_dir).search(args.query):
+            print(json.dumps(context, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Per-stage latency and throughput metrics, served in the Prometheus text format.
+
+app.py serves them at `GET /metrics`. The Lepton deployment already serves the
+prometheus_client registry at `/metrics`, so `register_prometheus_collector()`
+adds these metrics to it.
+
+Recording sits on the hot path of every request, so it takes no lock: each
+thread records into a shard of its own, which no other thread writes, and a
+scrape sums the shards. The only lock is taken once per thread and metric, to
+register the thread's shard. A scrape that races a recording may see a
+histogram's count one ahead of its sum, which Prometheus tolerates.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+NAMESPACE = "evidence_search"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the histogram buckets, in seconds unless noted.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STREAM_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_RATE_BUCKETS = (5, 10, 20, 40, 80, 160, 320)  # tokens per second
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A metric whose samples are kept in per-thread shards."""
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[dict] = []
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self) -> List[dict]:
+        with self._lock:
+            shards = list(self._shards)
+        # Copying a dict is atomic, while iterating one another thread adds to is not.
+        return [shard.copy() for shard in shards]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, per label values."""
+
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        totals = {}
+        for shard in self._snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets with the given upper bounds, per label values."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket and one for +Inf, then the sum.
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observes the seconds spent in the `with` block, also if it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *labels)
+
+    def values(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        """Returns the cumulative bucket counts, ending with +Inf, and the sum per label values."""
+        totals = {}
+        for shard in self._snapshots():
+            for labels, counts in shard.items():
+                counts = list(counts)
+                total = totals.setdefault(labels, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+        result = {}
+        for labels, total in totals.items():
+            cumulative, running = [], 0
+            for count in total[:-1]:
+                running += count
+                cumulative.append(running)
+            result[labels] = (cumulative, total[-1])
+        return result
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        names = self.labelnames + ("le",)
+        for labels, (cumulative, total) in sorted(self.values().items()):
+            for bound, count in zip(self.buckets + (float("inf"),), cumulative):
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (_format_value(bound),))} {count}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative[-1]}")
+        return lines
+
+
+class Registry:
+    """The metrics of the process, rendered together."""
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+search_latency = registry.histogram(
+    "search_latency_seconds", "Search latency per backend, retries included.", ["backend"]
+)
+llm_time_to_first_token = registry.histogram(
+    "llm_time_to_first_token_seconds", "Seconds from the LLM call to the first answer token."
+)
+llm_tokens_per_second = registry.histogram(
+    "llm_tokens_per_second", "Answer tokens per second after the first token.", buckets=TOKEN_RATE_BUCKETS
+)
+stream_duration = registry.histogram(
+    "stream_duration_seconds", "Duration of answer streams by outcome (completed, failed, abandoned).",
+    ["outcome"], buckets=STREAM_BUCKETS,
+)
+related_questions_latency = registry.histogram(
+    "related_questions_latency_seconds", "Latency of the related-questions call."
+)
+queue_wait = registry.histogram(
+    "admission_queue_wait_seconds", "Seconds requests waited for an admission slot.", ["limiter"]
+)
+errors = registry.counter("errors_total", "Errors per stage (search, answer, related).", ["stage"])
+cache_hits = registry.counter("cache_hits_total", "Cache hits per cache (search, answer, replay).", ["cache"])
+cache_misses = registry.counter("cache_misses_total", "Cache misses per cache (search, answer, replay).", ["cache"])
+empty_contexts = registry.counter(
+    "empty_context_responses_total", "Answers generated without any search results."
+)
+kv_writes = registry.counter(
+    "kv_writes_total",
+    "Results handed to the KV writer by outcome (written, spilled, unspilled, dropped, failed, too_large).",
+    ["outcome"],
+)
+kv_write_lag = registry.histogram(
+    "kv_write_lag_seconds", "Seconds from the end of a stream to its result being in the KV.",
+    buckets=STREAM_BUCKETS,
+)
+tool_calls = registry.counter(
+    "tool_calls_total",
+    "Sandboxed tool calls by tool and outcome (ok, error, cpu_limit, timeout, crashed, rejected).",
+    ["tool", "outcome"],
+)
+tool_call_duration = registry.histogram(
+    "tool_call_seconds", "Seconds a sandbox worker took per tool call.", ["tool"]
+)
+tool_queue_wait = registry.histogram(
+    "tool_queue_wait_seconds", "Seconds tool calls waited for a sandbox worker."
+)
+
+
+class AnswerTimer:
+    """
+    Times one answer stream from its start: call `llm_call()` when the LLM is
+    called, `token()` per streamed delta and `done(outcome)` once at the end, to
+    record time to first token, token rate and stream duration.
+    """
+
+    def __init__(self):
+        self.start = self.llm_called_at = time.monotonic()
+        self.first_token_at = None
+        self.tokens = 0
+
+    def llm_call(self) -> None:
+        self.llm_called_at = time.monotonic()
+
+    def token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            llm_time_to_first_token.observe(self.first_token_at - self.llm_called_at)
+        self.tokens += 1
+
+    def done(self, outcome: str) -> None:
+        end = time.monotonic()
+        stream_duration.observe(end - self.start, outcome)
+        if outcome == "completed" and self.tokens > 1 and end > self.first_token_at:
+            llm_tokens_per_second.observe((self.tokens - 1) / (end - self.first_token_at))
+
+
+_collector_registered = False
+
+
+def register_prometheus_collector() -> bool:
+    """
+    Adds these metrics to the default prometheus_client registry, if that is
+    installed, so that an existing `/metrics` endpoint serves them too.
+    """
+    global _collector_registered
+    if _collector_registered:
+        return True
+    try:
+        from prometheus_client import REGISTRY
+        from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+    except ImportError:
+        return False
+
+    class Collector:
+        def collect(self):
+            for metric in registry.metrics:
+                if isinstance(metric, Counter):
+                    # prometheus_client adds the _total suffix itself.
+                    family = CounterMetricFamily(
+                        metric.name[:-len("_total")], metric.documentation, labels=metric.labelnames
+                    )
+                    for labels, value in metric.values().items():
+                        family.add_metric(labels, value)
+                else:
+                    family = HistogramMetricFamily(metric.name, metric.documentation, labels=metric.labelnames)
+                    for labels, (cumulative, total) in metric.values().items():
+                        bounds = [_format_value(bound) for bound in metric.buckets + (float("inf"),)]
+                        family.add_metric(labels, list(zip(bounds, cumulative)), total)
+                yield family
+
+    REGISTRY.register(Collector())
+    _collector_registered = True
+    return True
@@ -0,0 +1,450 @@
+"""
+Page-fetch enrichment between search and prompt building.
+
+Search snippets are one or two sentences, which is often not enough to answer
+the question. `PageFetcher.enrich` fetches the pages behind the top results
+concurrently, extracts their main text and appends the passages most relevant
+to the query to each snippet.
+
+The stage is bounded so that it can sit in the request path: all fetches share
+one total deadline after which the unfinished ones are dropped, each host gets
+a limited number of concurrent connections, and at most `max_bytes` of a page
+are read. Extracted documents are cached by URL and revalidated with
+If-None-Match / If-Modified-Since once they are older than the TTL.
+
+Search results are untrusted URLs, so only hosts that resolve to public
+addresses are fetched: loopback, private, link-local and reserved addresses
+are refused, and redirects are followed one hop at a time, each checked the
+same way.
+
+The fetcher runs its own event loop in a daemon thread, so that the pooled
+client and the per-host limits are shared by async (app.py) and threaded
+(search_with_lepton.py) callers alike.
+"""
+import asyncio
+import ipaddress
+import math
+import os
+import re
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict
+from html.parser import HTMLParser
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+PAGE_FETCH_TOP_K = int(os.environ.get("PAGE_FETCH_TOP_K", "0"))
+PAGE_FETCH_DEADLINE = float(os.environ.get("PAGE_FETCH_DEADLINE", "1.5"))
+PAGE_FETCH_PER_HOST = int(os.environ.get("PAGE_FETCH_PER_HOST", "2"))
+PAGE_FETCH_MAX_BYTES = int(os.environ.get("PAGE_FETCH_MAX_BYTES", str(512 * 1024)))
+PAGE_PASSAGES = int(os.environ.get("PAGE_PASSAGES", "3"))
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", "1024"))
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", "600"))
+
+USER_AGENT = "Mozilla/5.0 (compatible; EvidenceSearch/1.0)"
+MAX_REDIRECTS = 5
+
+_TEXT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+# Elements whose text is never main content.
+_SKIP_TAGS = {
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+    "nav", "header", "footer", "aside", "form", "button", "select", "option",
+}
+# Elements that end a block of text.
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "dl", "dt", "dd",
+    "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "table", "tr", "td", "th",
+    "br", "hr", "figcaption", "title",
+}
+_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?。！？])\s+")
+
+
+class BlockedURL(Exception):
+    """A URL whose host is not a public address."""
+
+
+async def _resolve(host: str) -> List[str]:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return not (
+        ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved
+        or ip.is_multicast or ip.is_unspecified
+    )
+
+
+class _MainTextParser(HTMLParser):
+    """Collects text blocks with their link density, skipping boilerplate elements."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self._skip_depth = 0
+        self._link_depth = 0
+        self._text = []
+        self._link_chars = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _VOID_TAGS:
+            if tag in _BLOCK_TAGS:
+                self._flush()
+            return
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "a":
+            self._link_depth += 1
+        if tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag == "a":
+            self._link_depth = max(0, self._link_depth - 1)
+        if tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+        self._text.append(data)
+        if self._link_depth:
+            self._link_chars += len(data.strip())
+
+    def _flush(self):
+        text = " ".join("".join(self._text).split())
+        if text:
+            self.blocks.append((text, self._link_chars / len(text)))
+        self._text = []
+        self._link_chars = 0
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def extract_main_text(html: str, min_chars: int = 40, max_link_density: float = 0.5) -> List[str]:
+    """
+    Extracts the paragraphs of main text from an HTML page: the text of skipped
+    elements (scripts, navigation, headers, footers, forms) is dropped, and so
+    are short blocks and blocks that are mostly link text, like menus.
+    """
+    parser = _MainTextParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # html.parser is lenient; a page it chokes on keeps what was parsed.
+        pass
+    return [
+        text for text, link_density in parser.blocks
+        if len(text) >= min_chars and link_density <= max_link_density
+    ]
+
+
+def _plain_text_paragraphs(text: str, min_chars: int = 40) -> List[str]:
+    paragraphs = (" ".join(p.split()) for p in re.split(r"\n\s*\n", text))
+    return [p for p in paragraphs if len(p) >= min_chars]
+
+
+def split_passages(paragraphs: List[str], max_words: int = 80) -> List[str]:
+    """Splits paragraphs into passages of whole sentences, at most ~`max_words` words each."""
+    passages = []
+    for paragraph in paragraphs:
+        current, words = [], 0
+        for sentence in _SENTENCE_END_RE.split(paragraph):
+            count = len(sentence.split())
+            if current and words + count > max_words:
+                passages.append(" ".join(current))
+                current, words = [], 0
+            current.append(sentence)
+            words += count
+        if current:
+            passages.append(" ".join(current))
+    return passages
+
+
+def select_passages(query: str, paragraphs: List[str], limit: int, max_words: int = 80) -> List[str]:
+    """
+    The `limit` passages most relevant to `query`, scored with BM25 over the
+    passages of the page, in page order. Passages without query terms are never
+    selected.
+    """
+    passages = split_passages(paragraphs, max_words)
+    terms = set(_WORD_RE.findall(query.lower()))
+    if not passages or not terms or limit <= 0:
+        return []
+    tokenized = [_WORD_RE.findall(passage.lower()) for passage in passages]
+    avg_len = sum(len(tokens) for tokens in tokenized) / len(tokenized) or 1.0
+    df = Counter(term for tokens in tokenized for term in set(tokens) & terms)
+    k1, b = 1.2, 0.75
+    scores = []
+    for i, tokens in enumerate(tokenized):
+        tf = Counter(token for token in tokens if token in terms)
+        score = 0.0
+        for term, freq in tf.items():
+            idf = math.log(1 + (len(passages) - df[term] + 0.5) / (df[term] + 0.5))
+            score += idf * freq * (k1 + 1) / (freq + k1 * (1 - b + b * len(tokens) / avg_len))
+        if score > 0:
+            scores.append((score, i))
+    best = sorted(i for _, i in sorted(scores, reverse=True)[:limit])
+    return [passages[i] for i in best]
+
+
+class CachedPage(NamedTuple):
+    paragraphs: List[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+class PageFetcher:
+    """
+    Fetches and caches the main text of result pages. `enrich(query, contexts)`
+    returns a copy of the contexts where the top `top_k` snippets carry the
+    most relevant passages of their page; it never takes longer than `deadline`
+    seconds. Hosts that are not public addresses are refused unless
+    `allow_private_hosts`.
+    """
+
+    def __init__(
+        self,
+        top_k: int = 3,
+        deadline: float = 1.5,
+        per_host: int = 2,
+        max_bytes: int = 512 * 1024,
+        passages: int = 3,
+        cache_size: int = 1024,
+        cache_ttl: float = 600,
+        max_connections: int = 64,
+        allow_private_hosts: bool = False,
+    ):
+        self.top_k = top_k
+        self.deadline = deadline
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.passages = passages
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.max_connections = max_connections
+        self.allow_private_hosts = allow_private_hosts
+        self._cache = OrderedDict()
+        # host -> [semaphore, fetches holding or waiting for it]; only touched on the fetcher loop.
+        self._host_limits: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+        self._stats = Counter()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="page-fetcher", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Only called on the fetcher loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                # Redirects are followed by _open, which checks every hop.
+                follow_redirects=False,
+                headers={"User-Agent": USER_AGENT, "Accept": "text/html,text/plain;q=0.9"},
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.deadline),
+            )
+        return self._client
+
+    def _cache_get(self, url: str) -> Optional[CachedPage]:
+        with self._lock:
+            page = self._cache.get(url)
+            if page is not None:
+                self._cache.move_to_end(url)
+            return page
+
+    def _cache_put(self, url: str, page: CachedPage) -> None:
+        with self._lock:
+            self._cache[url] = page
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    async def _check_url(self, url: httpx.URL) -> None:
+        """Raises BlockedURL unless `url` is http(s) on a host with only public addresses."""
+        if url.scheme not in ("http", "https") or not url.host:
+            raise BlockedURL(str(url))
+        if self.allow_private_hosts:
+            return
+        try:
+            addresses = [str(ipaddress.ip_address(url.host))]
+        except ValueError:
+            try:
+                addresses = await _resolve(url.host)
+            except OSError:
+                raise BlockedURL(str(url))
+        if not addresses or not all(_is_public(address) for address in addresses):
+            raise BlockedURL(str(url))
+
+    async def _open(self, url: str, headers: dict) -> httpx.Response:
+        """Sends a streaming GET for `url`, following at most MAX_REDIRECTS checked redirects."""
+        client = self._get_client()
+        request = client.build_request("GET", url, headers=headers)
+        for _ in range(MAX_REDIRECTS + 1):
+            await self._check_url(request.url)
+            response = await client.send(request, stream=True)
+            if not response.is_redirect or response.next_request is None:
+                return response
+            await response.aclose()
+            request = response.next_request
+        raise httpx.TooManyRedirects(f"More than {MAX_REDIRECTS} redirects", request=request)
+
+    async def _read_capped(self, response: httpx.Response) -> bytes:
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) >= self.max_bytes:
+                self._stats["truncated"] += 1
+                break
+        return bytes(body[:self.max_bytes])
+
+    async def _fetch(self, url: str) -> Optional[List[str]]:
+        cached = self._cache_get(url)
+        if cached is not None and time.monotonic() - cached.fetched_at < self.cache_ttl:
+            self._stats["cache_hits"] += 1
+            return cached.paragraphs
+
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        host = urlsplit(url).netloc.lower()
+        limit = self._host_limits.setdefault(host, [asyncio.Semaphore(self.per_host), 0])
+        limit[1] += 1
+        try:
+            async with limit[0]:
+                response = await self._open(url, headers)
+                try:
+                    if response.status_code == 304 and cached is not None:
+                        self._stats["not_modified"] += 1
+                        self._cache_put(url, cached._replace(fetched_at=time.monotonic()))
+                        return cached.paragraphs
+                    response.raise_for_status()
+                    content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+                    if content_type and content_type not in _TEXT_TYPES:
+                        self._stats["skipped"] += 1
+                        return None
+                    body = await self._read_capped(response)
+                finally:
+                    await response.aclose()
+        finally:
+            limit[1] -= 1
+            if not limit[1]:
+                del self._host_limits[host]
+
+        self._stats["fetched"] += 1
+        self._stats["bytes"] += len(body)
+        text = body.decode(response.encoding or "utf-8", errors="replace")
+        # Parse off the loop, so that the other fetches keep making progress.
+        extract = _plain_text_paragraphs if content_type == "text/plain" else extract_main_text
+        paragraphs = await asyncio.get_running_loop().run_in_executor(None, extract, text)
+        self._cache_put(url, CachedPage(
+            paragraphs, response.headers.get("etag"), response.headers.get("last-modified"), time.monotonic()
+        ))
+        return paragraphs
+
+    async def _fetch_quietly(self, url: str) -> Optional[List[str]]:
+        try:
+            return await self._fetch(url)
+        except asyncio.CancelledError:
+            raise
+        except BlockedURL:
+            self._stats["blocked"] += 1
+            return None
+        except Exception:
+            self._stats["errors"] += 1
+            return None
+
+    async def _enrich(self, query: str, contexts: List[dict]) -> List[dict]:
+        self._stats["requests"] += 1
+        targets = [
+            i for i, c in enumerate(contexts[:self.top_k])
+            if urlsplit(c.get("url") or "").scheme in ("http", "https")
+        ]
+        tasks = {asyncio.ensure_future(self._fetch_quietly(contexts[i]["url"])): i for i in targets}
+        if not tasks:
+            return contexts
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            task.cancel()
+        self._stats["timeouts"] += len(pending)
+
+        enriched = list(contexts)
+        for task in done:
+            paragraphs = task.result()
+            if not paragraphs:
+                continue
+            passages = select_passages(query, paragraphs, self.passages)
+            if passages:
+                i = tasks[task]
+                snippet = contexts[i].get("snippet") or ""
+                enriched[i] = {**contexts[i], "snippet": " ".join([snippet, *passages]).strip()}
+                self._stats["enriched"] += 1
+        return enriched
+
+    def _submit(self, query: str, contexts: List[dict]):
+        return asyncio.run_coroutine_threadsafe(self._enrich(query, contexts), self._ensure_loop())
+
+    async def enrich(self, query: str, contexts: List[dict]) -> List[dict]:
+        """Enriches the contexts; for callers on an event loop."""
+        return await asyncio.wrap_future(self._submit(query, contexts))
+
+    def enrich_sync(self, query: str, contexts: List[dict]) -> List[dict]:
+        """Enriches the contexts; for callers on a worker thread."""
+        return self._submit(query, contexts).result()
+
+    def close(self) -> None:
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(timeout=5)
+            self._client = None
+        self._host_limits.clear()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def stats(self) -> dict:
+        with self._lock:
+            cached = len(self._cache)
+        return {**self._stats, "cached_pages": cached}
+
+
+def page_fetcher_from_env() -> Optional[PageFetcher]:
+    """The page fetcher configured by PAGE_FETCH_* / PAGE_CACHE_*, or None if PAGE_FETCH_TOP_K is 0."""
+    if PAGE_FETCH_TOP_K <= 0:
+        return None
+    return PageFetcher(
+        top_k=PAGE_FETCH_TOP_K,
+        deadline=PAGE_FETCH_DEADLINE,
+        per_host=PAGE_FETCH_PER_HOST,
+        max_bytes=PAGE_FETCH_MAX_BYTES,
+        passages=PAGE_PASSAGES,
+        cache_size=PAGE_CACHE_SIZE,
+        cache_ttl=PAGE_CACHE_TTL,
+    )
@@ -0,0 +1,155 @@
+"""
+Prompt layout that keeps the static instructions in a stable prefix.
+
+LLM providers cache prompt prefixes: when a request starts with the same tokens
+as a recent one, those tokens are served from the cache, which is cheaper and
+cuts the time to first token. The prompts used to be sent as one string with
+the per-query contexts spliced into the instructions, so the static text did
+not form a message of its own, and providers that cache at message boundaries
+(explicit cache points on the system prompt) could not cache it.
+
+`split_prompt` cuts a `{context}` template into a system prompt holding only
+the static instructions, and a user message holding the contexts followed by
+the query. The system prompt is byte-identical across requests, so the tool
+definitions plus instructions form a cacheable prefix.
+
+`PromptCacheStats` records how many prompt tokens the provider reported as
+served from its cache, from either Strands usage dicts or OpenAI usage objects.
+"""
+import collections
+import threading
+from typing import List, NamedTuple, Optional
+
+CONTEXT_PLACEHOLDER = "{context}"
+
+
+class PromptLayout(NamedTuple):
+    """The static system prompt, and the user message around contexts and query."""
+    system: str
+    context_intro: str
+    query_intro: str
+
+    def user_message(self, context: str, query: str) -> str:
+        """The per-request part of the prompt: contexts first, the query last."""
+        return f"{self.context_intro}\n\n{context}\n\n{self.query_intro}\n{query}"
+
+    def messages(self, context: str, query: str) -> list:
+        """OpenAI chat messages for the layout."""
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user_message(context, query)},
+        ]
+
+
+def split_prompt(template: str) -> PromptLayout:
+    """
+    Splits a prompt template with a single `{context}` placeholder. The last
+    paragraph before the placeholder introduces the contexts and moves into the
+    user message along with them; everything before it is the system prompt.
+    The text after the placeholder introduces the query.
+    """
+    head, sep, tail = template.partition(CONTEXT_PLACEHOLDER)
+    if not sep or CONTEXT_PLACEHOLDER in tail:
+        raise ValueError("prompt template must contain exactly one {context} placeholder")
+    instructions, _, context_intro = head.strip().rpartition("\n\n")
+    if not instructions:
+        raise ValueError("prompt template has no instructions before the contexts")
+    return PromptLayout(instructions.strip(), context_intro.strip(), tail.strip())
+
+
+class PromptUsage(NamedTuple):
+    prompt_tokens: int
+    cached_tokens: int
+
+    @property
+    def uncached_tokens(self) -> int:
+        return self.prompt_tokens - self.cached_tokens
+
+
+def _int(value) -> Optional[int]:
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def parse_usage(usage) -> Optional[PromptUsage]:
+    """
+    Reads prompt and cached token counts from a Strands `Usage` dict or an
+    OpenAI `CompletionUsage`. Returns None when the usage carries no counts.
+    """
+    if isinstance(usage, dict):
+        input_tokens = _int(usage.get("inputTokens"))
+        if input_tokens is None:
+            return None
+        cached = _int(usage.get("cacheReadInputTokens")) or 0
+        output_tokens = _int(usage.get("outputTokens")) or 0
+        total_tokens = _int(usage.get("totalTokens"))
+        if total_tokens is not None and input_tokens + output_tokens != total_tokens:
+            # Providers that report cache reads and writes apart from inputTokens.
+            input_tokens += cached + (_int(usage.get("cacheWriteInputTokens")) or 0)
+        return PromptUsage(input_tokens, cached)
+
+    prompt_tokens = _int(getattr(usage, "prompt_tokens", None))
+    if prompt_tokens is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = _int(getattr(details, "cached_tokens", None)) or 0
+    return PromptUsage(prompt_tokens, cached)
+
+
+def add_usage(total: Optional[PromptUsage], usage) -> Optional[PromptUsage]:
+    """Adds the counts of `usage` to `total`, e.g. over the cycles of an agent run."""
+    parsed = parse_usage(usage)
+    if parsed is None:
+        return total
+    if total is None:
+        return parsed
+    return PromptUsage(total.prompt_tokens + parsed.prompt_tokens, total.cached_tokens + parsed.cached_tokens)
+
+
+class PromptCacheStats:
+    """
+    Thread-safe totals of cached versus uncached prompt tokens per prompt kind,
+    plus the usage of the last `history` requests of each kind.
+    """
+
+    def __init__(self, history: int = 100):
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._recent = collections.defaultdict(lambda: collections.deque(maxlen=history))
+
+    def record(self, kind: str, usage) -> Optional[PromptUsage]:
+        """Records the usage of one request and returns its parsed counts."""
+        parsed = usage if isinstance(usage, PromptUsage) else parse_usage(usage)
+        if parsed is None:
+            return None
+        with self._lock:
+            totals = self._totals.setdefault(kind, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += parsed.prompt_tokens
+            totals[2] += parsed.cached_tokens
+            if parsed.cached_tokens:
+                totals[3] += 1
+            self._recent[kind].append(parsed)
+        return parsed
+
+    def recent(self, kind: str) -> List[PromptUsage]:
+        """The usage of the most recent requests of `kind`, oldest first."""
+        with self._lock:
+            return list(self._recent.get(kind, ()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            totals = {kind: list(values) for kind, values in self._totals.items()}
+        return {
+            kind: {
+                "requests": requests,
+                "requests_with_cache_hits": hits,
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "uncached_tokens": prompt_tokens - cached_tokens,
+                "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            }
+            for kind, (requests, prompt_tokens, cached_tokens, hits) in totals.items()
+        }
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -0,0 +1,123 @@
+"""
+HTTP responses that replay stored results, shared by app.py and search_with_lepton.py.
+
+Stored results are zlib streams, which is what HTTP calls the "deflate"
+content coding. A client that accepts it gets the stored bytes as they are, in
+bounded chunks, without any decompression or recompression on our side; other
+clients, and the framed stream formats, get the text decompressed chunk by
+chunk. Every replay carries an ETag derived from the stored bytes, so a reload
+or a revisit of a shared link that sends If-None-Match gets a bodiless 304.
+
+Photon's POST handlers don't see the request, so `RequestHeadersMiddleware`
+makes its headers available to them through `request_headers()`.
+"""
+import codecs
+import contextvars
+import hashlib
+import zlib
+from typing import Iterable, Iterator, Mapping
+
+from starlette.concurrency import iterate_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import StreamingResponse
+
+from stream_encoder import MEDIA_TYPES, encode_stream
+
+REPLAY_CHUNK_SIZE = 16 * 1024
+
+_request_headers: contextvars.ContextVar[Mapping[str, str]] = contextvars.ContextVar(
+    "request_headers", default=Headers()
+)
+
+
+def content_digest(compressed: bytes) -> str:
+    """Identifies a stored result by its bytes; the ETag of its replays."""
+    return hashlib.blake2b(compressed, digest_size=12).hexdigest()
+
+
+def iter_chunks(data: bytes, size: int = REPLAY_CHUNK_SIZE) -> Iterator[bytes]:
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def inflate(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decompresses a zlib stream into text, chunk by chunk."""
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        text = decoder.decode(decompressor.decompress(chunk))
+        if text:
+            yield text
+    text = decoder.decode(decompressor.flush(), final=True)
+    if text:
+        yield text
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match compares weakly: W/ prefixes are ignored.
+    strip_weak = lambda tag: tag.strip().removeprefix("W/")
+    return strip_weak(etag) in (strip_weak(tag) for tag in if_none_match.split(","))
+
+
+def accepts_deflate(accept_encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() in ("deflate", "*"):
+            params = params.replace(" ", "")
+            if not params.startswith("q="):
+                return True
+            try:
+                return float(params[2:] or 0) > 0
+            except ValueError:
+                # A malformed q-value doesn't accept the coding.
+                return False
+    return False
+
+
+def replay_response(digest: str, compressed_chunks: Iterable[bytes], headers: Mapping[str, str],
+                    stream_format: str = "text") -> StreamingResponse:
+    """
+    Responds with a stored result, given the digest and the zlib chunks of it
+    and the request's headers.
+    """
+    # Weak, since the same result goes out in several encodings and framings.
+    response_headers = {"ETag": f'W/"{digest}"', "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+    if _etag_matches(headers.get("if-none-match", ""), response_headers["ETag"]):
+        close = getattr(compressed_chunks, "close", None)
+        if close is not None:
+            close()
+        # A StreamingResponse still: Photon wraps any other response class of the handler.
+        return StreamingResponse(iter(()), status_code=304, headers=response_headers)
+    media_type = MEDIA_TYPES[stream_format]
+    if stream_format == "text" and accepts_deflate(headers.get("accept-encoding", "")):
+        return StreamingResponse(
+            compressed_chunks, media_type=media_type, headers={**response_headers, "Content-Encoding": "deflate"}
+        )
+    return StreamingResponse(
+        encode_stream(iterate_in_threadpool(inflate(compressed_chunks)), stream_format),
+        media_type=media_type,
+        headers=response_headers,
+    )
+
+
+def request_headers() -> Mapping[str, str]:
+    """The headers of the request being handled, as set by `RequestHeadersMiddleware`."""
+    return _request_headers.get()
+
+
+class RequestHeadersMiddleware:
+    """An ASGI middleware that makes the request headers available to the handlers."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _request_headers.set(Headers(scope=scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_headers.reset(token)
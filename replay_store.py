@@ -0,0 +1,171 @@
+"""
+Local persistent store for replaying finished search results by search_uuid.
+
+This is the local counterpart of the Lepton KV used by RAG in
+search_with_lepton.py: every finished stream is stored zlib-compressed in a
+SQLite database, and shared links or page reloads are served from disk instead
+of running the search and the LLM again. Replays are streamed in chunks, so a
+large result never has to be held in memory as one blob, and are sent still
+compressed to clients that accept it (see replay_response.py). The database is
+capped in size and evicts the least recently replayed results. All worker
+processes of app.py share one store.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterator, Optional, Tuple
+
+from replay_response import content_digest, inflate
+from shared_cache import connect
+
+DEFAULT_CHUNK_SIZE = 16 * 1024
+
+
+class ReplayStore:
+    """A size-capped SQLite store of compressed stream results, keyed by search_uuid."""
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        # Worker processes share the store, so writes wait for each other.
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS replays ("
+            " search_uuid TEXT PRIMARY KEY,"
+            " data BLOB NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(replays)")]
+        if "digest" not in columns:
+            # Stores from before conditional replays; their digests are filled in when replayed.
+            self._conn.execute("ALTER TABLE replays ADD COLUMN digest TEXT")
+        if "size" in columns:
+            # Older stores kept the uncompressed length, which nothing reads; the cap counts LENGTH(data).
+            self._conn.execute("ALTER TABLE replays DROP COLUMN size")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS replays_accessed_at ON replays (accessed_at)")
+        # The size of the store, kept in the database so that all processes evict by it.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS replay_usage (id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO replay_usage (id, total_bytes)"
+            " SELECT 0, COALESCE(SUM(LENGTH(data)), 0) FROM replays"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, search_uuid: str, result: str) -> None:
+        data = zlib.compress(result.encode("utf-8"))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self._conn.execute("SELECT LENGTH(data) FROM replays WHERE search_uuid = ?", (search_uuid,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO replays (search_uuid, data, accessed_at, digest) VALUES (?, ?, ?, ?)",
+                    (search_uuid, data, time.time(), content_digest(data)),
+                )
+                self._add_bytes(len(data) - (old[0] if old else 0))
+                self._evict()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _total_bytes(self) -> int:
+        return self._conn.execute("SELECT total_bytes FROM replay_usage").fetchone()[0]
+
+    def _add_bytes(self, delta: int) -> None:
+        self._conn.execute("UPDATE replay_usage SET total_bytes = total_bytes + ?", (delta,))
+
+    def _evict(self) -> None:
+        while self._total_bytes() > self.max_bytes:
+            row = self._conn.execute(
+                "SELECT search_uuid, LENGTH(data) FROM replays ORDER BY accessed_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._conn.execute("UPDATE replay_usage SET total_bytes = 0")
+                return
+            self._conn.execute("DELETE FROM replays WHERE search_uuid = ?", (row[0],))
+            self._add_bytes(-row[1])
+            self.evictions += 1
+
+    def open_compressed(self, search_uuid: str) -> Optional[Tuple[str, Iterator[bytes]]]:
+        """
+        Looks up a stored result and returns its digest and an iterator over its
+        zlib-compressed bytes in chunks, or None if there is no result for `search_uuid`.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rowid, digest FROM replays WHERE search_uuid = ?", (search_uuid,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            rowid, digest = row
+            if digest is None:
+                data = self._conn.execute("SELECT data FROM replays WHERE rowid = ?", (rowid,)).fetchone()[0]
+                digest = content_digest(data)
+                self._conn.execute("UPDATE replays SET digest = ? WHERE rowid = ?", (digest, rowid))
+            self._conn.execute("UPDATE replays SET accessed_at = ? WHERE rowid = ?", (time.time(), rowid))
+            self.hits += 1
+        return digest, self._chunks(rowid)
+
+    def open_stream(self, search_uuid: str) -> Optional[Iterator[str]]:
+        """
+        Looks up a stored result and returns an iterator over its decompressed
+        text in chunks, or None if there is no result for `search_uuid`.
+        """
+        stored = self.open_compressed(search_uuid)
+        return None if stored is None else inflate(stored[1])
+
+    def _chunks(self, rowid: int) -> Iterator[bytes]:
+        offset = 0
+        while True:
+            with self._lock:
+                try:
+                    with self._conn.blobopen("replays", "data", rowid, readonly=True) as blob:
+                        blob.seek(offset)
+                        compressed = blob.read(self.chunk_size)
+                except sqlite3.OperationalError:
+                    # Evicted or replaced while we were streaming it; end the replay here.
+                    return
+            offset += len(compressed)
+            if compressed:
+                yield compressed
+            if len(compressed) < self.chunk_size:
+                return
+
+    def get(self, search_uuid: str) -> Optional[str]:
+        stream = self.open_stream(search_uuid)
+        return None if stream is None else "".join(stream)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM replays").fetchone()[0]
+            return {
+                "entries": entries,
+                "bytes": self._total_bytes(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def replay_store_from_env() -> Optional[ReplayStore]:
+    """
+    Builds the replay store configured by REPLAY_STORE_PATH (empty disables
+    replays) and REPLAY_STORE_MAX_MB.
+    """
+    path = os.environ.get("REPLAY_STORE_PATH", "replays.db")
+    if not path:
+        return None
+    return ReplayStore(path, max_bytes=int(float(os.environ.get("REPLAY_STORE_MAX_MB", "256")) * 1024 * 1024))
@@ -0,0 +1,151 @@
+"""
+Lexical reranking of an over-fetched candidate pool.
+
+Providers rank for clicks, not for answering a question from snippets, and the
+contexts used to be cut to REFERENCE_COUNT in provider order. With
+RERANK_CANDIDATES set, the search functions ask for that many candidates and
+`LexicalReranker` keeps the REFERENCE_COUNT best of them.
+
+A candidate's score blends three signals:
+
+- BM25 of its title and snippet against the query, normalized to [0, 1] over
+  the pool. The BM25 arithmetic is vectorized with NumPy; the term counts take
+  one bytes.count per candidate and query term. Reranking 50 candidates takes
+  about half a millisecond, three quarters at p99 (see
+  benchmarks/bench_reranker.py).
+- The provider's rank, as a 1 / log2(rank + 2) prior weighted by
+  RERANK_RANK_WEIGHT, so that lexical overlap refines the provider's order
+  rather than replacing it.
+- Optional per-domain multipliers from RERANK_DOMAIN_PRIORS, e.g.
+  "wikipedia.org=1.2,pinterest.com=0.5". A domain matches its subdomains.
+"""
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "0"))
+RERANK_RANK_WEIGHT = float(os.environ.get("RERANK_RANK_WEIGHT", "0.3"))
+RERANK_DOMAIN_PRIORS = os.environ.get("RERANK_DOMAIN_PRIORS", "")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_HOST_RE = re.compile(r"^[a-z][a-z0-9+.-]*://(?:[^@/?#]*@)?([^:/?#]+)", re.IGNORECASE)
+
+# Maps ASCII bytes that are not word characters to spaces; UTF-8 sequences of
+# non-ASCII letters are left alone. NUL separates candidates.
+_NON_WORD = bytes(
+    c if c == 0 or c >= 0x80 or chr(c).isalnum() or c == ord("_") else ord(" ") for c in range(256)
+)
+
+
+def parse_domain_priors(spec: str) -> Dict[str, float]:
+    """Parses "domain=weight,domain=weight" into a dict."""
+    priors = {}
+    for item in spec.split(","):
+        domain, sep, weight = item.partition("=")
+        if sep and domain.strip():
+            priors[domain.strip().lower().lstrip(".")] = float(weight)
+    return priors
+
+
+def candidate_count(reference_count: int) -> int:
+    """How many results the search functions should ask the provider for."""
+    return max(reference_count, RERANK_CANDIDATES)
+
+
+def _text(context: dict) -> str:
+    # Contexts are name/url/snippet, except raw Google items (title/link/snippet).
+    return f"{context.get('name') or context.get('title') or ''} {context.get('snippet') or ''}"
+
+
+def _host(context: dict) -> str:
+    match = _HOST_RE.match(context.get("url") or context.get("link") or "")
+    return match.group(1).lower() if match else ""
+
+
+def term_frequencies(terms: List[str], texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A (len(texts), len(terms)) matrix of how often each term occurs as a whole
+    word in each text, and the length of each text in bytes.
+
+    Tokenizing every candidate with a regex costs more than the scoring itself,
+    so all texts are normalized in one pass over a single bytes blob, where
+    every word is surrounded by two spaces, and whole-word occurrences are
+    counted with bytes.count, once per text and term. Counting in one pass
+    over the blob instead, with a regex or by mapping every word to a term
+    index and summing with np.add.at, measured slower for 50 candidates.
+    """
+    blob = b"  " + " \x00 ".join(texts).lower().encode().translate(_NON_WORD).replace(b" ", b"  ") + b"  "
+    docs = blob.split(b"\x00")
+    needles = [f" {term} ".encode() for term in terms]
+    tf = np.array([[doc.count(needle) for needle in needles] for doc in docs], dtype=np.float64)
+    lengths = np.fromiter((len(doc) for doc in docs), dtype=np.float64, count=len(docs))
+    return tf.reshape(len(docs), len(terms)), lengths
+
+
+class LexicalReranker:
+    """Keeps the `limit` best of a candidate pool; see the module docstring for the score."""
+
+    def __init__(
+        self,
+        limit: int,
+        rank_weight: float = 0.3,
+        domain_priors: Optional[Dict[str, float]] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.limit = limit
+        self.rank_weight = rank_weight
+        self.domain_priors = domain_priors or {}
+        self.k1 = k1
+        self.b = b
+
+    def _domain_weights(self, contexts: List[dict]) -> np.ndarray:
+        weights = np.ones(len(contexts))
+        for i, context in enumerate(contexts):
+            host = _host(context)
+            while host:
+                if host in self.domain_priors:
+                    weights[i] = self.domain_priors[host]
+                    break
+                host = host.partition(".")[2]
+        return weights
+
+    def scores(self, query: str, contexts: List[dict]) -> np.ndarray:
+        """The blended score of every candidate, in candidate order."""
+        n = len(contexts)
+        terms = list(dict.fromkeys(_WORD_RE.findall(query.lower())))
+
+        lexical = np.zeros(n)
+        if terms:
+            tf, lengths = term_frequencies(terms, [_text(context) for context in contexts])
+            df = np.count_nonzero(tf, axis=0)
+            idf = np.log1p((n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths / (lengths.mean() or 1.0))
+            bm25 = (idf * tf * (self.k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+            top = bm25.max()
+            if top > 0:
+                lexical = bm25 / top
+
+        rank_prior = 1 / np.log2(np.arange(n) + 2)
+        score = (1 - self.rank_weight) * lexical + self.rank_weight * rank_prior
+        if self.domain_priors:
+            score *= self._domain_weights(contexts)
+        return score
+
+    def rerank(self, query: str, contexts: List[dict]) -> List[dict]:
+        """The `limit` best candidates, best first. Ties keep provider order."""
+        if len(contexts) <= 1:
+            return contexts[:self.limit]
+        order = np.argsort(-self.scores(query, contexts), kind="stable")[:self.limit]
+        return [contexts[i] for i in order]
+
+
+def reranker_from_env(limit: int) -> Optional[LexicalReranker]:
+    """The reranker configured by RERANK_*, or None if RERANK_CANDIDATES does not exceed `limit`."""
+    if RERANK_CANDIDATES <= limit:
+        return None
+    return LexicalReranker(
+        limit, rank_weight=RERANK_RANK_WEIGHT, domain_priors=parse_domain_priors(RERANK_DOMAIN_PRIORS)
+    )
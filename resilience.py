@@ -0,0 +1,395 @@
+"""
+End-to-end deadlines, budgeted retries and circuit breakers for upstream calls.
+
+Timeouts used to be set per call (5 s for most search backends, 30 s for
+SearchApi, 120 s reads for the LLM, none for related questions), so a request
+could spend far longer than any client waits, and a degraded provider tied up
+workers for its full timeout on every request.
+
+- A `Deadline` is set once per request and read through a context variable by
+  everything the request calls: `timeout_for(cap)` gives a call the smaller of
+  its own timeout and the time the request has left. asyncio tasks inherit it;
+  thread pools need `contextvars.copy_context().run`.
+- `Upstream` wraps the calls to one search backend or LLM endpoint. Failed calls
+  that are worth retrying (timeouts, connection errors, 429 and 5xx) are retried
+  with full-jitter exponential backoff, but only while the request's deadline
+  leaves room and while the upstream's `RetryBudget` allows it, so that retries
+  add at most RETRY_BUDGET_RATIO extra load to an upstream that is struggling.
+- Each `Upstream` has a `CircuitBreaker`. After BREAKER_FAILURE_THRESHOLD
+  consecutive failures it opens, and calls fail immediately with `CircuitOpen`
+  for BREAKER_RESET_TIMEOUT seconds; then one probe call decides whether it
+  closes again. Callers fail fast or fall back while it is open.
+"""
+import asyncio
+import contextvars
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar, Union
+
+import httpx
+import openai
+
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "60"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.1"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "2.0"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "10"))
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """The request has no time left for another upstream call."""
+    status_code = 504
+    headers = None
+
+
+class Deadline:
+    """A point in time by which a request must be done."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """The time left, at most `cap`. Raises DeadlineExceeded if there is none."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("request deadline exceeded")
+        return remaining if cap is None else min(cap, remaining)
+
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def set_deadline(deadline: Optional[Deadline]) -> contextvars.Token:
+    """Sets the deadline of the current context (and of the tasks it starts from now on)."""
+    return _deadline.set(deadline)
+
+
+@contextmanager
+def deadline_scope(deadline: Union[Deadline, float]):
+    """Runs the body under `deadline` (or one that many seconds from now), or the current one if sooner."""
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+    current = _deadline.get()
+    if current is not None and current.expires_at < deadline.expires_at:
+        deadline = current
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def timeout_for(cap: Optional[float] = None) -> Optional[float]:
+    """
+    The timeout for an upstream call: the smaller of `cap` and the time the
+    current request has left. Raises DeadlineExceeded if it has none.
+    """
+    deadline = _deadline.get()
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Timeouts, connection errors, 429 and 5xx are worth another try; other errors are not."""
+    if isinstance(exc, (DeadlineExceeded, CircuitOpen)):
+        return False
+    if isinstance(exc, (TimeoutError, ConnectionError, httpx.TransportError, openai.APIConnectionError)):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+class RetryBudget:
+    """
+    Allows retries as a fraction of calls: every call deposits `ratio` tokens,
+    every retry withdraws one. Up to `max_tokens` are banked, starting full, so
+    that an upstream with little traffic can retry at all.
+    """
+
+    def __init__(self, ratio: float = 0.1, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.retries += 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+    status_code = 503
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is unavailable")
+        self.name = name
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; see the module docstring."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+
+    def _open_error(self) -> CircuitOpen:
+        self.rejected += 1
+        since = self.opened_at if self.state == self.OPEN else self.probe_at
+        retry_after = since + self.reset_timeout - time.monotonic()
+        return CircuitOpen(self.name, max(1, math.ceil(retry_after)))
+
+    def check(self) -> None:
+        """Raises CircuitOpen while the breaker is open, without taking the probe."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout:
+                raise self._open_error()
+
+    def allow(self) -> None:
+        """Raises CircuitOpen unless a call may go out now. Every allowed call must be recorded."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            waited = now - (self.opened_at if self.state == self.OPEN else self.probe_at)
+            if waited >= self.reset_timeout:
+                # Let one probe through; everyone else keeps failing fast until it
+                # is back. A probe that never reports (e.g. cancelled) is replaced.
+                self.state = self.HALF_OPEN
+                self.probe_at = now
+                return
+            raise self._open_error()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class Upstream:
+    """A search backend or LLM endpoint, called with retries behind a circuit breaker."""
+
+    def __init__(
+        self,
+        name: str,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        retry_ratio: float = RETRY_BUDGET_RATIO,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = RetryBudget(retry_ratio)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.calls = 0
+        self.failures = 0
+
+    def _record(self, exc: Optional[BaseException]) -> bool:
+        """Records the outcome of an attempt and returns whether the error is retryable."""
+        retryable = exc is not None and is_retryable(exc)
+        if exc is None or not (retryable or isinstance(exc, DeadlineExceeded)):
+            # The upstream answered, even if only to reject this request.
+            self.breaker.record_success()
+            return False
+        # Too slow to answer within the deadline counts against the upstream too.
+        self.failures += 1
+        self.breaker.record_failure()
+        return retryable
+
+    def _retry_delay(self, attempt: int) -> Optional[float]:
+        """The backoff before another attempt, or None if there is no room for one."""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+        deadline = _deadline.get()
+        if deadline is not None and deadline.remaining() <= delay:
+            return None
+        if not self.budget.withdraw():
+            return None
+        return delay
+
+    def _start(self, attempt: int) -> None:
+        if attempt == 0:
+            self.calls += 1
+            self.budget.deposit()
+        deadline = _deadline.get()
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded("request deadline exceeded")
+        self.breaker.allow()
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Awaits `fn()`, retrying failures as described in the module docstring."""
+        attempt = 0
+        while True:
+            self._start(attempt)
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._retry_delay(attempt) if self._record(e) else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    def call_sync(self, fn: Callable[[], T]) -> T:
+        """Like `call`, for blocking code."""
+        attempt = 0
+        while True:
+            self._start(attempt)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._retry_delay(attempt) if self._record(e) else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record(None)
+            return result
+
+    async def stream(self, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """
+        Iterates the stream made by `factory()`. A stream that fails before its
+        first item is started again like a failed `call`; once items went out it
+        is not. Waiting for an item is bounded by the request's deadline.
+        """
+        attempt = 0
+        while True:
+            self._start(attempt)
+            started = False
+            iterator = None
+            try:
+                iterator = factory().__aiter__()
+                while True:
+                    timeout = timeout_for()
+                    try:
+                        # Unlike wait_for, timeout() runs the step in this task, so the
+                        # stream's context (e.g. its tracing spans) stays the same throughout.
+                        async with asyncio.timeout(timeout):
+                            item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise DeadlineExceeded("request deadline exceeded") from None
+                    started = True
+                    yield item
+            except Exception as e:
+                retryable = self._record(e)
+                delay = self._retry_delay(attempt) if retryable and not started else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                if iterator is not None and hasattr(iterator, "aclose"):
+                    await iterator.aclose()
+            self._record(None)
+            return
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.budget.retries,
+            "retry_budget_exhausted": self.budget.exhausted,
+            "breaker": self.breaker.stats(),
+        }
+
+
+class Upstreams:
+    """Process-wide registry of upstreams by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._upstreams = {}
+
+    def get(self, name: str) -> Upstream:
+        with self._lock:
+            upstream = self._upstreams.get(name)
+            if upstream is None:
+                upstream = self._upstreams[name] = Upstream(name)
+            return upstream
+
+    def stats(self) -> dict:
+        with self._lock:
+            upstreams = list(self._upstreams.values())
+        return {upstream.name: upstream.stats() for upstream in upstreams}
+
+
+upstreams = Upstreams()
@@ -0,0 +1,267 @@
+"""
+Search-result cache shared by app.py and search_with_lepton.py.
+
+Popular queries are asked again and again within minutes of each other, so the
+contexts returned by the search provider are cached in front of the search
+function. Keys are normalized the same way both handlers sanitize queries, and
+entries expire after a TTL or are evicted least-recently-used once the cache is
+full. With SHARED_CACHE_PATH set, the entries live in a SQLite database shared
+by all worker processes (see shared_cache.py).
+"""
+import json
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from metrics import cache_hits, cache_misses
+from shared_cache import SHARED_CACHE_PATH, connect
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes a query into a cache key: no [INST] tags, lower case, single spaces."""
+    query = re.sub(r"\[/?INST\]", "", query or "")
+    return " ".join(query.lower().split())
+
+
+class SearchCache(ABC):
+    """
+    Interface for search-result caches. `get` returns the cached contexts or None,
+    and `put` stores the contexts for a query.
+    """
+
+    @abstractmethod
+    def get(self, query: str) -> Optional[List[dict]]:
+        ...
+
+    @abstractmethod
+    def put(self, query: str, contexts: List[dict]) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+    def save(self) -> None:
+        pass
+
+    def cached(self, search_function: Callable[[str], List[dict]]) -> Callable[[str], List[dict]]:
+        """Wraps a sync `search_function(query)` so that it consults the cache first."""
+
+        def cached_search_function(query: str) -> List[dict]:
+            contexts = self.get(query)
+            if contexts is None:
+                contexts = search_function(query)
+                self.put(query, contexts)
+            return contexts
+
+        return cached_search_function
+
+
+class NullSearchCache(SearchCache):
+    """A cache that never hits, used when caching is disabled."""
+
+    def get(self, query):
+        return None
+
+    def put(self, query, contexts):
+        pass
+
+
+class LRUSearchCache(SearchCache):
+    """
+    An in-process TTL + LRU cache. If `path` is given, the cache is loaded from
+    that file on construction and written back by `save()`, so that restarts
+    start warm.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: Optional[str] = None, namespace: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.namespace = namespace
+        self._entries = OrderedDict()  # key -> (expires_at, contexts)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self.load()
+
+    def _key(self, query: str) -> str:
+        return f"{self.namespace}:{normalize_query(query)}"
+
+    def get(self, query: str) -> Optional[List[dict]]:
+        key = self._key(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                cache_misses.inc("search")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        cache_hits.inc("search")
+        # Hand out copies, so callers can't mutate the cached contexts.
+        return [dict(c) for c in entry[1]]
+
+    def put(self, query: str, contexts: List[dict]) -> None:
+        # Empty results are usually a provider hiccup, don't pin them for a whole TTL.
+        if not contexts:
+            return
+        key = self._key(query)
+        entry = (time.time() + self.ttl, [dict(c) for c in contexts])
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            # A corrupt cache file must not keep the service from starting.
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires_at, contexts in stored:
+                if expires_at > now:
+                    self._entries[key] = (expires_at, contexts)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """Atomically writes the live entries to `path`, oldest first."""
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            stored = [[key, expires_at, contexts] for key, (expires_at, contexts) in self._entries.items() if expires_at > now]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, self.path)
+
+
+class SqliteSearchCache(SearchCache):
+    """
+    A TTL + LRU cache kept in a SQLite database, so that several processes
+    share it. Recency is tracked per entry, so eviction stays least-recently-used
+    across all of them.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024, ttl: float = 3600, namespace: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY,"
+            " contexts TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS search_cache_accessed_at ON search_cache (accessed_at)")
+        # Counted by this process only.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, query: str) -> str:
+        return f"{self.namespace}:{normalize_query(query)}"
+
+    def get(self, query: str) -> Optional[List[dict]]:
+        key = self._key(query)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT contexts FROM search_cache WHERE key = ? AND expires_at >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self._conn.execute("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self.hits += 1
+        if row is None:
+            cache_misses.inc("search")
+            return None
+        cache_hits.inc("search")
+        return json.loads(row[0])
+
+    def put(self, query: str, contexts: List[dict]) -> None:
+        # Empty results are usually a provider hiccup, don't pin them for a whole TTL.
+        if not contexts:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, contexts, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (self._key(query), json.dumps(contexts), now + self.ttl, now),
+            )
+            # Expired entries go first, then the least recently used ones.
+            evicted = self._conn.execute(
+                "DELETE FROM search_cache WHERE expires_at < ? OR key IN ("
+                " SELECT key FROM search_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (now, self.max_entries),
+            ).rowcount
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "shared": True,
+            }
+
+
+def search_cache_from_env(namespace: str = "") -> SearchCache:
+    """
+    Builds the search cache configured by SEARCH_CACHE_SIZE (0 disables the cache),
+    SEARCH_CACHE_TTL (seconds) and SEARCH_CACHE_PATH (optional persistence file),
+    shared between processes through SHARED_CACHE_PATH if that is set.
+    """
+    max_entries = int(os.environ.get("SEARCH_CACHE_SIZE", "1024"))
+    if max_entries <= 0:
+        return NullSearchCache()
+    if SHARED_CACHE_PATH:
+        # Shared entries outlive any one process, so SEARCH_CACHE_PATH isn't needed.
+        return SqliteSearchCache(
+            SHARED_CACHE_PATH,
+            max_entries=max_entries,
+            ttl=float(os.environ.get("SEARCH_CACHE_TTL", "3600")),
+            namespace=namespace,
+        )
+    return LRUSearchCache(
+        max_entries=max_entries,
+        ttl=float(os.environ.get("SEARCH_CACHE_TTL", "3600")),
+        path=os.environ.get("SEARCH_CACHE_PATH") or None,
+        namespace=namespace,
+    )
@@ -1,9 +1,10 @@
+import atexit
 import concurrent.futures
+import contextvars
 import glob
 import json
 import os
 import re
-import threading
 import requests
 import traceback
 from typing import Annotated, List, Generator, Optional
@@ -21,6 +22,30 @@ from leptonai.photon.types import to_bool
 from leptonai.api.v0.workspace import WorkspaceInfoLocalRecord
 from leptonai.util import tool
 
+from abandonment import abandonment_stats
+from admission import Overloaded, admission_from_env
+from context_packer import RELATED_CONTEXT_TOKEN_BUDGET, format_contexts, pack_contexts
+from hedged_search import HedgedSearch
+from kv_writer import KV_MAX_RESULT_KB, ResultBuffer, compressed_value, kv_writer_from_env
+from llm_clients import get_openai_client
+from local_index import LOCAL_INDEX_PATH, LocalIndex
+from metrics import (
+    AnswerTimer, cache_hits, cache_misses, empty_contexts, errors, register_prometheus_collector,
+    related_questions_latency, search_latency,
+)
+from page_fetcher import page_fetcher_from_env
+from prompt_layout import prompt_cache_stats, split_prompt
+from replay_response import (
+    RequestHeadersMiddleware, content_digest, iter_chunks, replay_response, request_headers
+)
+from reranker import candidate_count, reranker_from_env
+from resilience import (
+    REQUEST_DEADLINE, CircuitOpen, Deadline, DeadlineExceeded, deadline_scope, timeout_for, upstreams
+)
+from search_cache import search_cache_from_env
+from stream_encoder import FRAMINGS, MEDIA_TYPES, encode_stream, iterate_closing
+from tracing import mark, span, tracer_from_env
+
 ################################################################################
 # Constant values for the RAG model.
 ################################################################################
@@ -35,14 +60,23 @@ SEARCHAPI_SEARCH_ENDPOINT = "https://www.searchapi.io/api/v1/search"
 # Specify the number of references from the search engine you want to use.
 # 8 is usually a good number.
 REFERENCE_COUNT = 8
+# With RERANK_CANDIDATES set, the search functions over-fetch candidates and the
+# reranker keeps the REFERENCE_COUNT best of them.
+SEARCH_CANDIDATE_COUNT = candidate_count(REFERENCE_COUNT)
 
 # Specify the default timeout for the search engine. If the search engine
 # does not respond within this time, we will return an error.
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
 
+# SearchApi.io is noticeably slower than the other backends, so it gets a longer
+# timeout. Use the FANOUT backend to hedge against its tail latency.
+SEARCHAPI_SEARCH_ENGINE_TIMEOUT = 30
+
 
 # If the user did not provide a query, we will use this default query.
 _default_query = "Who said 'live long and prosper'?"
+# Streamed in place of the answer when the LLM call fails, as by app.py.
+_llm_error_prefix = "Error generating response: "
 
 # This is really the most important part of the rag model. It gives instructions
 # to the model on how to generate the answer. Of course, different models may
@@ -93,24 +127,30 @@ Here are the contexts of the question:
 Remember, based on the original question and related contexts, suggest three such further questions. Do NOT repeat the original question. Each related question should be no longer than 20 words. Here is the original question:
 """
 
+# The static instructions form the system prompt, identical across requests so
+# that the provider can serve it from its prompt cache. Contexts and the query
+# go in the user message.
+_rag_layout = split_prompt(_rag_query_text)
+_more_questions_layout = split_prompt(_more_questions_prompt)
+
 
 def search_with_bing(query: str, subscription_key: str):
     """
     Search with bing and return the contexts.
     """
-    params = {"q": query, "mkt": BING_MKT}
+    params = {"q": query, "mkt": BING_MKT, "count": SEARCH_CANDIDATE_COUNT}
     response = requests.get(
         BING_SEARCH_V7_ENDPOINT,
         headers={"Ocp-Apim-Subscription-Key": subscription_key},
         params=params,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+        timeout=timeout_for(DEFAULT_SEARCH_ENGINE_TIMEOUT),
     )
     if not response.ok:
         logger.error(f"{response.status_code} {response.text}")
         raise HTTPException(response.status_code, "Search engine error.")
     json_content = response.json()
     try:
-        contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
+        contexts = json_content["webPages"]["value"][:SEARCH_CANDIDATE_COUNT]
     except KeyError:
         logger.error(f"Error encountered: {json_content}")
         return []
@@ -125,17 +165,18 @@ def search_with_google(query: str, subscription_key: str, cx: str):
         "key": subscription_key,
         "cx": cx,
         "q": query,
-        "num": REFERENCE_COUNT,
+        # The custom search API returns at most 10 results per call.
+        "num": min(SEARCH_CANDIDATE_COUNT, 10),
     }
     response = requests.get(
-        GOOGLE_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
+        GOOGLE_SEARCH_ENDPOINT, params=params, timeout=timeout_for(DEFAULT_SEARCH_ENGINE_TIMEOUT)
     )
     if not response.ok:
         logger.error(f"{response.status_code} {response.text}")
         raise HTTPException(response.status_code, "Search engine error.")
     json_content = response.json()
     try:
-        contexts = json_content["items"][:REFERENCE_COUNT]
+        contexts = json_content["items"][:SEARCH_CANDIDATE_COUNT]
     except KeyError:
         logger.error(f"Error encountered: {json_content}")
         return []
@@ -149,20 +190,19 @@ def search_with_serper(query: str, subscription_key: str):
     payload = json.dumps({
         "q": query,
         "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
+            SEARCH_CANDIDATE_COUNT
+            if SEARCH_CANDIDATE_COUNT % 10 == 0
+            else (SEARCH_CANDIDATE_COUNT // 10 + 1) * 10
         ),
     })
     headers = {"X-API-KEY": subscription_key, "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SERPER_SEARCH_ENDPOINT}"
-    )
+    # Never log the headers: they carry the API key.
+    logger.info(f"{payload} {SERPER_SEARCH_ENDPOINT}")
     response = requests.post(
         SERPER_SEARCH_ENDPOINT,
         headers=headers,
         data=payload,
-        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+        timeout=timeout_for(DEFAULT_SEARCH_ENGINE_TIMEOUT),
     )
     if not response.ok:
         logger.error(f"{response.status_code} {response.text}")
@@ -193,7 +233,7 @@ def search_with_serper(query: str, subscription_key: str):
             {"name": c["title"], "url": c["link"], "snippet": c.get("snippet","")}
             for c in json_content["organic"]
         ]
-        return contexts[:REFERENCE_COUNT]
+        return contexts[:SEARCH_CANDIDATE_COUNT]
     except KeyError:
         logger.error(f"Error encountered: {json_content}")
         return []
@@ -206,20 +246,19 @@ def search_with_searchapi(query: str, subscription_key: str):
         "q": query,
         "engine": "google",
         "num": (
-            REFERENCE_COUNT
-            if REFERENCE_COUNT % 10 == 0
-            else (REFERENCE_COUNT // 10 + 1) * 10
+            SEARCH_CANDIDATE_COUNT
+            if SEARCH_CANDIDATE_COUNT % 10 == 0
+            else (SEARCH_CANDIDATE_COUNT // 10 + 1) * 10
         ),
     }
     headers = {"Authorization": f"Bearer {subscription_key}", "Content-Type": "application/json"}
-    logger.info(
-        f"{payload} {headers} {subscription_key} {query} {SEARCHAPI_SEARCH_ENDPOINT}"
-    )
+    # Never log the headers: they carry the API key.
+    logger.info(f"{payload} {SEARCHAPI_SEARCH_ENDPOINT}")
     response = requests.get(
         SEARCHAPI_SEARCH_ENDPOINT,
         headers=headers,
         params=payload,
-        timeout=30,
+        timeout=timeout_for(SEARCHAPI_SEARCH_ENGINE_TIMEOUT),
     )
     if not response.ok:
         logger.error(f"{response.status_code} {response.text}")
@@ -283,7 +322,7 @@ def search_with_searchapi(query: str, subscription_key: str):
                         "snippet": snippet
                     })
 
-        return contexts[:REFERENCE_COUNT]
+        return contexts[:SEARCH_CANDIDATE_COUNT]
     except KeyError:
         logger.error(f"Error encountered: {json_content}")
         return []
@@ -302,7 +341,25 @@ class RAG(Photon):
         "openai",  # for openai client usage.
     ]
 
-    extra_files = glob.glob("ui/**/*", recursive=True)
+    extra_files = glob.glob("ui/**/*", recursive=True) + [
+        "abandonment.py",
+        "admission.py",
+        "context_packer.py",
+        "hedged_search.py",
+        "kv_writer.py",
+        "llm_clients.py",
+        "local_index.py",
+        "metrics.py",
+        "page_fetcher.py",
+        "prompt_layout.py",
+        "replay_response.py",
+        "reranker.py",
+        "resilience.py",
+        "search_cache.py",
+        "shared_cache.py",
+        "stream_encoder.py",
+        "tracing.py",
+    ]
 
     deployment_template = {
         # All actual computations are carried out via remote apis, so
@@ -311,7 +368,9 @@ class RAG(Photon):
         "resource_shape": "cpu.small",
         # You most likely don't need to change this.
         "env": {
-            # Choose the backend. Currently, we support BING and GOOGLE. For
+            # Choose the backend. Currently, we support BING, GOOGLE, SERPER,
+            # SEARCHAPI, and FANOUT, which hedges across the backends listed in
+            # SEARCH_BACKENDS (e.g. "SERPER,BING"). For
             # simplicity, in this demo, if you specify the backend as LEPTON,
             # we will use the hosted serverless version of lepton search api
             # at https://search-api.lepton.run/ to do the search and RAG, which
@@ -350,30 +409,72 @@ class RAG(Photon):
     }
 
     # It's just a bunch of api calls, so our own deployment can be made massively
-    # concurrent.
-    handler_max_concurrency = 16
+    # concurrent. The calls to the upstreams are bounded by the ADMISSION_* limits.
+    handler_max_concurrency = int(os.environ.get("HANDLER_MAX_CONCURRENCY", "16"))
 
     def local_client(self):
         """
-        Gets a thread-local client, so in case openai clients are not thread safe,
-        each thread will have its own client.
+        Gets the process-wide pooled client for the model. OpenAI clients are
+        thread safe, so all threads share one client and its keep-alive
+        connections instead of paying a new handshake per call.
         """
-        import openai
+        return get_openai_client(
+            base_url=f"https://{self.model}.lepton.run/api/v1/",
+            api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
+            or WorkspaceInfoLocalRecord.get_current_workspace_token(),
+            # We will set the connect timeout to be 10 seconds, and read/write
+            # timeout to be 120 seconds, in case the inference server is
+            # overloaded.
+            timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+        )
 
-        thread_local = threading.local()
-        try:
-            return thread_local.client
-        except AttributeError:
-            thread_local.client = openai.OpenAI(
-                base_url=f"https://{self.model}.lepton.run/api/v1/",
-                api_key=os.environ.get("LEPTON_WORKSPACE_TOKEN")
-                or WorkspaceInfoLocalRecord.get_current_workspace_token(),
-                # We will set the connect timeout to be 10 seconds, and read/write
-                # timeout to be 120 seconds, in case the inference server is
-                # overloaded.
-                timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+    def resilient_search_function(self, backend):
+        """
+        Returns `backend_search_function(backend)` with budgeted retries behind a
+        circuit breaker. While the breaker is open the backend fails fast, and
+        with FANOUT the hedged search moves on to the next backend right away.
+        """
+        upstream = upstreams.get(f"search:{backend.lower()}")
+        search_function = self.backend_search_function(backend)
+
+        def search(query):
+            with search_latency.time(backend.lower()):
+                try:
+                    return upstream.call_sync(lambda: search_function(query))
+                except Exception:
+                    errors.inc("search")
+                    raise
+
+        return search
+
+    def backend_search_function(self, backend):
+        """
+        Returns a `search_function(query)` for a single remote search backend.
+        """
+        if backend == "BING":
+            search_api_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
+            return lambda query: search_with_bing(query, search_api_key)
+        elif backend == "GOOGLE":
+            search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
+            return lambda query: search_with_google(
+                query,
+                search_api_key,
+                os.environ["GOOGLE_SEARCH_CX"],
+            )
+        elif backend == "SERPER":
+            search_api_key = os.environ["SERPER_SEARCH_API_KEY"]
+            return lambda query: search_with_serper(query, search_api_key)
+        elif backend == "SEARCHAPI":
+            search_api_key = os.environ["SEARCHAPI_API_KEY"]
+            return lambda query: search_with_searchapi(query, search_api_key)
+        elif backend == "LOCAL":
+            # Our own documents, indexed with `python -m local_index build`.
+            self.local_index = LocalIndex(LOCAL_INDEX_PATH)
+            return lambda query: self.local_index.search(query, SEARCH_CANDIDATE_COUNT)
+        else:
+            raise RuntimeError(
+                "Backend must be LEPTON, BING, GOOGLE, SERPER, SEARCHAPI, LOCAL or FANOUT."
             )
-            return thread_local.client
 
     def init(self):
         """
@@ -381,6 +482,8 @@ class RAG(Photon):
         """
         # First, log in to the workspace.
         leptonai.api.v0.workspace.login()
+        # Serve the per-stage metrics along with Photon's own at /metrics.
+        register_prometheus_collector()
         self.backend = os.environ["BACKEND"].upper()
         if self.backend == "LEPTON":
             self.leptonsearch_client = Client(
@@ -390,35 +493,49 @@ class RAG(Photon):
                 stream=True,
                 timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
             )
-        elif self.backend == "BING":
-            self.search_api_key = os.environ["BING_SEARCH_V7_SUBSCRIPTION_KEY"]
-            self.search_function = lambda query: search_with_bing(
-                query,
-                self.search_api_key,
-            )
-        elif self.backend == "GOOGLE":
-            self.search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_google(
-                query,
-                self.search_api_key,
-                os.environ["GOOGLE_SEARCH_CX"],
-            )
-        elif self.backend == "SERPER":
-            self.search_api_key = os.environ["SERPER_SEARCH_API_KEY"]
-            self.search_function = lambda query: search_with_serper(
-                query,
-                self.search_api_key,
-            )
-        elif self.backend == "SEARCHAPI":
-            self.search_api_key = os.environ["SEARCHAPI_API_KEY"]
-            self.search_function = lambda query: search_with_searchapi(
-                query,
-                self.search_api_key,
+        elif self.backend == "FANOUT":
+            # Hedged fan-out over several backends, in order of preference.
+            backends = [
+                b.strip().upper()
+                for b in os.environ.get("SEARCH_BACKENDS", "SERPER,BING").split(",")
+                if b.strip()
+            ]
+            self.hedged_search = HedgedSearch(
+                {backend: self.resilient_search_function(backend) for backend in backends},
+                limit=SEARCH_CANDIDATE_COUNT,
+                hedge_percentile=float(os.environ.get("HEDGE_PERCENTILE", "0.95")),
+                default_hedge_delay=float(os.environ.get("HEDGE_DELAY", "1.0")),
+                merge=to_bool(os.environ.get("HEDGE_MERGE", "false")),
+                max_workers=self.handler_max_concurrency * len(backends),
             )
+            self.search_function = self.hedged_search.search
         else:
-            raise RuntimeError("Backend must be LEPTON, BING, GOOGLE, SERPER or SEARCHAPI.")
+            self.search_function = self.resilient_search_function(self.backend)
+        if self.backend != "LEPTON":
+            # Keep the REFERENCE_COUNT most relevant of the over-fetched candidates.
+            self.reranker = reranker_from_env(REFERENCE_COUNT)
+            if self.reranker is not None:
+                search_function = self.search_function
+                self.search_function = lambda query: self.reranker.rerank(
+                    query, search_function(query)
+                )
+        if self.backend not in ("LEPTON", "LOCAL"):
+            # Cache search results in front of the search engine, so that repeated
+            # queries don't spend provider quota and the search round trip.
+            self.search_cache = search_cache_from_env(namespace=self.backend)
+            self.search_function = self.search_cache.cached(self.search_function)
+            atexit.register(self.search_cache.save)
+        # Optionally enrich the top results with passages from their pages.
+        self.page_fetcher = page_fetcher_from_env()
+        # Per-upstream concurrency limits; requests that would queue too long are shed.
+        self.admission = admission_from_env()
+        # Stage timelines of recent requests, served at /debug/trace/{search_uuid}.
+        self.tracer = tracer_from_env()
         self.model = os.environ["LLM_MODEL"]
-        # An executor to carry out async tasks, such as uploading to KV.
+        # Retries and the circuit breaker of the LLM endpoint, shared by the answer
+        # and the related questions.
+        self.llm_upstream = upstreams.get(f"llm:{self.model}")
+        # An executor to carry out async tasks, such as the related questions.
         self.executor = concurrent.futures.ThreadPoolExecutor(
             max_workers=self.handler_max_concurrency * 2
         )
@@ -427,6 +544,9 @@ class RAG(Photon):
         self.kv = KV(
             os.environ["KV_NAME"], create_if_not_exists=True, error_if_exists=False
         )
+        # Finished results are written behind, compressed, by a worker of their own.
+        self.kv_writer = kv_writer_from_env(self.kv)
+        atexit.register(self.kv_writer.close)
         # whether we should generate related questions.
         self.should_do_related_questions = to_bool(os.environ["RELATED_QUESTIONS"])
 
@@ -452,88 +572,176 @@ class RAG(Photon):
             pass
 
         try:
-            response = self.local_client().chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": _more_questions_prompt.format(
-                            context="\n\n".join([c["snippet"] for c in contexts])
+            # Related questions are optional: when their limiter sheds the call,
+            # the answer goes out without them.
+            with self.admission.related.slot_sync(), related_questions_latency.time():
+                response = self.llm_upstream.call_sync(
+                    lambda: self.local_client().chat.completions.create(
+                        model=self.model,
+                        messages=_more_questions_layout.messages(
+                            format_contexts(
+                                pack_contexts(contexts, RELATED_CONTEXT_TOKEN_BUDGET),
+                                citations=False,
+                            ),
+                            query,
                         ),
-                    },
-                    {
-                        "role": "user",
-                        "content": query,
-                    },
-                ],
-                tools=[{
-                    "type": "function",
-                    "function": tool.get_tools_spec(ask_related_questions),
-                }],
-                max_tokens=512,
-            )
+                        tools=[{
+                            "type": "function",
+                            "function": tool.get_tools_spec(ask_related_questions),
+                        }],
+                        max_tokens=512,
+                        timeout=timeout_for(),
+                    )
+                )
+            self._record_usage("related", response.usage)
             related = response.choices[0].message.tool_calls[0].function.arguments
             if isinstance(related, str):
                 related = json.loads(related)
             logger.trace(f"Related questions: {related}")
+            mark("related_questions_done")
             return related["questions"][:5]
         except Exception as e:
             # For any exceptions, we will just return an empty list.
+            errors.inc("related")
+            mark("related_questions_failed", error=type(e).__name__)
             logger.error(
                 "encountered error while generating related questions:"
                 f" {e}\n{traceback.format_exc()}"
             )
             return []
 
+    def _record_usage(self, kind, usage):
+        parsed = prompt_cache_stats.record(kind, usage)
+        if parsed is not None:
+            logger.info(
+                f"{kind} prompt tokens: {parsed.prompt_tokens}, cached:"
+                f" {parsed.cached_tokens}, uncached: {parsed.uncached_tokens}"
+            )
+
     def _raw_stream_response(
-        self, contexts, llm_response, related_questions_future
+        self, contexts, llm_response, related_questions_future, permit=None, trace=None
     ) -> Generator[str, None, None]:
         """
         A generator that yields the raw stream response. You do not need to call
         this directly. Instead, use the stream_and_upload_to_kv which will also
-        upload the response to KV.
+        upload the response to KV. The admission `permit` of the answer, if any,
+        is released as soon as the LLM response is done. If the client goes away
+        mid-answer, the LLM stream and the related questions are given up. The
+        answer's stages are marked on `trace`, if given: the generator runs on
+        threadpool threads, which don't see the request's current trace.
         """
+        timer = AnswerTimer()
         # First, yield the contexts.
         yield json.dumps(contexts)
         yield "\n\n__LLM_RESPONSE__\n\n"
         # Second, yield the llm response.
         if not contexts:
+            empty_contexts.inc()
             # Prepend a warning to the user
             yield (
                 "(The search engine returned nothing for this query. Please take the"
                 " answer with a grain of salt.)\n\n"
             )
-        for chunk in llm_response:
-            if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
-        # Third, yield the related questions. If any error happens, we will just
-        # return an empty list.
-        if related_questions_future is not None:
-            related_questions = related_questions_future.result()
+        deltas = 0
+        failed = False
+        try:
             try:
-                result = json.dumps(related_questions)
-            except Exception as e:
-                logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-                result = "[]"
-            yield "\n\n__RELATED_QUESTIONS__\n\n"
-            yield result
+                if callable(llm_response):
+                    # Created only now, after the contexts were sent.
+                    timer.llm_call()
+                    try:
+                        llm_response = llm_response()
+                    except Exception as e:
+                        logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+                        errors.inc("answer")
+                        failed = True
+                        llm_response = []
+                        # Tell the client, as app.py does, rather than leave the answer empty.
+                        yield f"{_llm_error_prefix}{e}"
+                for chunk in llm_response:
+                    if chunk.choices:
+                        if deltas == 0 and trace is not None:
+                            trace.mark("first_token")
+                        timer.token()
+                        deltas += 1
+                        yield chunk.choices[0].delta.content or ""
+                    if getattr(chunk, "usage", None) is not None:
+                        # Sent in a final chunk without choices.
+                        self._record_usage("answer", chunk.usage)
+                if trace is not None:
+                    trace.mark("last_token", deltas=deltas)
+            except Exception:
+                errors.inc("answer")
+                timer.done("failed")
+                raise
+            finally:
+                if permit is not None:
+                    permit.release()
+            # Third, yield the related questions. If any error happens, we will just
+            # return an empty list.
+            if related_questions_future is not None:
+                related_questions = related_questions_future.result()
+                try:
+                    result = json.dumps(related_questions)
+                except Exception as e:
+                    logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+                    result = "[]"
+                if trace is not None:
+                    trace.mark("related_questions_sent")
+                yield "\n\n__RELATED_QUESTIONS__\n\n"
+                yield result
+            timer.done("failed" if failed else "completed")
+            abandonment_stats.record_completed(deltas)
+        except GeneratorExit:
+            timer.done("abandoned")
+            # The client went away. Close the LLM stream, which drops its
+            # connection, and skip the related questions if they haven't started.
+            close = getattr(llm_response, "close", None)
+            if close is not None:
+                close()
+            related_cancelled = (
+                related_questions_future is not None and related_questions_future.cancel()
+            )
+            saved = abandonment_stats.record_abandoned(deltas, related_cancelled)
+            logger.info(f"Client went away after {deltas} deltas, ~{saved:.0f} tokens saved.")
+            raise
 
     def stream_and_upload_to_kv(
-        self, contexts, llm_response, related_questions_future, search_uuid
+        self, contexts, llm_response, related_questions_future, search_uuid, permit=None,
+        trace=None,
     ) -> Generator[str, None, None]:
         """
-        Streams the result and uploads to KV.
+        Streams the result and uploads to KV, then finishes the request's `trace`.
         """
         # First, stream and yield the results.
-        all_yielded_results = []
-        for result in self._raw_stream_response(
-            contexts, llm_response, related_questions_future
-        ):
-            all_yielded_results.append(result)
-            yield result
-        # Second, upload to KV. Note that if uploading to KV fails, we will silently
-        # ignore it, because we don't want to affect the user experience.
-        _ = self.executor.submit(self.kv.put, search_uuid, "".join(all_yielded_results))
+        result_buffer = ResultBuffer(KV_MAX_RESULT_KB * 1024)
+        stream = self._raw_stream_response(
+            contexts, llm_response, related_questions_future, permit, trace
+        )
+        outcome = "abandoned"
+        failed = False
+        try:
+            for result in stream:
+                result_buffer.append(result)
+                failed = failed or result.startswith(_llm_error_prefix)
+                yield result
+            outcome = "failed" if failed else "completed"
+        except Exception:
+            outcome = "failed"
+            raise
+        finally:
+            # If the client went away, stop the generation now rather than
+            # whenever the generator is garbage collected.
+            stream.close()
+            # The client may go away before the LLM response even started.
+            if permit is not None:
+                permit.release()
+            self.tracer.finish(trace, outcome)
+        # Second, hand the result to the KV writer. If the write fails or is
+        # dropped, the link runs the query again; the user never waits for it.
+        # A failed answer isn't kept, so that its links try again too.
+        if not failed:
+            self.kv_writer.submit(search_uuid, result_buffer)
 
     @Photon.handler(method="POST", path="/query")
     def query_function(
@@ -541,6 +749,7 @@ class RAG(Photon):
         query: str,
         search_uuid: str,
         generate_related_questions: Optional[bool] = True,
+        stream_format: Optional[str] = "text",
     ) -> StreamingResponse:
         """
         Query the search engine and returns the response.
@@ -554,19 +763,31 @@ class RAG(Photon):
             - generate_related_questions: if set to false, will not generate related
                 questions. Otherwise, will depend on the environment variable
                 RELATED_QUESTIONS. Default: true.
+            - stream_format: "text" for the __LLM_RESPONSE__ / __RELATED_QUESTIONS__
+                sentinel protocol, or "ndjson" / "length" for framed sections.
+                Default: text.
         """
+        if stream_format not in FRAMINGS:
+            raise HTTPException(
+                status_code=400, detail=f"stream_format must be one of {FRAMINGS}."
+            )
         # Note that, if uuid exists, we don't check if the stored query is the same
         # as the current query, and simply return the stored result. This is to enable
         # the user to share a searched link to others and have others see the same result.
         if search_uuid:
             try:
-                result = self.kv.get(search_uuid)
-
-                def str_to_generator(result: str) -> Generator[str, None, None]:
-                    yield result
-
-                return StreamingResponse(str_to_generator(result))
+                # Not in the KV yet if the write is still queued or spilled.
+                value = self.kv_writer.get(search_uuid)
+                if value is None:
+                    value = self.kv.get(search_uuid)
+                cache_hits.inc("replay")
+                # Sent as stored, in chunks, or 304 if the client has it already.
+                compressed = compressed_value(value)
+                return replay_response(
+                    content_digest(compressed), iter_chunks(compressed), request_headers(), stream_format
+                )
             except KeyError:
+                cache_misses.inc("replay")
                 logger.info(f"Key {search_uuid} not found, will generate again.")
             except Exception as e:
                 logger.error(
@@ -588,45 +809,117 @@ class RAG(Photon):
         query = query or _default_query
         # Basic attack protection: remove "[INST]" or "[/INST]" from the query
         query = re.sub(r"\[/?INST\]", "", query)
-        contexts = self.search_function(query)
+        # The related questions see the trace through the context; the answer
+        # stream is handed it.
+        trace = self.tracer.start(search_uuid, query=query)
+        # Search, answer and related questions all share the request's deadline.
+        deadline = Deadline(REQUEST_DEADLINE)
+        try:
+            # Shed the request before searching if the LLM is backed up or failing.
+            self.admission.answer.check()
+            self.llm_upstream.breaker.check()
+            with span("search") as stage, deadline_scope(deadline), self.admission.search.slot_sync():
+                contexts = self.search_function(query)
+                stage["results"] = len(contexts)
+            with span("answer_admission"):
+                permit = self.admission.answer.acquire_sync()
+        except (Overloaded, CircuitOpen, DeadlineExceeded) as e:
+            if trace is not None:
+                trace.attributes["status_code"] = e.status_code
+            self.tracer.finish(trace, "rejected")
+            raise HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers)
+        except Exception:
+            self.tracer.finish(trace, "failed")
+            raise
+
+        # Pack the snippets into the token budget, dropping near-duplicates. The
+        # citation numbers stay those of `contexts`, which is what the client gets.
+        def create_llm_response(prompt_contexts):
+            # Retried until the stream starts, within the request's deadline.
+            with span("prompt_build"):
+                messages = _rag_layout.messages(
+                    format_contexts(pack_contexts(prompt_contexts)), query
+                )
+            with deadline_scope(deadline), span("llm_call"):
+                return self.llm_upstream.call_sync(
+                    lambda: client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=1024,
+                        stop=stop_words,
+                        stream=True,
+                        # Report token usage, including cached prompt tokens, at the end.
+                        stream_options={"include_usage": True},
+                        temperature=0.9,
+                        timeout=timeout_for(),
+                    )
+                )
 
-        system_prompt = _rag_query_text.format(
-            context="\n\n".join(
-                [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
-            )
-        )
         try:
             client = self.local_client()
-            llm_response = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query},
-                ],
-                max_tokens=1024,
-                stop=stop_words,
-                stream=True,
-                temperature=0.9,
-            )
+            if self.page_fetcher is None:
+                llm_response = create_llm_response(contexts)
+            else:
+                # Fetch the pages only once the contexts are streamed, so that a
+                # slow site never holds back the first byte. The passages only go
+                # into the prompt; the client gets the search results.
+                def enriched_llm_response():
+                    with span("page_fetch"):
+                        prompt_contexts = self.page_fetcher.enrich_sync(query, contexts)
+                    return create_llm_response(prompt_contexts)
+
+                # Runs on a stream thread; take the request's trace along.
+                context = contextvars.copy_context()
+                llm_response = lambda: context.run(enriched_llm_response)
             if self.should_do_related_questions and generate_related_questions:
                 # While the answer is being generated, we can start generating
                 # related questions as a future.
-                related_questions_future = self.executor.submit(
-                    self.get_related_questions, query, contexts
-                )
+                with deadline_scope(deadline):
+                    related_questions_future = self.executor.submit(
+                        contextvars.copy_context().run,
+                        self.get_related_questions, query, contexts,
+                    )
             else:
                 related_questions_future = None
         except Exception as e:
             logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+            errors.inc("answer")
+            permit.release()
+            self.tracer.finish(trace, "failed")
             return HTMLResponse("Internal server error.", 503)
 
+        # Coalesce the tiny LLM deltas into fewer, larger writes. The KV still
+        # receives the plain text protocol.
         return StreamingResponse(
-            self.stream_and_upload_to_kv(
-                contexts, llm_response, related_questions_future, search_uuid
+            encode_stream(
+                iterate_closing(
+                    self.stream_and_upload_to_kv(
+                        contexts, llm_response, related_questions_future, search_uuid, permit,
+                        trace,
+                    )
+                ),
+                stream_format,
             ),
-            media_type="text/html",
+            media_type=MEDIA_TYPES[stream_format],
         )
 
+    def _create_app(self, load_mount):
+        app = super()._create_app(load_mount)
+        # Conditional and precompressed replays need the request headers, which
+        # Photon doesn't pass to the handlers.
+        app.add_middleware(RequestHeadersMiddleware)
+        return app
+
+    @Photon.handler(method="GET", path="/debug/trace/{search_uuid}")
+    def debug_trace(self, search_uuid: str) -> dict:
+        """
+        Returns the stage timeline of a recent request.
+        """
+        trace = self.tracer.get(search_uuid)
+        if trace is None:
+            raise HTTPException(status_code=404, detail="No trace for this search_uuid.")
+        return trace
+
     @Photon.handler(mount=True)
     def ui(self):
         return StaticFiles(directory="ui")
@@ -0,0 +1,42 @@
+"""
+Serves app.py with WORKERS processes on one host.
+
+    WORKERS=4 python serve.py
+
+One process does the JSON encoding, stream handling and agent bookkeeping of
+all requests on a single core. With WORKERS > 1, uvicorn runs that many
+processes on a shared socket, and the search and answer caches are shared
+between them through the SQLite database at SHARED_CACHE_PATH (see
+shared_cache.py), as is the replay store, so adding workers doesn't lower the
+hit rates. Admission limits and agent pools are per worker.
+
+SIGHUP replaces the workers one at a time, each only after its replacement
+has started, so a restart drops no requests (uvicorn 0.51.0 and later; before
+that, uvicorn stopped each worker before starting its replacement). A stopping
+worker stops accepting connections and gives the streams in flight
+GRACEFUL_SHUTDOWN_TIMEOUT seconds to finish.
+
+This module stays small on purpose: worker processes are spawned and import
+the main module again before they import the app.
+"""
+import os
+
+import uvicorn
+
+from shared_cache import WORKERS
+
+GRACEFUL_SHUTDOWN_TIMEOUT = float(os.environ.get("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+
+
+def main():
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8080,
+        workers=WORKERS,
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Cache storage shared by the worker processes of one host.
+
+With WORKERS > 1 every worker would otherwise keep its own search and answer
+caches, and the hit rate would drop with each worker added. When
+SHARED_CACHE_PATH is set, which it is by default with several workers, the
+caches keep their entries in one SQLite database instead (see
+`SqliteSearchCache` and `SharedAnswerCache`). SQLite in WAL mode lets the
+workers read concurrently, and a lookup costs well under a millisecond next
+to the seconds a search or an answer takes.
+"""
+import os
+import sqlite3
+
+# Worker processes of `python app.py`.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+SHARED_CACHE_PATH = os.environ.get("SHARED_CACHE_PATH", "shared_cache.db" if WORKERS > 1 else "")
+
+# Seconds a write waits for another worker's write to finish.
+_BUSY_TIMEOUT = 5.0
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Opens a SQLite database for use by several threads and processes; callers serialize access."""
+    conn = sqlite3.connect(path, timeout=_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
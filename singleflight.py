@@ -0,0 +1,144 @@
+"""
+Single-flight coalescing of identical in-flight work.
+
+When a query trends, many users ask it within the same second. Instead of one
+search, one LLM stream and one related-questions call per user, the first
+request (the leader) starts the work and every identical request that arrives
+while it is in flight attaches to it:
+
+- `do` shares the result of one awaitable, like Go's singleflight.
+- `stream` shares one async stream. The source is drained by a background task
+  into a buffer, and each subscriber gets every chunk from the start, so late
+  joiners first catch up on what was buffered so far and then follow live.
+
+Flights are forgotten as soon as they finish, so a later request starts fresh
+(and usually finds the result in a cache instead).
+
+A stream nobody reads any more is abandoned: once its last subscriber went
+away (the client disconnected) and no one subscribed again within
+`abandon_grace` seconds, the draining task is cancelled, which cancels the
+source and whatever upstream calls it is waiting on.
+"""
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Hashable
+
+
+class _Flight:
+    """A running source stream, buffered for any number of subscribers."""
+
+    def __init__(self, abandon_grace: float, on_abandon: Callable[[], None]):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.abandon_grace = abandon_grace
+        self._on_abandon = on_abandon
+        self._abandon_timer = None
+        self._changed = asyncio.get_running_loop().create_future()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.get_running_loop().create_future()
+        changed.set_result(None)
+
+    async def drain(self, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _abandon(self) -> None:
+        self._abandon_timer = None
+        if not self.subscribers and not self.done:
+            self.task.cancel()
+            self._on_abandon()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        if self._abandon_timer is not None:
+            # Someone came back (e.g. a page reload) before the stream was given up.
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+        try:
+            index = 0
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await asyncio.shield(self._changed)
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done and self.task is not None:
+                self._abandon_timer = asyncio.get_running_loop().call_later(self.abandon_grace, self._abandon)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls and streams that share a key."""
+
+    def __init__(self, abandon_grace: float = 0.0):
+        self.abandon_grace = abandon_grace
+        self._calls = {}
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    @staticmethod
+    def _forget(in_flight: dict, key, value) -> None:
+        if in_flight.get(key) is value:
+            del in_flight[key]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """Awaits `fn()`, or the already in-flight call for `key`."""
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._forget(self._calls, key, future))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        # Shielded, so that one caller going away doesn't cancel the call for the others.
+        return await asyncio.shield(future)
+
+    def stream(self, key: Hashable, source_factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Returns a subscription to the in-flight stream for `key`, starting one from
+        `source_factory()` if there is none. The factory is only called for leaders.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(self.abandon_grace, lambda: self._abandoned(key, flight))
+            self._flights[key] = flight
+            flight.task = task = asyncio.ensure_future(flight.drain(source_factory()))
+            task.add_done_callback(lambda _: self._forget(self._flights, key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return flight.subscribe()
+
+    def _abandoned(self, key, flight: _Flight) -> None:
+        # Requests arriving from now on start afresh rather than join a cancelled stream.
+        self._forget(self._flights, key, flight)
+        self.abandoned += 1
+
+    def streaming(self, key: Hashable) -> bool:
+        """Whether a stream for `key` is in flight, so that `stream` would join it."""
+        return key in self._flights
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls) + len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
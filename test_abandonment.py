@@ -0,0 +1,23 @@
+from abandonment import AbandonmentStats
+
+
+class TestAbandonmentStats:
+    """Tests for abandoned answer accounting"""
+
+    def test_tokens_saved_are_estimated_from_completed_answers(self):
+        stats = AbandonmentStats()
+        stats.record_completed(100)
+        assert stats.record_abandoned(30, related_cancelled=True) == 70
+        assert stats.record_abandoned(150) == 0
+        result = stats.stats()
+        assert result["completed"] == 1
+        assert result["abandoned"] == 2
+        assert result["abandoned_ratio"] == 2 / 3
+        assert result["related_cancelled"] == 1
+        assert result["tokens_generated_abandoned"] == 180
+        assert result["tokens_saved_estimate"] == 70
+
+    def test_nothing_saved_without_completed_answers(self):
+        stats = AbandonmentStats()
+        assert stats.record_abandoned(10) == 0
+        assert stats.stats()["abandoned_ratio"] == 1.0
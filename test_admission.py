@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import ConcurrencyLimiter, Overloaded
+
+
+def make_limiter(max_concurrency=2, max_queue=4, queue_target=1.0):
+    return ConcurrencyLimiter("test", max_concurrency, max_queue, queue_target)
+
+
+class TestConcurrencyLimiter:
+    """Tests for per-upstream admission control"""
+
+    def test_concurrency_is_bounded_and_queue_is_fifo(self):
+        limiter = make_limiter(max_concurrency=2)
+        active, max_active, order = 0, 0, []
+
+        async def call(i):
+            nonlocal active, max_active
+            async with limiter.slot():
+                order.append(i)
+                active += 1
+                max_active = max(max_active, active)
+                await asyncio.sleep(0.02)
+                active -= 1
+
+        async def run():
+            await asyncio.gather(*(call(i) for i in range(6)))
+
+        asyncio.run(run())
+        assert max_active == 2
+        assert order == list(range(6))
+        stats = limiter.stats()
+        assert stats["admitted"] == 6
+        assert stats["queued"] == 4
+        assert stats["in_flight"] == 0
+        assert stats["queue_depth"] == 0
+
+    def test_full_queue_is_rejected_with_429(self):
+        limiter = make_limiter(max_concurrency=1, max_queue=1)
+
+        async def run():
+            permit = await limiter.acquire()
+            queued = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            with pytest.raises(Overloaded) as e:
+                await limiter.acquire()
+            permit.release()
+            (await queued).release()
+            return e.value
+
+        error = asyncio.run(run())
+        assert error.status_code == 429
+        assert error.headers == {"Retry-After": "1"}
+        assert limiter.stats()["rejected_queue_full"] == 1
+
+    def test_queue_wait_past_target_is_rejected_with_503(self):
+        limiter = make_limiter(max_concurrency=1, queue_target=0.05)
+
+        async def run():
+            permit = await limiter.acquire()
+            with pytest.raises(Overloaded) as e:
+                await limiter.acquire()
+            permit.release()
+            return e.value
+
+        error = asyncio.run(run())
+        assert error.status_code == 503
+        stats = limiter.stats()
+        assert stats["rejected_timeout"] == 1
+        assert stats["queue_depth"] == 0
+        assert stats["in_flight"] == 0
+
+    def test_expected_wait_past_target_is_shed_immediately(self):
+        limiter = make_limiter(max_concurrency=1, queue_target=1.0)
+        limiter.hold_ewma = 5.0  # slots have recently been held for 5s
+
+        async def run():
+            permit = await limiter.acquire()
+            start = time.monotonic()
+            with pytest.raises(Overloaded) as e:
+                limiter.check()
+            with pytest.raises(Overloaded):
+                await limiter.acquire()
+            permit.release()
+            return e.value, time.monotonic() - start
+
+        error, elapsed = asyncio.run(run())
+        assert error.status_code == 503
+        assert error.retry_after == 5
+        assert elapsed < 0.5
+        assert limiter.stats()["rejected_expected_wait"] == 2
+
+    def test_check_admits_when_idle(self):
+        limiter = make_limiter()
+        limiter.hold_ewma = 100.0
+        limiter.check()
+
+    def test_cancelled_waiter_leaves_the_queue(self):
+        limiter = make_limiter(max_concurrency=1)
+
+        async def run():
+            permit = await limiter.acquire()
+            waiter = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            permit.release()
+            (await limiter.acquire()).release()
+
+        asyncio.run(run())
+        stats = limiter.stats()
+        assert stats["in_flight"] == 0
+        assert stats["queue_depth"] == 0
+
+    def test_threads_and_coroutines_share_the_limit(self):
+        limiter = make_limiter(max_concurrency=1)
+        events = []
+
+        def worker():
+            with limiter.slot_sync():
+                events.append("thread")
+
+        async def run():
+            permit = await limiter.acquire()
+            thread = threading.Thread(target=worker)
+            thread.start()
+            await asyncio.sleep(0.05)
+            events.append("released")
+            permit.release()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+        asyncio.run(run())
+        assert events == ["released", "thread"]
+        assert limiter.stats()["wait_seconds"] > 0.04
+
+    def test_release_is_idempotent(self):
+        limiter = make_limiter(max_concurrency=1)
+        permit = limiter.acquire_sync()
+        permit.release()
+        permit.release()
+        assert limiter.stats()["in_flight"] == 0
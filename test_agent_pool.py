@@ -0,0 +1,82 @@
+import asyncio
+import itertools
+
+import pytest
+
+from agent_pool import AgentPool
+
+
+class FakeAgent:
+    def __init__(self, number):
+        self.number = number
+        self.messages = []
+
+
+def make_pool(max_size):
+    counter = itertools.count()
+    return AgentPool(lambda: FakeAgent(next(counter)), max_size=max_size)
+
+
+class TestAgentPool:
+    """Tests for the bounded agent pool"""
+
+    def test_checkout_resets_conversation(self):
+        pool = make_pool(1)
+
+        async def run():
+            async with pool.checkout() as agent:
+                agent.messages.append("previous user's question")
+            async with pool.checkout() as agent:
+                return agent
+
+        agent = asyncio.run(run())
+        assert agent.number == 0
+        assert agent.messages == []
+
+    def test_size_is_bounded_and_waiters_are_served(self):
+        pool = make_pool(2)
+        seen = []
+
+        async def use():
+            async with pool.checkout() as agent:
+                seen.append(agent.number)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*[use() for _ in range(10)])
+
+        asyncio.run(run())
+        assert sorted(set(seen)) == [0, 1]
+        stats = pool.stats()
+        assert stats["size"] == 2
+        assert stats["in_use"] == 0
+        assert stats["waits"] == 8
+
+    def test_cancelled_waiter_does_not_leak(self):
+        pool = make_pool(1)
+
+        async def run():
+            agent = await pool.acquire()
+            waiter = asyncio.ensure_future(pool.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            pool.release(agent)
+            return await asyncio.wait_for(pool.acquire(), timeout=1)
+
+        assert asyncio.run(run()).number == 0
+        assert pool.stats()["waiting"] == 0
+
+    def test_warm(self):
+        pool = make_pool(3)
+        assert pool.warm(2) == 2
+        assert pool.warm() == 1
+        assert pool.stats()["idle"] == 3
+
+    def test_factory_failure_frees_slot(self):
+        pool = AgentPool(lambda: (_ for _ in ()).throw(ValueError("no key")), max_size=1)
+        with pytest.raises(ValueError):
+            asyncio.run(pool.acquire())
+        assert pool.stats()["size"] == 0
+        assert pool.stats()["in_use"] == 0
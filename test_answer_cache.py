@@ -0,0 +1,166 @@
+import time
+from unittest.mock import patch
+
+from answer_cache import AnswerCache, SharedAnswerCache, query_tokens
+
+
+CONTEXTS = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+
+
+class TestQueryTokens:
+    """Tests for query normalization"""
+
+    def test_case_and_punctuation_are_ignored(self):
+        assert query_tokens("Who said 'Live long and prosper'?") == query_tokens("who said: live long, and PROSPER")
+
+    def test_word_order_counts(self):
+        assert query_tokens("is rust faster than go") != query_tokens("is go faster than rust")
+        assert "faster+than" in query_tokens("is rust faster than go")
+
+    def test_contractions_are_negations(self):
+        assert "not" in query_tokens("Isn't it raining?")
+
+    def test_is_contractions_are_expanded(self):
+        assert query_tokens("What's the speed of light?") == query_tokens("what is the speed of light")
+        assert "is" not in query_tokens("Einstein's theory of relativity")
+
+
+class TestAnswerCache:
+    """Tests for the near-duplicate answer cache"""
+
+    def test_exact_hits(self):
+        cache = AnswerCache()
+        cache.put("Who said live long and prosper?", CONTEXTS, "Spock.", ["Who is Spock?"])
+
+        cached = cache.get("who said: Live long and prosper")
+
+        assert cached.answer == "Spock."
+        assert cached.related_questions == ["Who is Spock?"]
+        assert cache.stats()["near_hits"] == 0
+
+    def test_one_word_more_or_less_hits(self):
+        cache = AnswerCache()
+        cache.put("How tall is the Eiffel Tower?", CONTEXTS, "330 m", None)
+        cache.put("best pizza in new york city", CONTEXTS, "Joe's", None)
+
+        assert cache.get("how tall is the eiffel tower in paris").answer == "330 m"
+        assert cache.get("best pizza new york city").answer == "Joe's"
+        assert cache.get("best pizza in new york city tonight").answer == "Joe's"
+        assert cache.stats()["near_hits"] == 3
+
+    def test_one_word_of_a_short_query_is_too_much(self):
+        cache = AnswerCache()
+        cache.put("capital of france", CONTEXTS, "Paris", None)
+
+        assert cache.get("capital france") is None
+        assert cache.get("capital city of france") is None
+
+    def test_near_duplicate_hit_above_threshold(self):
+        cache = AnswerCache(threshold=0.8)
+        cache.put("how tall is the eiffel tower in paris france", CONTEXTS, "330 m", None)
+
+        assert cache.get("how tall is the eiffel tower in paris") is not None
+        assert cache.stats()["near_hits"] == 1
+
+    def test_different_question_misses(self):
+        cache = AnswerCache()
+        cache.put("who is the president of the usa", CONTEXTS, "answer", None)
+
+        # Above the threshold, but a word was replaced rather than added.
+        assert cache.get("who is the president of the france") is None
+        assert cache.get("who is the prime minister of the usa") is None
+        assert cache.stats()["misses"] == 2
+
+    def test_reversed_comparison_misses(self):
+        cache = AnswerCache()
+        cache.put("is rust faster than go", CONTEXTS, "rust", None)
+
+        assert cache.get("is go faster than rust") is None
+
+    def test_negation_must_match(self):
+        cache = AnswerCache()
+        cache.put("which european countries are members of the eu and use the euro", CONTEXTS, "answer", None)
+
+        assert cache.get("which european countries are members of the eu and do not use the euro") is None
+        assert cache.get("which european countries are members of the eu but don't use the euro") is None
+
+    def test_numbers_must_match(self):
+        cache = AnswerCache()
+        cache.put("what were the best selling cars in the united states in 2019", CONTEXTS, "answer", None)
+
+        assert cache.get("what were the best selling cars in the united states in 2020") is None
+        assert cache.get("what were the best selling cars in the united states in 2019 overall") is not None
+
+    def test_ttl_expiry(self):
+        cache = AnswerCache(ttl=10)
+        with patch("answer_cache.time.time", return_value=1000.0):
+            cache.put("question", CONTEXTS, "answer", None)
+        with patch("answer_cache.time.time", return_value=1011.0):
+            assert cache.get("question") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_index_is_bounded(self):
+        cache = AnswerCache(max_entries=10)
+        for i in range(100):
+            cache.put(f"question number {i}", CONTEXTS, "answer", None)
+
+        assert cache.stats()["entries"] == 10
+        assert cache.get("question number 5") is None
+        assert cache.get("question number 95") is not None
+        assert sum(len(bucket) for band in cache._buckets for bucket in band.values()) == 10 * cache.bands
+
+    def test_lookup_is_sub_millisecond(self):
+        cache = AnswerCache(max_entries=1000)
+        for i in range(1000):
+            cache.put(f"what happened in the year {i} in europe", CONTEXTS, "answer", None)
+
+        start = time.perf_counter()
+        for i in range(200):
+            cache.get(f"what happened in year {i} europe?")
+        assert (time.perf_counter() - start) / 200 < 0.001
+
+
+class TestSharedAnswerCache:
+    """Tests for the answer cache shared between processes"""
+
+    def test_answers_are_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / "shared.db")
+        writer, reader = SharedAnswerCache(path, threshold=0.8), SharedAnswerCache(path, threshold=0.8)
+        writer.put("how tall is the eiffel tower in paris france", CONTEXTS, "330 m", ["Who built it?"])
+
+        cached = reader.get("how tall is the eiffel tower in paris")
+
+        assert cached.answer == "330 m"
+        assert cached.contexts == CONTEXTS
+        assert cached.related_questions == ["Who built it?"]
+        assert reader.stats()["near_hits"] == 1
+        assert reader.get("who is the president of the usa") is None
+
+    def test_negations_and_numbers_must_match(self, tmp_path):
+        cache = SharedAnswerCache(str(tmp_path / "shared.db"), threshold=0.6)
+        cache.put("what were the best selling cars in the united states in 2019", CONTEXTS, "answer", None)
+
+        assert cache.get("what were the best selling cars in the united states in 2020") is None
+        assert cache.get("what were not the best selling cars in the united states in 2019") is None
+        assert cache.get("what were the best selling cars in the united states in 2019 overall") is not None
+
+    def test_ttl_expiry(self, tmp_path):
+        cache = SharedAnswerCache(str(tmp_path / "shared.db"), ttl=10)
+        with patch("answer_cache.time.time", return_value=1000.0):
+            cache.put("question", CONTEXTS, "answer", None)
+        with patch("answer_cache.time.time", return_value=1011.0):
+            assert cache.get("question") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_least_recently_used_are_evicted(self, tmp_path):
+        cache = SharedAnswerCache(str(tmp_path / "shared.db"), max_entries=10)
+        for i in range(30):
+            with patch("answer_cache.time.time", return_value=1000.0 + i):
+                cache.put(f"question number {i}", CONTEXTS, "answer", None)
+
+        with patch("answer_cache.time.time", return_value=1100.0):
+            assert cache.stats()["entries"] == 10
+            assert cache.get("question number 5") is None
+            assert cache.get("question number 25") is not None
+        bucket_rows = cache._conn.execute("SELECT COUNT(*) FROM answer_buckets").fetchone()[0]
+        assert bucket_rows == 10 * cache.bands
@@ -1,14 +1,91 @@
 import json
+import os
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 
-from app import app, search_with_serper, get_related_questions
+import asyncio
+import concurrent.futures
+import subprocess
+import sys
+
+import httpx
+import openai
+
+# Keep the replay store and answer cache out of the tests unless a test installs its own.
+os.environ["REPLAY_STORE_PATH"] = ""
+os.environ["ANSWER_CACHE_SIZE"] = "0"
+
+import app as app_module
+from app import app, search_with_serper, search_with_serper_async, get_related_questions
+from abandonment import AbandonmentStats
+from admission import ConcurrencyLimiter, admission_from_env
+from agent_pool import AgentPool
+from answer_cache import AnswerCache, SharedAnswerCache
+from benchmarks.standins import RELATED_QUESTIONS_CALL, make_openai_app
+from context_packer import format_contexts, pack_contexts
+from local_index import LocalIndex, build_index
+from prompt_layout import PromptCacheStats
+from replay_store import ReplayStore
+from reranker import LexicalReranker
+from resilience import Upstream
+from search_cache import LRUSearchCache, SqliteSearchCache
+from singleflight import SingleFlight
+from tracing import Tracer
 
 
 client = TestClient(app)
 
 
+def fake_agent(chunks=("answer",), raises=None, delay=0.0, on_prompt=None):
+    """
+    A stand-in for the main answer agent. Its stream_async records the prompt
+    in `agent.prompts`, calls `on_prompt(agent, prompt)`, yields `chunks` as
+    text deltas, `delay` seconds apart, and then raises `raises`, if given.
+    `agent.finished` counts the streams that ended, however they ended.
+    """
+    agent = MagicMock()
+    agent.prompts = []
+    agent.finished = 0
+
+    async def stream_async(prompt):
+        agent.prompts.append(prompt)
+        try:
+            if on_prompt is not None:
+                on_prompt(agent, prompt)
+            for chunk in chunks:
+                if delay:
+                    await asyncio.sleep(delay)
+                yield {"event": {"contentBlockDelta": {"delta": {"text": chunk}}}}
+            if raises is not None:
+                raise raises
+        finally:
+            agent.finished += 1
+
+    agent.stream_async = stream_async
+    return agent
+
+
+@pytest.fixture(autouse=True)
+def fresh_agent_pool():
+    """Give every test empty agent pools that build agents with the (patchable) factories."""
+    pool = AgentPool(lambda: app_module.create_main_response_agent(), max_size=4)
+    related_pool = AgentPool(lambda: app_module.create_related_questions_agent(), max_size=4)
+    with patch("app.main_agent_pool", pool), patch("app.related_agent_pool", related_pool):
+        yield pool
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstreams():
+    """Give every test closed circuit breakers and fast retries."""
+    def upstream(name):
+        return Upstream(name, base_delay=0.001, max_delay=0.001, reset_timeout=60)
+
+    with patch("app.serper_upstream", upstream("serper")) as serper, patch("app.llm_upstream", upstream("llm")):
+        yield serper
+
+
 class TestSearchWithSerper:
     """Tests for search_with_serper function"""
 
@@ -51,6 +128,22 @@ class TestSearchWithSerper:
         assert results[0]["name"] == "Knowledge Title"
         assert results[0]["snippet"] == "KG Description"
 
+    @patch("app.requests.post")
+    def test_search_with_serper_reranks_candidates(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.ok = True
+        mock_response.json.return_value = {"organic": [
+            {"title": f"Result {i}", "link": f"https://example.com/{i}", "snippet": "Cooking recipes."} for i in range(19)
+        ] + [{"title": "Vulcan salute", "link": "https://example.com/vulcan", "snippet": "Live long and prosper."}]}
+        mock_post.return_value = mock_response
+
+        with patch("app.SEARCH_CANDIDATE_COUNT", 20), patch("app.reranker", LexicalReranker(app_module.REFERENCE_COUNT)):
+            results = search_with_serper("live long and prosper", "fake_api_key")
+
+        assert json.loads(mock_post.call_args.kwargs["data"])["num"] == 20
+        assert len(results) == app_module.REFERENCE_COUNT
+        assert results[0]["url"] == "https://example.com/vulcan"
+
     @patch("app.requests.post")
     def test_search_with_serper_api_error(self, mock_post):
         mock_response = MagicMock()
@@ -62,20 +155,53 @@ class TestSearchWithSerper:
             search_with_serper("test query", "fake_api_key")
 
 
+class TestSearchWithSerperAsync:
+    """Tests for the pooled async Serper client"""
+
+    def _run_with_transport(self, handler):
+        async def run():
+            app_module._search_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            try:
+                return await search_with_serper_async("test query", "fake_api_key")
+            finally:
+                await app_module.close_search_client()
+        return asyncio.run(run())
+
+    def test_search_with_serper_async_success(self):
+        def handler(request):
+            assert request.headers["X-API-KEY"] == "fake_api_key"
+            assert json.loads(request.content)["q"] == "test query"
+            return httpx.Response(200, json={
+                "organic": [{"title": "Result 1", "link": "https://example.com/1", "snippet": "Snippet 1"}]
+            })
+
+        results = self._run_with_transport(handler)
+
+        assert results == [{"name": "Result 1", "url": "https://example.com/1", "snippet": "Snippet 1"}]
+
+    def test_search_with_serper_async_api_error(self):
+        with pytest.raises(Exception):
+            self._run_with_transport(lambda request: httpx.Response(500))
+
+    def test_search_client_is_shared(self):
+        async def run():
+            try:
+                return app_module.get_search_client() is app_module.get_search_client()
+            finally:
+                await app_module.close_search_client()
+        assert asyncio.run(run())
+
+
 class TestQueryEndpoint:
     """Tests for /query endpoint"""
 
-    @patch("app.search_with_serper")
-    @patch("app.get_main_response_agent")
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
     def test_query_endpoint_success(self, mock_get_agent, mock_search):
         mock_search.return_value = [
             {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
         ]
-        
-        # Mock the Strands Agent
-        mock_agent = MagicMock()
-        mock_agent.stream.return_value = iter(["Test ", "answer"])
-        mock_get_agent.return_value = mock_agent
+        mock_get_agent.return_value = fake_agent(["Test ", "answer"])
 
         with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
             response = client.post("/query", json={
@@ -84,6 +210,7 @@ class TestQueryEndpoint:
             })
 
         assert response.status_code == 200
+        assert "__LLM_RESPONSE__\n\nTest answer" in response.text
 
     def test_query_endpoint_missing_query(self):
         with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
@@ -93,6 +220,510 @@ class TestQueryEndpoint:
         assert response.status_code == 422
 
 
+class TestQueryAgentPool:
+    """Tests for per-request agent checkout in /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_agent_is_returned_with_fresh_conversation(self, mock_create_agent, mock_search, fresh_agent_pool):
+        mock_search.return_value = []
+        histories = []
+
+        def converse(agent, prompt):
+            histories.append(list(agent.messages))
+            agent.messages.append({"role": "user", "content": prompt})
+
+        mock_create_agent.return_value = fake_agent(on_prompt=converse)
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            for query in ["first question", "second question"]:
+                client.post("/query", json={"query": query, "search_uuid": "", "generate_related_questions": False})
+
+        assert histories == [[], []]
+        assert mock_create_agent.call_count == 1
+        assert fresh_agent_pool.stats()["in_use"] == 0
+
+    def test_missing_api_key_returns_503(self):
+        with patch("app.search_with_serper_async", new_callable=AsyncMock) as mock_search, \
+                patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": ""}):
+            mock_search.return_value = []
+            response = client.post("/query", json={"query": "question", "search_uuid": ""})
+        assert response.status_code == 503
+
+
+class TestQueryPageFetch:
+    """Tests for page-fetch enrichment in /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_passages_go_into_the_prompt_only(self, mock_create_agent, mock_search):
+        contexts = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+        mock_search.return_value = contexts
+        agent = mock_create_agent.return_value = fake_agent()
+        fetcher = MagicMock()
+        fetcher.enrich = AsyncMock(return_value=[{**contexts[0], "snippet": "Test snippet. A passage from the page."}])
+
+        with patch("app.page_fetcher", fetcher), \
+                patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={"query": "page question", "search_uuid": "", "generate_related_questions": False})
+
+        assert json.loads(response.text.split("\n\n__LLM_RESPONSE__\n\n")[0]) == contexts
+        assert "A passage from the page." in agent.prompts[0]
+
+    def test_contexts_are_sent_before_the_prompt_is_ready(self):
+        async def run():
+            prompt = asyncio.get_running_loop().create_future()
+            stream = app_module.raw_stream_response([{"snippet": "s"}], AgentPool(MagicMock, max_size=1), prompt, None)
+            first = await asyncio.wait_for(stream.__anext__(), timeout=1)
+            await stream.aclose()
+            return first
+
+        assert json.loads(asyncio.run(run())) == [{"snippet": "s"}]
+
+
+class TestQueryLocalIndex:
+    """Tests for the LOCAL search backend in /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_searches_the_local_index_without_serper(self, mock_create_agent, mock_search, tmp_path):
+        source = tmp_path / "docs.jsonl"
+        source.write_text(json.dumps({
+            "url": "https://docs.example.com/salute", "name": "Vulcan salute",
+            "text": "Leonard Nimoy introduced the blessing live long and prosper.",
+        }) + "\n")
+        build_index(str(source), str(tmp_path / "index"))
+        mock_create_agent.return_value = fake_agent()
+
+        with patch("app.local_index", LocalIndex(str(tmp_path / "index"))), \
+                patch.dict("os.environ", {"OPENAI_API_KEY": "fake_key"}):
+            os.environ.pop("SERPER_SEARCH_API_KEY", None)
+            response = client.post("/query", json={"query": "live long and prosper", "search_uuid": "", "generate_related_questions": False})
+
+        contexts = json.loads(response.text.split("\n\n__LLM_RESPONSE__\n\n")[0])
+        assert [c["url"] for c in contexts] == ["https://docs.example.com/salute"]
+        mock_search.assert_not_awaited()
+
+
+class TestQueryAdmission:
+    """Tests for admission control in /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    def test_backed_up_answer_stage_sheds_before_searching(self, mock_search):
+        admission = admission_from_env()._replace(answer=ConcurrencyLimiter("answer", 1, 4, queue_target=1.0))
+        admission.answer.acquire_sync()
+        admission.answer.hold_ewma = 10.0
+
+        with patch("app.admission", admission), \
+                patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={"query": "overload", "search_uuid": "", "generate_related_questions": False})
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "10"
+        mock_search.assert_not_awaited()
+        assert admission.stats()["answer"]["rejected_expected_wait"] == 1
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_answer_slot_is_held_for_the_stream(self, mock_create_agent, mock_search):
+        mock_search.return_value = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+        admission = admission_from_env()
+        in_flight = []
+        mock_create_agent.return_value = fake_agent(
+            on_prompt=lambda agent, prompt: in_flight.append(admission.answer.stats()["in_flight"])
+        )
+
+        with patch("app.admission", admission), \
+                patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={"query": "slot", "search_uuid": "", "generate_related_questions": False})
+
+        assert response.text.endswith("answer")
+        assert in_flight == [1]
+        assert admission.answer.stats()["in_flight"] == 0
+        assert admission.search.stats()["admitted"] == 1
+
+
+class TestQueryResilience:
+    """Tests for retries and circuit breakers in /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_failed_search_is_retried(self, mock_create_agent, mock_search):
+        contexts = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+        mock_search.side_effect = [HTTPException(502, "Search engine error."), contexts]
+        mock_create_agent.return_value = fake_agent()
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={"query": "retry me", "search_uuid": "", "generate_related_questions": False})
+
+        assert json.loads(response.text.split("\n\n__LLM_RESPONSE__\n\n")[0]) == contexts
+        assert mock_search.await_count == 2
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    def test_open_search_circuit_fails_fast(self, mock_search, fresh_upstreams):
+        mock_search.side_effect = HTTPException(503, "Search engine error.")
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            statuses = [
+                client.post("/query", json={"query": f"down {i}", "search_uuid": "", "generate_related_questions": False}).status_code
+                for i in range(3)
+            ]
+            response = client.post("/query", json={"query": "down again", "search_uuid": "", "generate_related_questions": False})
+
+        # Each failed request made 3 attempts; 5 consecutive failures opened the circuit.
+        assert statuses[:2] == [503, 503]
+        assert mock_search.await_count == 5
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) > 0
+        assert fresh_upstreams.breaker.state == "open"
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_answer_is_retried_before_its_first_token(self, mock_create_agent, mock_search):
+        mock_search.return_value = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+
+        def fail_first_attempt(agent, prompt):
+            if len(agent.prompts) == 1:
+                raise httpx.ConnectError("connection reset")
+
+        agent = mock_create_agent.return_value = fake_agent(on_prompt=fail_first_attempt)
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={"query": "answer retry", "search_uuid": "", "generate_related_questions": False})
+
+        assert response.text.endswith("__LLM_RESPONSE__\n\nanswer")
+        assert len(agent.prompts) == 2
+
+
+class TestQuerySearchCache:
+    """Tests for the search cache in front of /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_repeated_query_searches_once(self, mock_get_agent, mock_search):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_get_agent.return_value = fake_agent()
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.search_cache", LRUSearchCache()) as cache:
+            for query in ["Cached Question", "  cached   question "]:
+                client.post("/query", json={
+                    "query": query,
+                    "search_uuid": "test-uuid",
+                    "generate_related_questions": False
+                })
+
+        assert mock_search.await_count == 1
+        assert cache.stats()["hits"] == 1
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_shared_caches_are_queried_off_the_event_loop(self, mock_get_agent, mock_search, tmp_path):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_get_agent.return_value = fake_agent()
+        path = str(tmp_path / "shared.db")
+        search_cache, answer_cache = SqliteSearchCache(path), SharedAnswerCache(path)
+        on_loop = []
+        for cache in (search_cache, answer_cache):
+            for name in ("get", "put"):
+                def record(*args, method=getattr(cache, name)):
+                    try:
+                        asyncio.get_running_loop()
+                        on_loop.append(True)
+                    except RuntimeError:
+                        on_loop.append(False)
+                    return method(*args)
+                setattr(cache, name, record)
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.search_cache", search_cache), patch("app.answer_cache", answer_cache):
+            response = client.post("/query", json={
+                "query": "shared question", "search_uuid": "", "generate_related_questions": False
+            })
+
+        assert response.status_code == 200
+        assert answer_cache.stats()["entries"] == 1
+        assert on_loop and not any(on_loop)
+
+
+class TestQueryAnswerCache:
+    """Tests for replaying near-duplicate queries from the answer cache"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_related_questions_agent")
+    @patch("app.create_main_response_agent")
+    def test_near_duplicate_query_is_answered_from_cache(self, mock_create_agent, mock_create_related, mock_search):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_create_agent.return_value = fake_agent(["Spock said it."])
+        mock_related = MagicMock()
+        mock_related.invoke_async = AsyncMock(return_value=MagicMock(
+            structured_output=app_module.RelatedQuestions(questions=["Who is Spock?"])
+        ))
+        mock_create_related.return_value = mock_related
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.answer_cache", AnswerCache()), patch("app.should_do_related_questions", True):
+            first = client.post("/query", json={"query": "Who said live long and prosper?", "search_uuid": ""})
+            second = client.post("/query", json={"query": "who said: Live long and prosper", "search_uuid": ""})
+
+        assert second.text == first.text
+        assert second.text.endswith('__RELATED_QUESTIONS__\n\n[{"question": "Who is Spock?"}]')
+        assert mock_search.await_count == 1
+        assert mock_related.invoke_async.await_count == 1
+
+
+class TestQuerySingleFlight:
+    """Tests for coalescing identical in-flight queries"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_concurrent_identical_queries_share_one_generation(self, mock_create_agent, mock_search):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        agent = mock_create_agent.return_value = fake_agent(["Trending ", "answer."], delay=0.05)
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+                return await asyncio.gather(*[
+                    async_client.post("/query", json={
+                        "query": query, "search_uuid": "", "generate_related_questions": False
+                    })
+                    for query in ["Trending question", "trending  QUESTION", "Trending question"]
+                ])
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.search_cache", LRUSearchCache()):
+            responses = asyncio.run(run())
+
+        assert len({response.text for response in responses}) == 1
+        assert responses[0].text.endswith("Trending answer.")
+        assert mock_search.await_count == 1
+        assert len(agent.prompts) == 1
+
+
+class TestQueryAbandonment:
+    """Tests for giving up answers whose clients went away"""
+
+    @patch("app.create_main_response_agent")
+    def test_abandoned_answer_cancels_related_questions(self, mock_create_agent):
+        agent = mock_create_agent.return_value = fake_agent(["word "] * 100, delay=0.01)
+        stats = AbandonmentStats()
+        on_complete = AsyncMock()
+
+        async def run():
+            flights = SingleFlight(abandon_grace=0)
+            related = asyncio.ensure_future(asyncio.sleep(10, result=["never"]))
+            stream = flights.stream("q", lambda: app_module.raw_stream_response(
+                [], app_module.main_agent_pool, "prompt", related, on_complete=on_complete
+            ))
+            chunks = 0
+            async for _ in stream:
+                chunks += 1
+                if chunks == 5:
+                    break
+            await stream.aclose()  # the client went away
+            await asyncio.sleep(0.05)
+            return related
+
+        with patch("app.abandonment_stats", stats):
+            related = asyncio.run(run())
+
+        assert related.cancelled()
+        assert agent.finished == 1
+        on_complete.assert_not_called()
+        result = stats.stats()
+        assert result["abandoned"] == 1
+        assert result["related_cancelled"] == 1
+        assert 0 < result["tokens_generated_abandoned"] < 100
+
+
+class TestQueryStreamFormat:
+    """Tests for the framed stream formats of /query"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_ndjson_stream_format(self, mock_create_agent, mock_search):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_create_agent.return_value = fake_agent(["Framed ", "answer."])
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            response = client.post("/query", json={
+                "query": "framed question",
+                "search_uuid": "",
+                "generate_related_questions": False,
+                "stream_format": "ndjson"
+            })
+
+        events = [json.loads(line) for line in response.text.splitlines()]
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert events[0] == {"type": "contexts", "data": mock_search.return_value}
+        assert "".join(e["data"] for e in events[1:]) == "Framed answer."
+
+    def test_unknown_stream_format_is_rejected(self):
+        response = client.post("/query", json={"query": "q", "search_uuid": "", "stream_format": "xml"})
+        assert response.status_code == 422
+
+
+class TestQueryReplay:
+    """Tests for replaying stored results by search_uuid"""
+
+    def test_store_is_opened_by_the_lifespan_not_the_import(self, tmp_path):
+        env = {key: value for key, value in os.environ.items() if key != "REPLAY_STORE_PATH"}
+        env["PYTHONPATH"] = os.path.dirname(os.path.abspath(app_module.__file__))
+        subprocess.run([sys.executable, "-c", "import app"], cwd=tmp_path, env=env, check=True, capture_output=True)
+        assert not (tmp_path / "replays.db").exists()
+
+        path = tmp_path / "data" / "replays.db"
+        path.parent.mkdir()
+        with patch.dict("os.environ", {"REPLAY_STORE_PATH": str(path), "OPENAI_API_KEY": ""}), \
+                patch("app.tool_sandbox", None), patch("app.AGENT_POOL_WARM", 0):
+            with TestClient(app):
+                assert app_module.replay_store.path == str(path)
+        assert path.exists()
+        assert app_module.replay_store is None
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    def test_stored_uuid_is_replayed_without_search(self, mock_search, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"))
+        store.put("shared-uuid", '[]\n\n__LLM_RESPONSE__\n\nStored answer')
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.replay_store", store):
+            response = client.post("/query", json={"query": "anything", "search_uuid": "shared-uuid"})
+
+        assert response.status_code == 200
+        assert response.text.endswith("Stored answer")
+        mock_search.assert_not_awaited()
+
+    def test_replays_are_precompressed_and_conditional(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"))
+        store.put("shared-uuid", '[]\n\n__LLM_RESPONSE__\n\nStored answer')
+
+        with patch("app.replay_store", store):
+            response = client.post("/query", json={"query": "anything", "search_uuid": "shared-uuid"})
+            revisit = client.post(
+                "/query", json={"query": "anything", "search_uuid": "shared-uuid"},
+                headers={"If-None-Match": response.headers["etag"]},
+            )
+
+        assert response.headers["content-encoding"] == "deflate"
+        assert response.text.endswith("Stored answer")
+        assert revisit.status_code == 304
+        assert revisit.content == b""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_generated_result_is_stored(self, mock_get_agent, mock_search, tmp_path):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_get_agent.return_value = fake_agent(["Fresh answer"])
+        store = ReplayStore(str(tmp_path / "replays.db"))
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.replay_store", store), patch("app.executor", concurrent.futures.ThreadPoolExecutor(1)) as pool:
+            response = client.post("/query", json={
+                "query": "stored question",
+                "search_uuid": "new-uuid",
+                "generate_related_questions": False
+            })
+            pool.shutdown(wait=True)
+
+        assert store.get("new-uuid") == response.text
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_failed_answer_is_not_stored(self, mock_get_agent, mock_search, tmp_path):
+        mock_search.return_value = [
+            {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
+        ]
+        mock_get_agent.return_value = fake_agent(["Half an "], raises=RuntimeError("model went away"))
+        store = ReplayStore(str(tmp_path / "replays.db"))
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.replay_store", store), patch("app.executor", concurrent.futures.ThreadPoolExecutor(1)) as pool:
+            response = client.post("/query", json={
+                "query": "failing question",
+                "search_uuid": "failed-uuid",
+                "generate_related_questions": False
+            })
+            pool.shutdown(wait=True)
+
+        assert response.status_code == 200
+        assert response.text.endswith(f"{app_module._llm_error_prefix}model went away")
+        assert store.get("failed-uuid") is None
+
+
+class TestMetricsEndpoint:
+    """Tests for /metrics"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_query_stages_are_recorded(self, mock_create_agent, mock_search):
+        mock_search.return_value = []
+        mock_create_agent.return_value = fake_agent(["Test ", "answer"])
+
+        def sample(text, name):
+            lines = [line for line in text.splitlines() if line.startswith(name + " ")]
+            return float(lines[0].split()[-1]) if lines else 0.0
+
+        before = client.get("/metrics").text
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            client.post("/query", json={
+                "query": "metrics question", "search_uuid": "", "generate_related_questions": False
+            })
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        after = response.text
+        for name in [
+            'evidence_search_search_latency_seconds_count{backend="serper"}',
+            "evidence_search_llm_time_to_first_token_seconds_count",
+            'evidence_search_stream_duration_seconds_count{outcome="completed"}',
+            "evidence_search_empty_context_responses_total",
+        ]:
+            assert sample(after, name) == sample(before, name) + 1
+
+
+class TestDebugTrace:
+    """Tests for /debug/trace"""
+
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_main_response_agent")
+    def test_query_leaves_a_stage_timeline(self, mock_create_agent, mock_search):
+        mock_search.return_value = [{"name": "Result", "url": "https://example.com", "snippet": "Snippet"}]
+        mock_create_agent.return_value = fake_agent(["Test ", "answer"])
+
+        with patch("app.tracer", Tracer(buffer_size=8)), \
+                patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+            client.post("/query", json={
+                "query": "trace question", "search_uuid": "trace-uuid", "generate_related_questions": False
+            })
+            response = client.get("/debug/trace/trace-uuid")
+
+            assert response.status_code == 200
+            trace = response.json()
+            assert trace["outcome"] == "completed"
+            assert trace["query"] == "trace question"
+            names = [stage["name"] for stage in trace["stages"]]
+            for name in ["search", "prompt_build", "agent_checkout", "first_token", "last_token"]:
+                assert name in names
+            assert names.index("search") < names.index("first_token") < names.index("last_token")
+            assert trace["stages"][names.index("search")]["results"] == 1
+            assert client.get("/debug/trace/unknown-uuid").status_code == 404
+
+
 class TestIndexEndpoint:
     """Tests for / endpoint"""
 
@@ -105,28 +736,98 @@ class TestIndexEndpoint:
 class TestGetRelatedQuestions:
     """Tests for get_related_questions function"""
 
-    @patch("app.get_related_questions_agent")
-    def test_get_related_questions_success(self, mock_get_agent):
+    @patch("app.create_related_questions_agent")
+    def test_get_related_questions_success(self, mock_create_agent):
         # Mock the Strands Agent
         mock_agent = MagicMock()
-        mock_agent.return_value = "Question 1?\nQuestion 2?\nQuestion 3?"
-        mock_get_agent.return_value = mock_agent
+        mock_agent.invoke_async = AsyncMock(return_value=MagicMock(
+            structured_output=app_module.RelatedQuestions(questions=["Question 1?", "Question 2?", "Question 3?"])
+        ))
+        mock_create_agent.return_value = mock_agent
 
         with patch.dict("os.environ", {"OPENAI_API_KEY": "fake_key"}):
-            questions = get_related_questions("test", [{"snippet": "context"}])
+            questions = asyncio.run(get_related_questions("test", [{"snippet": "context"}]))
 
         assert len(questions) == 3
+        prompt = mock_agent.invoke_async.call_args.args[0]
+        assert "context" in prompt
+        assert prompt.rstrip().endswith("test")
 
-    @patch("app.get_related_questions_agent")
-    def test_get_related_questions_error_returns_empty(self, mock_get_agent):
-        mock_get_agent.side_effect = Exception("API Error")
+    def test_structured_output_from_an_openai_compatible_endpoint(self):
+        standin = openai.AsyncOpenAI(
+            api_key="k", base_url="http://standin/v1",
+            http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=make_openai_app())),
+        )
+        with patch("app.get_async_openai_client", return_value=standin), \
+                patch.dict("os.environ", {"OPENAI_API_KEY": "fake_key"}):
+            questions = asyncio.run(get_related_questions("test", [{"snippet": "context"}]))
+
+        assert questions == RELATED_QUESTIONS_CALL["questions"]
+
+    @patch("app.create_related_questions_agent")
+    def test_get_related_questions_error_returns_empty(self, mock_create_agent):
+        mock_create_agent.side_effect = Exception("API Error")
 
         with patch.dict("os.environ", {"OPENAI_API_KEY": "fake_key"}):
-            questions = get_related_questions("test", [{"snippet": "context"}])
+            questions = asyncio.run(get_related_questions("test", [{"snippet": "context"}]))
 
         assert questions == []
 
 
+class TestPromptCaching:
+    """The static instructions form a prefix that the provider can cache"""
+
+    @staticmethod
+    def _answer_twice(system_prompt, build_prompt):
+        standin = openai.AsyncOpenAI(
+            api_key="k", base_url="http://standin/v1",
+            http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=make_openai_app(
+                cache_block_tokens=16, cache_min_tokens=0,
+            ))),
+        )
+
+        def factory():
+            agent = app_module.create_main_response_agent()
+            agent.system_prompt = system_prompt
+            return agent
+
+        async def run():
+            pool = AgentPool(factory, max_size=1)
+            answers = []
+            for query in ["Who said live long and prosper?", "What is the speed of light?"]:
+                contexts = [{"name": "n", "url": "https://example.com", "snippet": f"A snippet about: {query}"}]
+                prompt = build_prompt(format_contexts(pack_contexts(contexts)), query)
+                answers.append("".join([chunk async for chunk in app_module.raw_stream_response(contexts, pool, prompt, None)]))
+            return answers
+
+        stats = PromptCacheStats()
+        with patch("app.get_async_openai_client", return_value=standin), patch("app.prompt_cache_stats", stats), \
+                patch.dict("os.environ", {"OPENAI_API_KEY": "fake_key"}):
+            answers = asyncio.run(run())
+        assert all("Live long and prosper" in answer for answer in answers)
+        return stats.recent("answer")
+
+    def test_instructions_are_sent_as_system_prompt(self):
+        layout = app_module._rag_layout
+        assert "{context}" not in layout.system
+        assert "cite the contexts" in layout.system
+        message = layout.user_message("[[citation:1]] snippet", "the query")
+        assert message.index("snippet") < message.index("the query")
+        assert message.endswith("the query")
+
+    def test_only_the_user_message_is_uncached(self):
+        layout = app_module._rag_layout
+        first, second = self._answer_twice(layout.system, layout.user_message)
+
+        assert first.cached_tokens == 0
+        # Tool definitions and instructions come from the cache; what is left is
+        # the contexts and the query, up to the cache's block rounding.
+        user_tokens = len(layout.user_message("[[citation:1]] A snippet about: What is the speed of light?",
+                                              "What is the speed of light?").encode()) // 4
+        assert second.cached_tokens > 4 * user_tokens
+        assert second.uncached_tokens <= user_tokens + 16 + 8
+
+
 class TestStopWordsLimit:
     """Test that stop_words doesn't exceed OpenAI's limit of 4"""
 
@@ -138,44 +839,32 @@ class TestStopWordsLimit:
 class TestRelatedQuestionsFormat:
     """Test that related questions are formatted correctly for frontend"""
 
-    @patch("app.search_with_serper")
-    @patch("app.get_main_response_agent")
-    @patch("app.executor")
-    def test_related_questions_format(self, mock_executor, mock_get_agent, mock_search):
+    @patch("app.search_with_serper_async", new_callable=AsyncMock)
+    @patch("app.create_related_questions_agent")
+    @patch("app.create_main_response_agent")
+    def test_related_questions_format(self, mock_get_agent, mock_create_related, mock_search):
         mock_search.return_value = [
             {"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}
         ]
-        
-        # Mock main agent streaming response
-        mock_agent = MagicMock()
-        mock_agent.stream.return_value = iter(["Answer"])
-        mock_get_agent.return_value = mock_agent
-        
-        # Mock related questions future
-        mock_future = MagicMock()
-        mock_future.result.return_value = ["1. Question one?", "2. Question two?"]
-        mock_executor.submit.return_value = mock_future
-
-        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}):
+        mock_get_agent.return_value = fake_agent(["Answer"])
+        mock_related = MagicMock()
+        mock_related.invoke_async = AsyncMock(return_value=MagicMock(
+            structured_output=app_module.RelatedQuestions(questions=["Question one?", "Question two?"])
+        ))
+        mock_create_related.return_value = mock_related
+
+        with patch.dict("os.environ", {"SERPER_SEARCH_API_KEY": "fake_key", "OPENAI_API_KEY": "fake_key"}), \
+                patch("app.should_do_related_questions", True):
             response = client.post("/query", json={
                 "query": "test",
-                "search_uuid": "test-uuid",
+                "search_uuid": "",
                 "generate_related_questions": True
             })
 
         assert response.status_code == 200
-        content = response.text
-        
-        if "__RELATED_QUESTIONS__" in content:
-            related_part = content.split("__RELATED_QUESTIONS__")[1].strip()
-            related_data = json.loads(related_part)
-            # Check format is [{question: string}]
-            for item in related_data:
-                assert "question" in item, "Related question should have 'question' key"
-                assert isinstance(item["question"], str), "Question should be a string"
-                # Check numbering is stripped
-                assert not item["question"].startswith("1."), "Numbering should be stripped"
-                assert not item["question"].startswith("2."), "Numbering should be stripped"
+        related_part = response.text.split("__RELATED_QUESTIONS__")[1].strip()
+        # Check format is [{question: string}]
+        assert json.loads(related_part) == [{"question": "Question one?"}, {"question": "Question two?"}]
 
 
 class TestBranding:
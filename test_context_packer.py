@@ -0,0 +1,60 @@
+from context_packer import count_tokens, format_contexts, pack_contexts, truncate_to_tokens
+
+
+def context(snippet):
+    return {"name": "n", "url": "https://example.com", "snippet": snippet}
+
+
+LONG = "The first sentence is short. " + "The second sentence goes on and on about many things. " * 40
+
+
+class TestTruncate:
+    """Tests for sentence-boundary truncation"""
+
+    def test_short_text_is_untouched(self):
+        assert truncate_to_tokens("Short text.", 100) == "Short text."
+
+    def test_cuts_at_sentence_boundary(self):
+        truncated = truncate_to_tokens(LONG, 30)
+        assert truncated.endswith(".")
+        assert truncated.startswith("The first sentence is short.")
+        assert count_tokens(truncated) <= 30
+
+    def test_cuts_long_sentence_at_word_boundary(self):
+        truncated = truncate_to_tokens("word " * 200, 10)
+        assert truncated.endswith(" …")
+        assert count_tokens(truncated) <= 10
+
+
+class TestPackContexts:
+    """Tests for packing snippets into the prompt budget"""
+
+    def test_near_duplicates_are_dropped_and_citations_are_stable(self):
+        contexts = [
+            context("Live long and prosper is a salutation popularized by Spock in Star Trek."),
+            context("live long and prosper is a salutation popularized by Spock in Star Trek!"),
+            context("Leonard Nimoy based the Vulcan salute on a Jewish priestly blessing."),
+        ]
+
+        packed = pack_contexts(contexts, budget_tokens=1000)
+
+        assert [c.citation for c in packed] == [1, 3]
+        assert format_contexts(packed).startswith("[[citation:1]] Live long")
+        assert "[[citation:3]] Leonard Nimoy" in format_contexts(packed)
+
+    def test_budget_is_respected(self):
+        contexts = [context(" ".join(f"Fact {j} about topic{i} is w{i}x{j}." for j in range(40))) for i in range(8)]
+
+        packed = pack_contexts(contexts, budget_tokens=200, max_snippet_tokens=80)
+
+        assert len(packed) >= 3
+        assert sum(count_tokens(c.snippet) for c in packed) <= 200
+        assert all(count_tokens(c.snippet) <= 80 for c in packed)
+
+    def test_empty_snippets_are_skipped(self):
+        packed = pack_contexts([context(""), context("Real content here.")])
+        assert [c.citation for c in packed] == [2]
+
+    def test_related_questions_format(self):
+        packed = pack_contexts([context("One."), context("Two words here.")])
+        assert format_contexts(packed, citations=False) == "One.\n\nTwo words here."
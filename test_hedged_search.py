@@ -0,0 +1,103 @@
+import time
+
+from hedged_search import HedgedSearch, LatencyHistogram, merge_contexts, normalize_url
+
+
+def result(url, snippet="snippet"):
+    return {"name": url, "url": url, "snippet": snippet}
+
+
+def backend(results, delay=0.0, calls=None):
+    def search(query):
+        if calls is not None:
+            calls.append(query)
+        time.sleep(delay)
+        if isinstance(results, Exception):
+            raise results
+        return results
+    return search
+
+
+class TestLatencyHistogram:
+    """Tests for the per-backend latency histogram"""
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for _ in range(95):
+            histogram.record(0.01)
+        for _ in range(5):
+            histogram.record(2.0)
+
+        assert 0.01 <= histogram.percentile(0.5) < 0.0125
+        assert 2.0 <= histogram.percentile(0.99) < 2.5
+
+    def test_empty(self):
+        assert LatencyHistogram().percentile(0.95) is None
+
+
+class TestMerge:
+    """Tests for URL-level merging of backend results"""
+
+    def test_normalize_url(self):
+        assert normalize_url("https://www.Example.com/a/?utm_source=x&b=1#top") == normalize_url("http://example.com/a?b=1")
+
+    def test_normalize_url_keeps_real_params(self):
+        assert normalize_url("https://example.com/a?gclid=1&ref=x&ved=2&ei=3&fbclid=4") == normalize_url("https://example.com/a")
+        for name in ("eid", "ref_id", "reference", "referrer_page", "eighty"):
+            assert normalize_url(f"https://example.com/a?{name}=1") != normalize_url(f"https://example.com/a?{name}=2")
+
+    def test_merge_interleaves_and_dedupes(self):
+        bing = [result("https://a.com/"), result("https://b.com")]
+        google = [{"title": "A", "link": "https://www.a.com", "snippet": "dup"}, {"title": "C", "link": "https://c.com", "snippet": "c"}]
+
+        merged = merge_contexts([bing, google], limit=8)
+
+        assert [c["url"] for c in merged] == ["https://a.com/", "https://b.com", "https://c.com"]
+        assert merged[2] == {"name": "C", "url": "https://c.com", "snippet": "c"}
+
+
+class TestHedgedSearch:
+    """Tests for hedged fan-out"""
+
+    def test_fast_primary_makes_one_call(self):
+        secondary_calls = []
+        search = HedgedSearch(
+            {"A": backend([result("https://a.com")]), "B": backend([result("https://b.com")], calls=secondary_calls)},
+            limit=8, default_hedge_delay=0.5,
+        )
+        assert search.search("q")[0]["url"] == "https://a.com"
+        assert secondary_calls == []
+        assert search.stats()["hedges"] == 0
+
+    def test_slow_primary_is_hedged(self):
+        search = HedgedSearch(
+            {"A": backend([result("https://a.com")], delay=1.0), "B": backend([result("https://b.com")])},
+            limit=8, default_hedge_delay=0.05,
+        )
+        start = time.monotonic()
+        assert search.search("q")[0]["url"] == "https://b.com"
+        assert time.monotonic() - start < 0.5
+        assert search.stats()["hedge_wins"] == 1
+
+    def test_failed_primary_falls_through_immediately(self):
+        search = HedgedSearch(
+            {"A": backend(RuntimeError("down")), "B": backend([result("https://b.com")])},
+            limit=8, default_hedge_delay=5.0,
+        )
+        start = time.monotonic()
+        assert search.search("q")[0]["url"] == "https://b.com"
+        assert time.monotonic() - start < 1.0
+        assert search.stats()["errors"]["A"] == 1
+
+    def test_hedge_delay_adapts_to_latency(self):
+        search = HedgedSearch({"A": backend([])}, limit=8, min_samples=10, default_hedge_delay=1.0)
+        for _ in range(10):
+            search.histograms["A"].record(0.2)
+        assert 0.2 <= search.hedge_delay("A") < 0.25
+
+    def test_merge_mode(self):
+        search = HedgedSearch(
+            {"A": backend([result("https://a.com")], delay=0.2), "B": backend([result("https://b.com"), result("https://a.com")])},
+            limit=8, default_hedge_delay=0.05, merge=True, merge_grace=1.0,
+        )
+        assert [c["url"] for c in search.search("q")] == ["https://a.com", "https://b.com"]
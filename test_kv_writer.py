@@ -0,0 +1,127 @@
+import threading
+import zlib
+
+from kv_writer import COMPRESSED_PREFIX, KVWriter, ResultBuffer, compressed_value, decode_value, encode_value
+
+
+class FakeKV:
+    def __init__(self, fail=False):
+        self.values = {}
+        self.fail = fail
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def put(self, key, value):
+        self.gate.wait()
+        if self.fail:
+            raise RuntimeError("KV is down")
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values[key]
+
+
+class TestValues:
+    """Tests for the stored value format"""
+
+    def test_values_are_compressed(self):
+        result = ("[]\n\n__LLM_RESPONSE__\n\n" + "word " * 1000).encode("utf-8")
+        value = encode_value(result)
+        assert value.startswith(COMPRESSED_PREFIX)
+        assert len(value) < len(result) / 10
+        assert decode_value(value) == result.decode("utf-8")
+
+    def test_plain_values_still_decode(self):
+        assert decode_value(b"[]\n\n__LLM_RESPONSE__\n\nanswer") == "[]\n\n__LLM_RESPONSE__\n\nanswer"
+        assert decode_value("text") == "text"
+
+    def test_compressed_value_of_old_and_new_values(self):
+        result = b"[]\n\n__LLM_RESPONSE__\n\nanswer"
+        assert zlib.decompress(compressed_value(encode_value(result))) == result
+        assert zlib.decompress(compressed_value(result)) == result
+
+    def test_buffer_gives_up_past_its_cap(self):
+        buffer = ResultBuffer(max_bytes=10)
+        buffer.append("héllo")
+        assert bytes(buffer.data) == "héllo".encode("utf-8")
+        buffer.append("world!")
+        assert buffer.overflowed
+        assert not buffer.data
+
+
+class TestKVWriter:
+    """Tests for write-behind KV persistence"""
+
+    def test_results_are_written_behind(self):
+        kv = FakeKV()
+        writer = KVWriter(kv, spill_dir="")
+        buffer = ResultBuffer(1024)
+        for chunk in ["[]", "\n\n__LLM_RESPONSE__\n\n", "answer"]:
+            buffer.append(chunk)
+        assert writer.submit("uuid", buffer)
+        writer.close()
+        assert decode_value(kv.get("uuid")) == "[]\n\n__LLM_RESPONSE__\n\nanswer"
+        assert writer.stats()["written"] == 1
+        assert writer.stats()["compression_ratio"] is not None
+
+    def test_queued_results_are_readable_before_the_write(self):
+        kv = FakeKV()
+        kv.gate.clear()
+        writer = KVWriter(kv, spill_dir="")
+        writer.submit("uuid", b"result")
+        assert decode_value(writer.get("uuid")) == "result"
+        kv.gate.set()
+        writer.close()
+        assert writer.get("uuid") is None
+        assert decode_value(kv.get("uuid")) == "result"
+
+    def test_full_queue_drops_results(self):
+        kv = FakeKV()
+        kv.gate.clear()
+        writer = KVWriter(kv, queue_size=1, batch_size=1, spill_dir="")
+        results = [writer.submit(f"uuid-{i}", b"result") for i in range(4)]
+        assert not all(results)
+        assert writer.stats()["dropped"] == results.count(False)
+        kv.gate.set()
+        writer.close()
+
+    def test_overflowed_buffers_are_not_written(self):
+        writer = KVWriter(FakeKV(), spill_dir="")
+        buffer = ResultBuffer(max_bytes=2)
+        buffer.append("too long")
+        assert not writer.submit("uuid", buffer)
+        writer.close()
+        assert writer.stats()["too_large"] == 1
+
+    def test_failed_writes_spill_and_are_uploaded_later(self, tmp_path):
+        kv = FakeKV(fail=True)
+        writer = KVWriter(kv, spill_dir=str(tmp_path), idle_interval=0.01)
+        writer.submit("uuid", b"result")
+        writer.close()
+        assert writer.stats()["spilled"] == 1
+        assert decode_value(writer.get("uuid")) == "result"
+
+        # The next writer picks the spilled result up once the KV is back.
+        kv.fail = False
+        writer = KVWriter(kv, spill_dir=str(tmp_path), idle_interval=0.01)
+        for _ in range(200):
+            if "uuid" in kv.values:
+                break
+            threading.Event().wait(0.01)
+        writer.close()
+        assert decode_value(kv.get("uuid")) == "result"
+        assert writer.stats()["unspilled"] == 1
+        assert writer.stats()["spill_files"] == 0
+        assert not list(tmp_path.iterdir())
+
+    def test_results_that_waited_too_long_are_spilled(self, tmp_path):
+        kv = FakeKV()
+        kv.gate.clear()
+        writer = KVWriter(kv, batch_size=1, spill_dir=str(tmp_path), spill_after=0.0)
+        writer.submit("first", b"1")
+        writer.submit("second", b"2")
+        kv.gate.set()
+        writer.close()
+        # With spill_after=0 every result counts as behind, so none waits for the KV.
+        assert writer.stats()["spilled"] >= 1
+        assert decode_value(writer.get("second")) == "2"
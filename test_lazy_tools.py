@@ -0,0 +1,55 @@
+import json
+import subprocess
+import sys
+
+import lazy_tools
+from lazy_tools import TOOL_MODULES, LazyTool, tool_stats
+
+
+class TestLazyTools:
+    """Tests for the community tools imported on first call"""
+
+    def test_specs_are_cached_by_tools_version(self, tmp_path):
+        path = str(tmp_path / "tool_specs.json")
+        tools = lazy_tools.lazy_tools(path)
+        assert [tool.tool_name for tool in tools] == list(TOOL_MODULES)
+        with open(path) as f:
+            cache = json.load(f)
+        assert cache["version"] == lazy_tools._tools_version()
+        assert tools[0].tool_spec == cache["tools"]["calculator"]["spec"]
+
+        cache["version"] = "0.0.0"
+        cache["tools"]["calculator"]["spec"]["description"] = "stale"
+        with open(path, "w") as f:
+            json.dump(cache, f)
+        # A cache written for another version of the tools is rewritten.
+        assert lazy_tools.lazy_tools(path)[0].tool_spec["description"] != "stale"
+
+    def test_building_an_agent_imports_no_tool(self, tmp_path):
+        path = str(tmp_path / "tool_specs.json")
+        lazy_tools.write_spec_cache(path)
+        code = (
+            "import sys; from lazy_tools import lazy_tools; from strands import Agent;"
+            "from strands.models.openai import OpenAIModel;"
+            f"agent = Agent(model=OpenAIModel(client_args={{'api_key': 'k'}}, model_id='m'), tools=lazy_tools({path!r}));"
+            "print(sorted(agent.tool_names), [m for m in sys.modules if m.startswith('strands_tools.') or m == 'sympy'])"
+        )
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        assert out.strip() == "['calculator', 'http_request', 'python_repl'] []"
+
+    def test_first_call_imports_the_tool(self, tmp_path):
+        from strands import Agent
+        from strands.models.openai import OpenAIModel
+
+        tools = lazy_tools.lazy_tools(str(tmp_path / "tool_specs.json"))
+        agent = Agent(model=OpenAIModel(client_args={"api_key": "k"}, model_id="m"), tools=tools, callback_handler=None)
+        result = agent.tool.calculator(expression="2+3*4", record_direct_tool_call=False)
+        assert result["status"] == "success"
+        assert "14" in result["content"][0]["text"]
+        stats = tool_stats(tools)
+        assert stats["calculator"]["loaded"] and stats["calculator"]["calls"] == 1
+        assert stats["calculator"]["load_ms"] is not None
+
+    def test_eager_mode_imports_at_startup(self, tmp_path):
+        tools = lazy_tools.lazy_tools(str(tmp_path / "tool_specs.json"), lazy=False)
+        assert all(isinstance(tool, LazyTool) and tool.loaded for tool in tools)
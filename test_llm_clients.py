@@ -0,0 +1,95 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm_clients
+
+
+class _CompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = (
+            b'{"id": "1", "object": "chat.completion", "created": 0, "model": "stub",'
+            b' "choices": [{"index": 0, "finish_reason": "stop",'
+            b' "message": {"role": "assistant", "content": "hi"}}]}'
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # A server without /models; the connection stays open all the same.
+        body = b'{"error": {"message": "not found"}}'
+        self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_llm():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _CompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+
+
+def _ask(client):
+    return client.chat.completions.create(model="stub", messages=[{"role": "user", "content": "hello"}])
+
+
+class TestLLMClients:
+    """Tests for the shared pooled LLM clients"""
+
+    def test_clients_are_shared_per_endpoint(self):
+        assert llm_clients.get_openai_client("k", "http://a/v1") is llm_clients.get_openai_client("k", "http://a/v1")
+        assert llm_clients.get_openai_client("k", "http://a/v1") is not llm_clients.get_openai_client("k", "http://b/v1")
+        assert llm_clients.get_async_openai_client("k", "http://a/v1") is not llm_clients.get_openai_client("k", "http://a/v1")
+
+    def test_sync_connections_are_reused(self, stub_llm):
+        before = llm_clients.connection_stats.snapshot()
+        client = llm_clients.get_openai_client("k", stub_llm)
+        for _ in range(3):
+            assert _ask(client).choices[0].message.content == "hi"
+        after = llm_clients.connection_stats.snapshot()
+
+        assert after["requests"] - before["requests"] == 3
+        assert after["new_connections"] - before["new_connections"] == 1
+
+    def test_async_connections_are_reused(self, stub_llm):
+        async def run():
+            client = llm_clients.get_async_openai_client("k", stub_llm)
+            for _ in range(3):
+                await client.chat.completions.create(model="stub", messages=[{"role": "user", "content": "hello"}])
+            await llm_clients.close_clients()
+
+        before = llm_clients.connection_stats.snapshot()
+        asyncio.run(run())
+        after = llm_clients.connection_stats.snapshot()
+
+        assert after["requests"] - before["requests"] == 3
+        assert after["new_connections"] - before["new_connections"] == 1
+
+    def test_warmed_connection_serves_the_first_request(self, stub_llm):
+        async def run():
+            client = llm_clients.get_async_openai_client("k", stub_llm)
+            await llm_clients.warm_connection(client)
+            await client.chat.completions.create(model="stub", messages=[{"role": "user", "content": "hello"}])
+            await llm_clients.close_clients()
+
+        before = llm_clients.connection_stats.snapshot()
+        asyncio.run(run())
+        after = llm_clients.connection_stats.snapshot()
+
+        assert after["requests"] - before["requests"] == 2
+        assert after["new_connections"] - before["new_connections"] == 1
@@ -0,0 +1,116 @@
+import json
+import os
+
+import numpy as np
+
+from local_index import LocalIndex, build_index, vbyte_decode, vbyte_encode
+
+DOCS = [
+    {"url": "https://docs.example.com/salute", "name": "Vulcan salute",
+     "text": "The Vulcan salute is a hand gesture from Star Trek.\n\n"
+             "Leonard Nimoy introduced the blessing live long and prosper."},
+    {"url": "https://docs.example.com/pasta", "name": "Pasta",
+     "text": "Boil the pasta in salted water until it is al dente."},
+    {"url": "https://docs.example.com/tea", "name": "Tea",
+     "text": "Steep green tea for two minutes in water below boiling."},
+]
+
+
+def write_jsonl(path, docs):
+    with open(path, "w") as f:
+        for doc in docs:
+            f.write(json.dumps(doc) + "\n")
+
+
+def segment_dirs(index_dir):
+    return sorted(d for d in os.listdir(index_dir) if os.path.isdir(os.path.join(index_dir, d)))
+
+
+class TestVByte:
+    """Tests for the variable-byte postings codec"""
+
+    def test_round_trip(self):
+        values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2**31 - 1])
+        assert vbyte_decode(vbyte_encode(values)).tolist() == values.tolist()
+
+
+class TestBuildAndSearch:
+    """Tests for building an index and searching it"""
+
+    def test_search_returns_contexts_with_relevant_snippets(self, tmp_path):
+        source, index_dir = tmp_path / "docs.jsonl", str(tmp_path / "index")
+        write_jsonl(source, DOCS)
+        assert build_index(str(source), index_dir) == {"added": 3}
+
+        results = LocalIndex(index_dir).search("who said live long and prosper", limit=2)
+
+        assert results[0]["url"] == "https://docs.example.com/salute"
+        assert results[0]["name"] == "Vulcan salute"
+        assert "live long and prosper" in results[0]["snippet"]
+        assert LocalIndex(index_dir).search("quantum chromodynamics") == []
+
+    def test_rebuild_is_incremental(self, tmp_path):
+        source, index_dir = tmp_path / "docs.jsonl", str(tmp_path / "index")
+        write_jsonl(source, DOCS)
+        build_index(str(source), index_dir)
+        assert build_index(str(source), index_dir) == {"unchanged": 3}
+
+        changed = [DOCS[0], dict(DOCS[1], text="Bake the bread at two hundred degrees.")]
+        write_jsonl(source, changed)
+        assert build_index(str(source), index_dir) == {"unchanged": 1, "updated": 1, "removed": 1}
+
+        index = LocalIndex(index_dir)
+        assert index.search("boil salted") == []
+        assert index.search("steep") == []
+        assert [r["url"] for r in index.search("bread")] == ["https://docs.example.com/pasta"]
+        assert index.stats()["documents"] == 2
+
+    def test_running_index_picks_up_rebuilds(self, tmp_path):
+        source, index_dir = tmp_path / "docs.jsonl", str(tmp_path / "index")
+        write_jsonl(source, DOCS[:1])
+        build_index(str(source), index_dir)
+        index = LocalIndex(index_dir, reload_interval=0)
+        assert index.search("pasta") == []
+
+        write_jsonl(source, DOCS)
+        build_index(str(source), index_dir)
+
+        assert [r["name"] for r in index.search("pasta")] == ["Pasta"]
+        assert index.reloads == 2
+
+    def test_segments_are_merged(self, tmp_path):
+        source, index_dir = tmp_path / "docs.jsonl", str(tmp_path / "index")
+        for i in range(3):
+            write_jsonl(source, DOCS[:i + 1])
+            build_index(str(source), index_dir, max_segments=8)
+        assert len(segment_dirs(index_dir)) == 3
+        old_reader = LocalIndex(index_dir, reload_interval=3600)
+
+        write_jsonl(source, DOCS[1:])
+        counts = build_index(str(source), index_dir, max_segments=2)
+
+        assert counts["merged"] == 3
+        assert len(segment_dirs(index_dir)) == 1
+        assert [r["name"] for r in LocalIndex(index_dir).search("tea")] == ["Tea"]
+        assert LocalIndex(index_dir).search("vulcan") == []
+        # A reader that still maps the merged-away segments keeps serving them.
+        assert [r["name"] for r in old_reader.search("vulcan")] == ["Vulcan salute"]
+
+    def test_directory_source(self, tmp_path):
+        corpus, index_dir = tmp_path / "corpus", str(tmp_path / "index")
+        corpus.mkdir()
+        (corpus / "notes.md").write_text("Green tea should steep for two minutes.")
+        (corpus / "recipe.html").write_text(
+            "<html><head><title>Weeknight pasta</title></head><body><nav>Home About</nav>"
+            "<p>Boil the pasta in well salted water and finish it in the sauce for a minute.</p></body></html>"
+        )
+        (corpus / "image.png").write_bytes(b"\x89PNG")
+        build_index(str(corpus), index_dir, url_prefix="https://notes.example.com/")
+
+        results = LocalIndex(index_dir).search("pasta sauce")
+
+        assert results == [{
+            "name": "Weeknight pasta",
+            "url": "https://notes.example.com/recipe.html",
+            "snippet": "Boil the pasta in well salted water and finish it in the sauce for a minute.",
+        }]
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from metrics import Registry, register_prometheus_collector, search_latency
+
+
+class TestRegistry:
+    """Tests for lock-free metrics in the Prometheus text format"""
+
+    def test_counter(self):
+        metrics = Registry()
+        counter = metrics.counter("cache_hits_total", "Cache hits.", ["cache"])
+        counter.inc("search")
+        counter.inc("search")
+        counter.inc("answer", amount=3)
+        assert metrics.render() == (
+            "# HELP evidence_search_cache_hits_total Cache hits.\n"
+            "# TYPE evidence_search_cache_hits_total counter\n"
+            'evidence_search_cache_hits_total{cache="answer"} 3\n'
+            'evidence_search_cache_hits_total{cache="search"} 2\n'
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        metrics = Registry()
+        histogram = metrics.histogram("latency_seconds", "Latency.", ["backend"], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, "serper")
+        lines = metrics.render().splitlines()
+        assert lines[2:] == [
+            'evidence_search_latency_seconds_bucket{backend="serper",le="0.1"} 2',
+            'evidence_search_latency_seconds_bucket{backend="serper",le="1"} 3',
+            'evidence_search_latency_seconds_bucket{backend="serper",le="+Inf"} 4',
+            'evidence_search_latency_seconds_sum{backend="serper"} 2.65',
+            'evidence_search_latency_seconds_count{backend="serper"} 4',
+        ]
+
+    def test_label_values_are_escaped(self):
+        metrics = Registry()
+        metrics.counter("errors_total", "Errors.", ["stage"]).inc('a "b"\n')
+        assert 'stage="a \\"b\\"\\n"' in metrics.render()
+
+    def test_threads_record_into_their_own_shards(self):
+        metrics = Registry()
+        counter = metrics.counter("calls_total", "Calls.")
+        histogram = metrics.histogram("wait_seconds", "Waits.")
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+                histogram.observe(0.01)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.values() == {(): 8000}
+        cumulative, total = histogram.values()[()]
+        assert cumulative[-1] == 8000
+        assert len(counter._shards) == 8
+
+    def test_prometheus_client_collector(self):
+        prometheus_client = pytest.importorskip("prometheus_client")
+
+        assert register_prometheus_collector()
+        assert register_prometheus_collector()  # only registered once
+        search_latency.observe(0.2, "test-backend")
+        assert b'evidence_search_search_latency_seconds_count{backend="test-backend"} 1.0' in prometheus_client.generate_latest()
@@ -0,0 +1,205 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import page_fetcher
+from page_fetcher import PageFetcher, extract_main_text, select_passages
+
+ARTICLE = """<html><head><title>Vulcan salute</title><script>var tracking = "live long and prosper";</script></head>
+<body>
+<nav><a href="/">Home</a> <a href="/news">News</a> <a href="/about">About us and our long history</a></nav>
+<header>Site header with a long tagline about many unrelated things</header>
+<article>
+<h1>The Vulcan salute</h1>
+<p>The Vulcan salute is a hand gesture popularized by the 1960s television series Star Trek.</p>
+<p>Leonard Nimoy introduced the gesture and its blessing, live long and prosper, in the episode Amok Time.</p>
+<p>Other unrelated material about the production schedule of the series fills this paragraph.</p>
+</article>
+<footer>Copyright notice and other boilerplate that is long enough to count</footer>
+</body></html>"""
+
+
+class _Fixture(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    active = 0
+    max_active = 0
+    requests = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with _Fixture.lock:
+            _Fixture.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path.startswith("/slow"):
+            time.sleep(1.0)
+        if self.path.startswith("/busy"):
+            with _Fixture.lock:
+                _Fixture.active += 1
+                _Fixture.max_active = max(_Fixture.max_active, _Fixture.active)
+            time.sleep(0.1)
+            with _Fixture.lock:
+                # Before responding, so that the client's next request never overlaps.
+                _Fixture.active -= 1
+        self._respond()
+
+    def _respond(self):
+        if self.path == "/article" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content_type = "text/html; charset=utf-8"
+        body = ARTICLE.encode()
+        if self.path == "/big":
+            body = b"<p>" + b"live long and prosper. " * 100000 + b"</p>"
+        elif self.path == "/file.pdf":
+            content_type, body = "application/pdf", b"%PDF-1.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    _Fixture.requests, _Fixture.max_active = [], 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Fixture)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = PageFetcher(top_k=4, deadline=0.5, per_host=2, passages=1, allow_private_hosts=True)
+    yield fetcher
+    fetcher.close()
+
+
+def context(url, snippet="Short snippet."):
+    return {"name": "n", "url": url, "snippet": snippet}
+
+
+class TestExtraction:
+    """Tests for main-text extraction and passage selection"""
+
+    def test_drops_boilerplate(self):
+        paragraphs = extract_main_text(ARTICLE)
+        assert any("Amok Time" in p for p in paragraphs)
+        text = " ".join(paragraphs)
+        assert "tracking" not in text
+        assert "About us" not in text
+        assert "Site header" not in text
+        assert "Copyright" not in text
+
+    def test_selects_relevant_passages_in_page_order(self):
+        passages = select_passages("who said live long and prosper", extract_main_text(ARTICLE), limit=1)
+        assert passages == ["Leonard Nimoy introduced the gesture and its blessing, live long and prosper, in the episode Amok Time."]
+        assert select_passages("quantum chromodynamics", extract_main_text(ARTICLE), limit=2) == []
+
+
+class TestPageFetcher:
+    """Tests for fetching pages from a local fixture server"""
+
+    def test_enriches_snippets(self, site, fetcher):
+        contexts = [context(f"{site}/article"), context(f"{site}/file.pdf")]
+        enriched = fetcher.enrich_sync("live long and prosper", contexts)
+
+        assert enriched[0]["snippet"].startswith("Short snippet. Leonard Nimoy")
+        assert enriched[1] == contexts[1]
+        assert contexts[0]["snippet"] == "Short snippet."
+        assert fetcher.stats()["skipped"] == 1
+
+    def test_slow_pages_do_not_exceed_deadline(self, site, fetcher):
+        contexts = [context(f"{site}/slow"), context(f"{site}/article")]
+        start = time.monotonic()
+        enriched = fetcher.enrich_sync("live long and prosper", contexts)
+
+        assert time.monotonic() - start < 0.9
+        assert enriched[0] == contexts[0]
+        assert "Nimoy" in enriched[1]["snippet"]
+        assert fetcher.stats()["timeouts"] == 1
+
+    def test_per_host_limit(self, site):
+        fetcher = PageFetcher(top_k=6, deadline=2, per_host=2, passages=1, allow_private_hosts=True)
+        try:
+            fetcher.enrich_sync("prosper", [context(f"{site}/busy{i}") for i in range(6)])
+        finally:
+            fetcher.close()
+        assert len(_Fixture.requests) == 6
+        assert _Fixture.max_active == 2
+
+    def test_byte_cap(self, site):
+        fetcher = PageFetcher(top_k=1, deadline=2, max_bytes=16 * 1024, passages=1, allow_private_hosts=True)
+        try:
+            enriched = fetcher.enrich_sync("prosper", [context(f"{site}/big")])
+        finally:
+            fetcher.close()
+        assert "prosper" in enriched[0]["snippet"]
+        assert fetcher.stats()["bytes"] == 16 * 1024
+        assert fetcher.stats()["truncated"] == 1
+
+    def test_cache_and_revalidation(self, site, fetcher):
+        contexts = [context(f"{site}/article")]
+        first = fetcher.enrich_sync("prosper", contexts)
+        assert fetcher.enrich_sync("prosper", contexts) == first
+        assert len(_Fixture.requests) == 1
+
+        fetcher.cache_ttl = 0
+        assert fetcher.enrich_sync("prosper", contexts) == first
+        assert _Fixture.requests[-1] == ("/article", '"v1"')
+        assert fetcher.stats()["not_modified"] == 1
+        assert fetcher.stats()["cache_hits"] == 1
+
+    def test_async_callers(self, site, fetcher):
+        async def run():
+            return await asyncio.gather(*[
+                fetcher.enrich("prosper", [context(f"{site}/article")]) for _ in range(3)
+            ])
+
+        assert all("Nimoy" in enriched[0]["snippet"] for enriched in asyncio.run(run()))
+
+    def test_private_hosts_are_not_fetched(self, site):
+        fetcher = PageFetcher(top_k=2, deadline=2, passages=1)
+        try:
+            contexts = [context(f"{site}/article"), context("http://169.254.169.254/latest/meta-data/")]
+            assert fetcher.enrich_sync("prosper", contexts) == contexts
+        finally:
+            fetcher.close()
+        assert _Fixture.requests == []
+        assert fetcher.stats()["blocked"] == 2
+
+    def test_redirects_to_private_hosts_are_not_followed(self, monkeypatch):
+        requested = []
+
+        def handler(request):
+            requested.append(str(request.url))
+            if request.url.host == "public.example":
+                return httpx.Response(302, headers={"Location": "http://127.0.0.1/admin"})
+            return httpx.Response(200, text="<p>live long and prosper</p>", headers={"Content-Type": "text/html"})
+
+        async def resolve(host):
+            return ["93.184.216.34"]
+
+        monkeypatch.setattr(page_fetcher, "_resolve", resolve)
+        fetcher = PageFetcher(top_k=1, deadline=2, passages=1)
+        fetcher._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            contexts = [context("https://public.example/page")]
+            assert fetcher.enrich_sync("prosper", contexts) == contexts
+        finally:
+            fetcher.close()
+        assert requested == ["https://public.example/page"]
+        assert fetcher.stats()["blocked"] == 1
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+
+from prompt_layout import PromptCacheStats, PromptUsage, add_usage, parse_usage, split_prompt
+
+TEMPLATE = """
+Answer the question.
+
+Cite the contexts.
+
+Here are the contexts:
+
+{context}
+
+Here is the question:
+"""
+
+
+class TestSplitPrompt:
+    """Tests for splitting a template into static system prompt and user message"""
+
+    def test_static_instructions_go_to_the_system_prompt(self):
+        layout = split_prompt(TEMPLATE)
+        assert layout.system == "Answer the question.\n\nCite the contexts."
+        assert layout.context_intro == "Here are the contexts:"
+        assert layout.query_intro == "Here is the question:"
+
+    def test_user_message_has_contexts_then_query(self):
+        messages = split_prompt(TEMPLATE).messages("[[citation:1]] a {snippet}", "why?")
+        assert [m["role"] for m in messages] == ["system", "user"]
+        assert messages[1]["content"] == "Here are the contexts:\n\n[[citation:1]] a {snippet}\n\nHere is the question:\nwhy?"
+
+    @pytest.mark.parametrize("template", ["No placeholder.", "{context}", "A\n\n{context} and {context}"])
+    def test_rejects_malformed_templates(self, template):
+        with pytest.raises(ValueError):
+            split_prompt(template)
+
+
+class TestUsage:
+    """Tests for reading cached prompt tokens from usage reports"""
+
+    def test_strands_usage(self):
+        usage = {"inputTokens": 1200, "outputTokens": 30, "totalTokens": 1230, "cacheReadInputTokens": 1024}
+        assert parse_usage(usage) == PromptUsage(1200, 1024)
+
+    def test_strands_usage_with_cache_reported_apart(self):
+        usage = {"inputTokens": 176, "outputTokens": 30, "totalTokens": 1230, "cacheReadInputTokens": 1024}
+        assert parse_usage(usage) == PromptUsage(1200, 1024)
+
+    def test_openai_usage(self):
+        usage = SimpleNamespace(prompt_tokens=1500, prompt_tokens_details=SimpleNamespace(cached_tokens=1280))
+        assert parse_usage(usage) == PromptUsage(1500, 1280)
+        assert parse_usage(SimpleNamespace(prompt_tokens=10, prompt_tokens_details=None)) == PromptUsage(10, 0)
+
+    def test_missing_usage(self):
+        assert parse_usage(None) is None
+        assert parse_usage({}) is None
+        assert add_usage(None, None) is None
+
+    def test_add_usage_over_cycles(self):
+        total = add_usage(None, {"inputTokens": 100, "cacheReadInputTokens": 60})
+        total = add_usage(total, {"inputTokens": 150, "cacheReadInputTokens": 100})
+        assert total == PromptUsage(250, 160)
+        assert total.uncached_tokens == 90
+
+
+class TestPromptCacheStats:
+    """Tests for the cached token counters"""
+
+    def test_totals_per_kind(self):
+        stats = PromptCacheStats(history=2)
+        stats.record("answer", {"inputTokens": 1000})
+        stats.record("answer", {"inputTokens": 1000, "cacheReadInputTokens": 768})
+        stats.record("answer", {"inputTokens": 1000, "cacheReadInputTokens": 896})
+        stats.record("related", None)
+
+        answer = stats.stats()["answer"]
+        assert answer["requests"] == 3
+        assert answer["requests_with_cache_hits"] == 2
+        assert answer["cached_tokens"] == 1664
+        assert answer["uncached_tokens"] == 1336
+        assert "related" not in stats.stats()
+        assert stats.recent("answer") == [PromptUsage(1000, 768), PromptUsage(1000, 896)]
@@ -0,0 +1,69 @@
+import asyncio
+import zlib
+
+from starlette.datastructures import Headers
+
+from replay_response import accepts_deflate, content_digest, inflate, iter_chunks, replay_response
+
+RESULT = '[]\n\n__LLM_RESPONSE__\n\nThe answer — with ünïcode. ' * 100
+
+
+def body(response) -> bytes:
+    async def read():
+        return b"".join([
+            chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+            async for chunk in response.body_iterator
+        ])
+
+    return asyncio.run(read())
+
+
+class TestReplayResponse:
+    """Tests for conditional, precompressed replays"""
+
+    def setup_method(self):
+        self.compressed = zlib.compress(RESULT.encode("utf-8"))
+        self.digest = content_digest(self.compressed)
+
+    def test_inflate_across_chunk_boundaries(self):
+        assert "".join(inflate(iter_chunks(self.compressed, size=7))) == RESULT
+
+    def test_accept_encoding(self):
+        assert accepts_deflate("gzip, deflate, br")
+        assert accepts_deflate("*")
+        assert not accepts_deflate("gzip;q=1.0, deflate;q=0")
+        assert not accepts_deflate("identity")
+        assert not accepts_deflate("")
+        assert not accepts_deflate("deflate;q=abc")
+
+    def test_stored_bytes_are_sent_as_they_are(self):
+        response = replay_response(
+            self.digest, iter_chunks(self.compressed, size=64), Headers({"accept-encoding": "gzip, deflate"})
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "deflate"
+        assert response.headers["etag"] == f'W/"{self.digest}"'
+        assert body(response) == self.compressed
+
+    def test_decompressed_for_other_clients(self):
+        response = replay_response(self.digest, iter_chunks(self.compressed), Headers({}))
+        assert "content-encoding" not in response.headers
+        assert body(response).decode("utf-8") == RESULT
+
+    def test_framed_formats_are_decompressed(self):
+        response = replay_response(
+            self.digest, iter_chunks(self.compressed), Headers({"accept-encoding": "deflate"}), "ndjson"
+        )
+        assert "content-encoding" not in response.headers
+        assert body(response).startswith(b'{"type": "contexts"')
+
+    def test_if_none_match(self):
+        for if_none_match in [f'W/"{self.digest}"', f'"{self.digest}"', f'"other", W/"{self.digest}"', "*"]:
+            response = replay_response(
+                self.digest, iter_chunks(self.compressed), Headers({"if-none-match": if_none_match})
+            )
+            assert response.status_code == 304
+            assert response.headers["etag"] == f'W/"{self.digest}"'
+            assert body(response) == b""
+        response = replay_response(self.digest, iter_chunks(self.compressed), Headers({"if-none-match": '"other"'}))
+        assert response.status_code == 200
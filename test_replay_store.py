@@ -0,0 +1,94 @@
+import sqlite3
+import zlib
+
+from replay_response import content_digest
+from replay_store import ReplayStore
+
+
+RESULT = '[{"name": "Test"}]\n\n__LLM_RESPONSE__\n\nThe answer — with ünïcode. ' * 200
+
+
+class TestReplayStore:
+    """Tests for the local search_uuid replay store"""
+
+    def test_round_trip_streams_in_chunks(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"), chunk_size=64)
+        store.put("uuid-1", RESULT)
+
+        chunks = list(store.open_stream("uuid-1"))
+
+        assert len(chunks) > 1
+        assert "".join(chunks) == RESULT
+        assert store.stats()["hits"] == 1
+
+    def test_missing_uuid(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"))
+        assert store.open_stream("missing") is None
+        assert store.stats()["misses"] == 1
+
+    def test_entries_are_compressed(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"))
+        store.put("uuid-1", RESULT)
+        assert store.stats()["bytes"] < len(RESULT.encode("utf-8")) / 10
+
+    def test_evicts_least_recently_replayed(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"))
+        store.put("a", RESULT)
+        store.max_bytes = store.stats()["bytes"] * 2 + 64
+        store.put("b", RESULT + "b")
+        store.get("a")
+        store.put("c", RESULT + "c")
+
+        assert store.get("b") is None
+        assert store.get("a") == RESULT
+        assert store.get("c") == RESULT + "c"
+        assert store.stats()["evictions"] == 1
+
+    def test_persists_across_reopen(self, tmp_path):
+        path = str(tmp_path / "replays.db")
+        store = ReplayStore(path)
+        store.put("uuid-1", RESULT)
+        store.close()
+
+        reopened = ReplayStore(path)
+        assert reopened.get("uuid-1") == RESULT
+        assert reopened.stats()["bytes"] > 0
+
+    def test_compressed_chunks_and_digest(self, tmp_path):
+        store = ReplayStore(str(tmp_path / "replays.db"), chunk_size=64)
+        store.put("uuid-1", RESULT)
+        digest, chunks = store.open_compressed("uuid-1")
+        data = b"".join(chunks)
+        assert zlib.decompress(data).decode("utf-8") == RESULT
+        assert digest == content_digest(data)
+
+    def test_digests_are_filled_in_for_older_stores(self, tmp_path):
+        path = str(tmp_path / "replays.db")
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE replays (search_uuid TEXT PRIMARY KEY, data BLOB NOT NULL,"
+            " size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        data = zlib.compress(RESULT.encode("utf-8"))
+        conn.execute("INSERT INTO replays VALUES (?, ?, ?, ?)", ("old", data, len(RESULT), 0.0))
+        conn.commit()
+        conn.close()
+
+        store = ReplayStore(path)
+        assert store.open_compressed("old")[0] == content_digest(data)
+        assert store.get("old") == RESULT
+        store.put("new", RESULT)
+        assert store.get("new") == RESULT
+
+    def test_processes_share_the_size_cap(self, tmp_path):
+        path = str(tmp_path / "replays.db")
+        size = len(zlib.compress(RESULT.encode("utf-8")))
+        first = ReplayStore(path, max_bytes=int(size * 2.5))
+        second = ReplayStore(path, max_bytes=int(size * 2.5))
+        first.put("uuid-1", RESULT)
+        second.put("uuid-2", RESULT)
+        first.put("uuid-3", RESULT)
+
+        assert second.stats()["entries"] == 2
+        assert second.stats()["bytes"] == 2 * size
+        assert first.get("uuid-1") is None
@@ -0,0 +1,68 @@
+import time
+
+from benchmarks.bench_reranker import make_candidates
+from reranker import LexicalReranker, parse_domain_priors, term_frequencies
+
+
+def context(name, snippet, url="https://example.com/page"):
+    return {"name": name, "url": url, "snippet": snippet}
+
+
+class TestTermFrequencies:
+    """Tests for whole-word term counting"""
+
+    def test_counts_whole_words_case_insensitively(self):
+        tf, lengths = term_frequencies(
+            ["and", "live", "über"],
+            ["Live and and grand, live-long.", "über alles; ÜBER!", "x_and and_x"],
+        )
+        assert tf.tolist() == [[2, 2, 0], [0, 0, 2], [0, 0, 0]]
+        assert lengths.shape == (3,)
+
+
+class TestLexicalReranker:
+    """Tests for reranking an over-fetched candidate pool"""
+
+    def test_relevant_candidates_move_up(self):
+        candidates = [context(f"Unrelated {i}", "Cooking recipes and kitchen tips.") for i in range(9)]
+        candidates.append(context("Live long and prosper", "Spock says live long and prosper in Star Trek."))
+
+        reranked = LexicalReranker(limit=3).rerank("who said live long and prosper", candidates)
+
+        assert len(reranked) == 3
+        assert reranked[0] is candidates[-1]
+        assert reranked[1:] == candidates[:2]
+
+    def test_provider_order_without_matches(self):
+        candidates = [context(f"Result {i}", "Nothing relevant here.") for i in range(5)]
+        assert LexicalReranker(limit=3).rerank("quantum chromodynamics", candidates) == candidates[:3]
+        assert LexicalReranker(limit=3).rerank("", candidates) == candidates[:3]
+
+    def test_domain_priors(self):
+        candidates = [
+            context("Prosper", "live long and prosper", "https://spam.example.net/a"),
+            context("Prosper", "live long and prosper", "https://en.wikipedia.org/wiki/Vulcan_salute"),
+        ]
+        priors = parse_domain_priors("wikipedia.org=1.5, example.net=0.5")
+        assert priors == {"wikipedia.org": 1.5, "example.net": 0.5}
+
+        reranked = LexicalReranker(limit=2, domain_priors=priors).rerank("live long and prosper", candidates)
+        assert reranked[0] is candidates[1]
+
+    def test_reads_raw_google_items(self):
+        items = [
+            {"title": "Cooking", "link": "https://a.com", "snippet": "Recipes."},
+            {"title": "Vulcan salute", "link": "https://b.com", "snippet": "Live long and prosper."},
+        ]
+        assert LexicalReranker(limit=1).rerank("live long and prosper", items) == [items[1]]
+
+    def test_fifty_candidates_under_a_millisecond(self):
+        import random
+
+        candidates = make_candidates("who said live long and prosper", 50, random.Random(0))
+        reranker = LexicalReranker(limit=8, domain_priors={"example.com": 1.1})
+        reranker.rerank("who said live long and prosper", candidates)
+        start = time.perf_counter()
+        for _ in range(200):
+            reranker.rerank("who said live long and prosper", candidates)
+        assert (time.perf_counter() - start) / 200 < 0.001
@@ -0,0 +1,230 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from resilience import (
+    CircuitBreaker, CircuitOpen, Deadline, DeadlineExceeded, RetryBudget, Upstream, deadline_scope,
+    is_retryable, timeout_for,
+)
+
+
+def make_upstream(**kwargs):
+    kwargs = {"max_attempts": 3, "base_delay": 0.001, "max_delay": 0.001, "failure_threshold": 3,
+              "reset_timeout": 0.05, **kwargs}
+    return Upstream("test", **kwargs)
+
+
+class Flaky:
+    """Fails with `errors` in turn, then returns "ok"."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class TestDeadline:
+    """Tests for the request deadline"""
+
+    def test_timeout_for_is_capped_by_the_deadline(self):
+        assert timeout_for(5) == 5
+        with deadline_scope(1.0):
+            assert 0.9 < timeout_for(5) <= 1.0
+            assert timeout_for(0.5) == 0.5
+            # A nested scope never extends the request's deadline.
+            with deadline_scope(30):
+                assert timeout_for(5) <= 1.0
+        assert timeout_for(None) is None
+
+    def test_expired_deadline_raises(self):
+        with deadline_scope(Deadline(-1)):
+            with pytest.raises(DeadlineExceeded):
+                timeout_for(5)
+
+
+class TestRetryable:
+    """Tests for which errors are worth a retry"""
+
+    def test_classification(self):
+        assert is_retryable(HTTPException(502, "Search engine error."))
+        assert is_retryable(HTTPException(429, "slow down"))
+        assert is_retryable(httpx.ConnectError("refused"))
+        assert is_retryable(TimeoutError())
+        assert not is_retryable(HTTPException(401, "bad key"))
+        assert not is_retryable(ValueError("bad response"))
+        assert not is_retryable(DeadlineExceeded())
+
+
+class TestRetryBudget:
+    """Tests for the retry budget"""
+
+    def test_retries_are_a_fraction_of_calls(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=1)
+        assert budget.withdraw()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+        assert (budget.retries, budget.exhausted) == (2, 2)
+
+
+class TestCircuitBreaker:
+    """Tests for the circuit breaker"""
+
+    def test_opens_after_consecutive_failures_and_recovers(self):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpen) as e:
+            breaker.allow()
+        assert e.value.headers == {"Retry-After": "1"}
+
+        time.sleep(0.06)
+        breaker.allow()  # the probe
+        with pytest.raises(CircuitOpen):
+            breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.stats()["opens"] == 1
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpen):
+            breaker.check()
+
+    def test_lost_probe_is_replaced(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        breaker.allow()  # never reports back
+        time.sleep(0.06)
+        breaker.allow()
+
+
+class TestUpstream:
+    """Tests for retries behind a circuit breaker"""
+
+    def test_retryable_failures_are_retried(self):
+        upstream = make_upstream()
+        fn = Flaky(HTTPException(502, "error"), httpx.ReadTimeout("slow"))
+        assert upstream.call_sync(fn) == "ok"
+        assert fn.calls == 3
+        assert upstream.stats()["retries"] == 2
+        assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+    def test_client_errors_are_not_retried(self):
+        upstream = make_upstream()
+        fn = Flaky(HTTPException(401, "bad key"))
+        with pytest.raises(HTTPException):
+            upstream.call_sync(fn)
+        assert fn.calls == 1
+        assert upstream.stats()["failures"] == 0
+
+    def test_no_retry_without_deadline_left(self):
+        upstream = make_upstream(base_delay=1.0, max_delay=1.0)
+        fn = Flaky(HTTPException(503, "unavailable"))
+        with deadline_scope(0.001):
+            with pytest.raises(HTTPException):
+                upstream.call_sync(fn)
+        assert fn.calls == 1
+
+    def test_retry_budget_caps_retries(self):
+        upstream = make_upstream()
+        upstream.budget = RetryBudget(ratio=0, max_tokens=1)
+        fn = Flaky(HTTPException(503, "a"), HTTPException(503, "b"))
+        with pytest.raises(HTTPException):
+            upstream.call_sync(fn)
+        assert fn.calls == 2
+        assert upstream.stats()["retry_budget_exhausted"] == 1
+
+    def test_open_breaker_fails_fast(self):
+        upstream = make_upstream(max_attempts=1)
+        for _ in range(3):
+            with pytest.raises(HTTPException):
+                upstream.call_sync(Flaky(HTTPException(500, "down")))
+        fn = Flaky()
+        with pytest.raises(CircuitOpen):
+            upstream.call_sync(fn)
+        assert fn.calls == 0
+
+        time.sleep(0.06)
+        assert upstream.call_sync(fn) == "ok"
+        assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+    def test_async_call(self):
+        upstream = make_upstream()
+        flaky = Flaky(ConnectionError("reset"))
+
+        async def fn():
+            return flaky()
+
+        assert asyncio.run(upstream.call(fn)) == "ok"
+        assert flaky.calls == 2
+
+    def test_stream_is_retried_only_before_its_first_item(self):
+        upstream = make_upstream(failure_threshold=10)
+        starts = []
+
+        def factory(fail_after):
+            async def stream():
+                starts.append(fail_after)
+                for i in range(fail_after):
+                    yield i
+                raise HTTPException(502, "stream broke")
+            return stream
+
+        async def collect(stream):
+            items = []
+            try:
+                async for item in stream:
+                    items.append(item)
+            except HTTPException:
+                items.append("error")
+            return items
+
+        attempts = iter([0, 0, 5])
+        assert asyncio.run(collect(upstream.stream(lambda: factory(next(attempts))()))) == [0, 1, 2, 3, 4, "error"]
+        assert starts == [0, 0, 5]
+
+        starts.clear()
+        assert asyncio.run(collect(upstream.stream(factory(2)))) == [0, 1, "error"]
+        assert starts == [2]
+
+    def test_stream_waits_are_bounded_by_the_deadline(self):
+        upstream = make_upstream(max_attempts=1)
+
+        async def stalled():
+            yield "first"
+            await asyncio.sleep(10)
+            yield "never"
+
+        async def run():
+            items = []
+            with deadline_scope(0.1):
+                with pytest.raises(DeadlineExceeded):
+                    async for item in upstream.stream(stalled):
+                        items.append(item)
+            return items
+
+        start = time.monotonic()
+        assert asyncio.run(run()) == ["first"]
+        assert time.monotonic() - start < 1
+        assert upstream.stats()["failures"] == 1
@@ -0,0 +1,132 @@
+from unittest.mock import patch
+
+import pytest
+
+from search_cache import LRUSearchCache, NullSearchCache, SearchCache, SqliteSearchCache, normalize_query
+
+
+CONTEXTS = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+
+
+class TestNormalizeQuery:
+    """Tests for cache key normalization"""
+
+    def test_case_whitespace_and_inst_tags(self):
+        assert normalize_query("  Who said [INST]Live  Long\tand Prosper?[/INST] ") == "who said live long and prosper?"
+
+
+class TestLRUSearchCache:
+    """Tests for the TTL + LRU search cache"""
+
+    def test_hit_after_put_with_normalized_key(self):
+        cache = LRUSearchCache(max_entries=4)
+        assert cache.get("Test Query") is None
+        cache.put("Test Query", CONTEXTS)
+
+        assert cache.get("  test   QUERY ") == CONTEXTS
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_returns_copies(self):
+        cache = LRUSearchCache()
+        cache.put("q", CONTEXTS)
+        cache.get("q")[0]["snippet"] = "changed"
+        assert cache.get("q") == CONTEXTS
+
+    def test_ttl_expiry(self):
+        cache = LRUSearchCache(ttl=10)
+        with patch("search_cache.time.time", return_value=1000.0):
+            cache.put("q", CONTEXTS)
+        with patch("search_cache.time.time", return_value=1011.0):
+            assert cache.get("q") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_lru_eviction(self):
+        cache = LRUSearchCache(max_entries=2)
+        cache.put("a", CONTEXTS)
+        cache.put("b", CONTEXTS)
+        cache.get("a")
+        cache.put("c", CONTEXTS)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == CONTEXTS
+        assert cache.stats()["evictions"] == 1
+
+    def test_empty_results_are_not_cached(self):
+        cache = LRUSearchCache()
+        cache.put("q", [])
+        assert cache.get("q") is None
+
+    def test_persistence_round_trip(self, tmp_path):
+        path = str(tmp_path / "search-cache.json")
+        cache = LRUSearchCache(path=path)
+        cache.put("q", CONTEXTS)
+        cache.save()
+
+        assert LRUSearchCache(path=path).get("q") == CONTEXTS
+
+    def test_cached_wrapper_calls_search_once(self):
+        calls = []
+
+        def search(query):
+            calls.append(query)
+            return CONTEXTS
+
+        cached_search = LRUSearchCache().cached(search)
+        assert cached_search("Q") == CONTEXTS
+        assert cached_search("q") == CONTEXTS
+        assert calls == ["Q"]
+
+    def test_null_cache_never_hits(self):
+        cache = NullSearchCache()
+        cache.put("q", CONTEXTS)
+        assert cache.get("q") is None
+
+    def test_caches_must_implement_get_and_put(self):
+        class GetOnlyCache(SearchCache):
+            def get(self, query):
+                return None
+
+        with pytest.raises(TypeError):
+            GetOnlyCache()
+
+
+class TestSqliteSearchCache:
+    """Tests for the search cache shared between processes"""
+
+    def test_entries_are_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / "shared.db")
+        writer = SqliteSearchCache(path, namespace="serper")
+        reader = SqliteSearchCache(path, namespace="serper")
+        other_backend = SqliteSearchCache(path, namespace="bing")
+        writer.put("Live  Long", CONTEXTS)
+
+        assert reader.get("live long") == CONTEXTS
+        assert other_backend.get("live long") is None
+        assert reader.stats()["hits"] == 1
+
+    def test_ttl_expiry(self, tmp_path):
+        cache = SqliteSearchCache(str(tmp_path / "shared.db"), ttl=10)
+        with patch("search_cache.time.time", return_value=1000.0):
+            cache.put("query", CONTEXTS)
+        with patch("search_cache.time.time", return_value=1011.0):
+            assert cache.get("query") is None
+
+    def test_least_recently_used_are_evicted(self, tmp_path):
+        cache = SqliteSearchCache(str(tmp_path / "shared.db"), max_entries=2)
+        with patch("search_cache.time.time", return_value=1000.0):
+            cache.put("a", CONTEXTS)
+        with patch("search_cache.time.time", return_value=1001.0):
+            cache.put("b", CONTEXTS)
+        with patch("search_cache.time.time", return_value=1002.0):
+            assert cache.get("a") is not None
+        with patch("search_cache.time.time", return_value=1003.0):
+            cache.put("c", CONTEXTS)
+            assert cache.get("b") is None
+            assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_empty_results_are_not_cached(self, tmp_path):
+        cache = SqliteSearchCache(str(tmp_path / "shared.db"))
+        cache.put("query", [])
+        assert cache.get("query") is None
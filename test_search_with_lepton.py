@@ -0,0 +1,38 @@
+from search_with_lepton import RAG, _llm_error_prefix
+from tracing import Tracer
+
+
+class RecordingKVWriter:
+    def __init__(self):
+        self.submitted = {}
+
+    def submit(self, key, result):
+        self.submitted[key] = bytes(result.data)
+        return True
+
+
+def _rag():
+    # The streaming methods only need the tracer and the KV writer.
+    rag = RAG.__new__(RAG)
+    rag.tracer = Tracer(buffer_size=8)
+    rag.kv_writer = RecordingKVWriter()
+    return rag
+
+
+class TestStreamAndUploadToKV:
+    """Tests for streaming RAG answers and keeping them in the KV"""
+
+    def test_failed_llm_call_streams_the_error_and_is_not_kept(self):
+        rag = _rag()
+
+        def llm_response():
+            raise RuntimeError("upstream is down")
+
+        results = list(rag.stream_and_upload_to_kv([], llm_response, None, "uuid"))
+        assert results[-1] == f"{_llm_error_prefix}upstream is down"
+        assert rag.kv_writer.submitted == {}
+
+    def test_answers_are_kept(self):
+        rag = _rag()
+        results = list(rag.stream_and_upload_to_kv([], lambda: [], None, "uuid"))
+        assert rag.kv_writer.submitted["uuid"] == "".join(results).encode("utf-8")
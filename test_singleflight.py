@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestSingleFlightDo:
+    """Tests for coalescing awaitables"""
+
+    def test_concurrent_calls_share_one_result(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def search():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ["result"]
+
+        async def run():
+            return await asyncio.gather(*[flights.do("q", search) for _ in range(5)])
+
+        assert asyncio.run(run()) == [["result"]] * 5
+        assert len(calls) == 1
+        assert flights.stats() == {"in_flight": 0, "started": 1, "coalesced": 4, "abandoned": 0}
+
+    def test_errors_reach_every_caller(self):
+        flights = SingleFlight()
+
+        async def search():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider down")
+
+        async def run():
+            return await asyncio.gather(*[flights.do("q", search) for _ in range(3)], return_exceptions=True)
+
+        assert all(isinstance(result, RuntimeError) for result in asyncio.run(run()))
+
+
+class TestSingleFlightStream:
+    """Tests for coalescing streams"""
+
+    def test_late_joiner_gets_buffered_chunks(self):
+        flights = SingleFlight()
+        sources = []
+
+        async def source():
+            for chunk in ["a", "b", "c", "d"]:
+                await asyncio.sleep(0.01)
+                yield chunk
+
+        def factory():
+            sources.append(1)
+            return source()
+
+        async def run():
+            leader = asyncio.ensure_future(collect(flights.stream("q", factory)))
+            await asyncio.sleep(0.025)
+            follower = asyncio.ensure_future(collect(flights.stream("q", factory)))
+            return await leader, await follower
+
+        leader, follower = asyncio.run(run())
+        assert leader == follower == ["a", "b", "c", "d"]
+        assert len(sources) == 1
+
+    def test_finished_flight_is_forgotten(self):
+        flights = SingleFlight()
+
+        async def source():
+            yield "x"
+
+        async def run():
+            await collect(flights.stream("q", source))
+            await asyncio.sleep(0)
+            await collect(flights.stream("q", source))
+
+        asyncio.run(run())
+        assert flights.stats()["started"] == 2
+
+    def test_source_error_is_raised_to_subscribers(self):
+        flights = SingleFlight()
+
+        async def source():
+            yield "x"
+            raise RuntimeError("stream broke")
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(collect(flights.stream("q", source)))
+
+
+class TestSingleFlightAbandon:
+    """Tests for giving up streams nobody reads"""
+
+    def test_source_is_cancelled_after_last_subscriber_leaves(self):
+        flights = SingleFlight(abandon_grace=0.01)
+        cancelled = []
+
+        async def source():
+            try:
+                while True:
+                    await asyncio.sleep(0.005)
+                    yield "x"
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def run():
+            async for _ in flights.stream("q", source):
+                break
+            await asyncio.sleep(0.05)
+            return flights.streaming("q")
+
+        assert asyncio.run(run()) is False
+        assert cancelled == [1]
+        assert flights.stats()["abandoned"] == 1
+
+    def test_resubscribing_within_grace_keeps_the_source(self):
+        flights = SingleFlight(abandon_grace=0.05)
+        sources = []
+
+        async def source():
+            sources.append(1)
+            for chunk in ["a", "b", "c"]:
+                await asyncio.sleep(0.01)
+                yield chunk
+
+        async def run():
+            async for _ in flights.stream("q", source):
+                break
+            return await collect(flights.stream("q", source))
+
+        assert asyncio.run(run()) == ["a", "b", "c"]
+        assert len(sources) == 1
+        assert flights.stats()["abandoned"] == 0
@@ -0,0 +1,23 @@
+import time
+
+from startup import StartupTimer
+
+
+class TestStartupTimer:
+    """Tests for the startup timing breakdown"""
+
+    def test_phases_follow_each_other(self):
+        timer = StartupTimer()
+        time.sleep(0.01)
+        timer.mark("imports")
+        with timer.phase("warm"):
+            time.sleep(0.01)
+        stats = timer.stats()
+        assert list(stats["phases_ms"]) == ["imports", "warm"]
+        assert all(ms >= 10 for ms in stats["phases_ms"].values())
+        assert stats["ready_ms"] is None
+
+        timer.ready()
+        assert timer.stats()["ready_ms"] >= 20
+        assert timer.summary().startswith("Ready after ")
+        assert "imports" in timer.summary()
@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import pytest
+
+from stream_encoder import LLM_RESPONSE_SEPARATOR, RELATED_QUESTIONS_SEPARATOR, encode_stream, iterate_closing
+
+
+CONTEXTS = [{"name": "Test", "url": "https://test.com", "snippet": "Test snippet"}]
+RELATED = [{"question": "Who is Spock?"}]
+
+
+async def protocol_stream(deltas, delay=0.0):
+    yield json.dumps(CONTEXTS)
+    yield LLM_RESPONSE_SEPARATOR
+    for delta in deltas:
+        if delay:
+            await asyncio.sleep(delay)
+        yield delta
+    yield RELATED_QUESTIONS_SEPARATOR
+    yield json.dumps(RELATED)
+
+
+async def rechunk(stream, size):
+    text = "".join([chunk async for chunk in stream])
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def encode(stream, **kwargs):
+    async def run():
+        return [chunk async for chunk in encode_stream(stream, **kwargs)]
+    return asyncio.run(run())
+
+
+class TestTextFraming:
+    """Tests for coalescing with the unchanged sentinel protocol"""
+
+    def test_output_is_unchanged_with_fewer_chunks(self):
+        deltas = ["tok "] * 200
+        chunks = encode(protocol_stream(deltas), max_bytes=256, max_delay=1.0)
+
+        expected = json.dumps(CONTEXTS) + LLM_RESPONSE_SEPARATOR + "tok " * 200 + RELATED_QUESTIONS_SEPARATOR + json.dumps(RELATED)
+        assert "".join(chunks) == expected
+        assert len(chunks) < 10
+
+    def test_deadline_flushes_while_source_is_idle(self):
+        async def slow():
+            yield "first"
+            await asyncio.sleep(0.2)
+            yield "second"
+
+        async def run():
+            start = asyncio.get_running_loop().time()
+            async for chunk in encode_stream(slow(), max_bytes=1024, max_delay=0.02):
+                return chunk, asyncio.get_running_loop().time() - start
+
+        chunk, elapsed = asyncio.run(run())
+        assert chunk == "first"
+        assert elapsed < 0.1
+
+    def test_early_close_closes_source(self):
+        closed = []
+
+        async def source():
+            try:
+                while True:
+                    await asyncio.sleep(0.001)
+                    yield "x"
+            finally:
+                closed.append(True)
+
+        async def run():
+            stream = encode_stream(source(), max_bytes=4, max_delay=1.0)
+            await stream.__anext__()
+            await stream.aclose()
+
+        asyncio.run(run())
+        assert closed == [True]
+
+
+class TestFramedOutput:
+    """Tests for the ndjson and length-prefixed framings"""
+
+    @pytest.mark.parametrize("size", [1, 7, 1000])
+    def test_ndjson(self, size):
+        lines = "".join(encode(rechunk(protocol_stream(["Spock ", "said ", "it."]), size), framing="ndjson")).splitlines()
+        events = [json.loads(line) for line in lines]
+
+        assert events[0] == {"type": "contexts", "data": CONTEXTS}
+        assert "".join(e["data"] for e in events if e["type"] == "answer") == "Spock said it."
+        assert events[-1] == {"type": "related", "data": RELATED}
+
+    def test_length_prefixed(self):
+        output = "".join(encode(protocol_stream(["Spöck ", "said it."]), framing="length", max_delay=1.0)).encode("utf-8")
+
+        frames = []
+        while output:
+            header, output = output.split(b"\n", 1)
+            kind, length = header.decode().split(" ")
+            frames.append((kind, output[:int(length)].decode("utf-8")))
+            output = output[int(length):]
+
+        assert frames == [
+            ("contexts", json.dumps(CONTEXTS)),
+            ("answer", "Spöck said it."),
+            ("related", json.dumps(RELATED)),
+        ]
+
+    def test_unknown_framing(self):
+        with pytest.raises(ValueError):
+            encode(protocol_stream([]), framing="xml")
+
+
+class TestIterateClosing:
+    """Tests for iterating blocking generators"""
+
+    def test_early_stop_closes_the_generator(self):
+        closed = []
+
+        def blocking():
+            try:
+                for i in range(100):
+                    yield str(i)
+            finally:
+                closed.append(1)
+
+        async def run():
+            stream = iterate_closing(blocking())
+            chunks = [await stream.__anext__(), await stream.__anext__()]
+            await stream.aclose()
+            return chunks
+
+        assert asyncio.run(run()) == ["0", "1"]
+        assert closed == [1]
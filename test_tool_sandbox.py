@@ -0,0 +1,124 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from tool_sandbox import SandboxedTool, ToolSandbox
+
+
+def _use(tool, **tool_input):
+    return {"toolUseId": "t1", "name": tool, "input": tool_input}
+
+
+def _text(result):
+    return result["content"][0]["text"]
+
+
+@pytest.fixture(scope="module")
+def sandbox():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # Workers must not inherit the app's environment.
+        monkeypatch.setenv("OPENAI_API_KEY", "secret")
+        sandbox = ToolSandbox(1, cpu_seconds=1, call_timeout=3, queue_timeout=0.2, max_calls=100)
+        sandbox.start()
+        yield sandbox
+        sandbox.close()
+
+
+class TestToolSandbox:
+    """Tests for the worker processes running the sandboxed tools"""
+
+    def test_calls_run_in_a_warm_worker(self, sandbox):
+        assert _text(sandbox.call("calculator", _use("calculator", expression="2+3*4"))) == "Result: 14"
+        result = sandbox.call("python_repl", _use("python_repl", code="import os\nprint(os.getpid())"))
+        assert result["status"] == "success"
+        assert int(_text(result)) != __import__("os").getpid()
+        assert sandbox.stats()["ok"] >= 2
+
+    def test_calls_share_no_state_or_environment(self, sandbox):
+        sandbox.call("python_repl", _use("python_repl", code="secret = 42"))
+        assert sandbox.call("python_repl", _use("python_repl", code="print(secret)"))["status"] == "error"
+        result = sandbox.call("python_repl", _use("python_repl", code="import os\nprint('OPENAI_API_KEY' in os.environ)"))
+        assert _text(result).strip() == "False"
+
+    def test_workers_of_another_user_cannot_read_the_apps_secrets(self, tmp_path, monkeypatch):
+        if os.geteuid() != 0:
+            pytest.skip("running workers as another user needs root")
+        try:
+            subprocess.run([sys.executable, "-c", "import strands_tools"], user="nobody", check=True)
+        except (OSError, subprocess.CalledProcessError):
+            pytest.skip("the interpreter isn't usable by nobody here")
+        monkeypatch.setenv("OPENAI_API_KEY", "secret")
+        dotenv = tmp_path / ".env"
+        dotenv.write_text("OPENAI_API_KEY=secret\n")
+        dotenv.chmod(0o600)
+        sandbox = ToolSandbox(1, user="nobody")
+        sandbox.start()
+        try:
+            code = (
+                f"import os\nfor path in [f'/proc/{{os.getppid()}}/environ', {str(dotenv)!r}]:\n"
+                "    try:\n        open(path).read()\n        print('read', path)\n"
+                "    except OSError:\n        print('denied', path)\n"
+            )
+            output = _text(sandbox.call("python_repl", _use("python_repl", code=code)))
+        finally:
+            sandbox.close()
+        assert "read" not in output.split()
+        assert output.count("denied") == 2
+
+    def test_cpu_hog_is_stopped_and_the_worker_replaced(self, sandbox):
+        restarts = sandbox.stats()["restarts"]
+        result = sandbox.call("python_repl", _use("python_repl", code="while True: pass"))
+        assert result["status"] == "error"
+        assert "CPU time" in _text(result)
+        assert sandbox.stats()["cpu_limit"] == 1
+        assert sandbox.stats()["restarts"] == restarts + 1
+        assert _text(sandbox.call("calculator", _use("calculator", expression="1+1"))) == "Result: 2"
+
+    def test_slow_call_times_out(self, sandbox):
+        result = sandbox.call("python_repl", _use("python_repl", code="import time\ntime.sleep(30)"))
+        assert result["status"] == "error"
+        assert "stopped after 3 seconds" in _text(result)
+        assert sandbox.stats()["timeout"] == 1
+
+    def test_calls_are_rejected_when_all_workers_stay_busy(self, sandbox):
+        busy = threading.Thread(
+            target=sandbox.call, args=("python_repl", _use("python_repl", code="import time\ntime.sleep(1)"))
+        )
+        busy.start()
+        while not sandbox.stats()["busy"]:
+            pass
+        result = sandbox.call("calculator", _use("calculator", expression="1+1"))
+        busy.join()
+        assert "busy" in _text(result)
+        assert sandbox.stats()["rejected"] == 1
+        assert sandbox.stats()["max_wait_ms"] >= 200
+
+    def test_workers_are_recycled_after_max_calls(self):
+        sandbox = ToolSandbox(1, max_calls=2)
+        sandbox.start()
+        try:
+            pids = [_text(sandbox.call("python_repl", _use("python_repl", code="import os\nprint(os.getpid())")))
+                    for _ in range(3)]
+        finally:
+            sandbox.close()
+        assert pids[0] == pids[1] != pids[2]
+        assert sandbox.stats()["restarts"] == 1
+
+    def test_agents_call_the_sandboxed_tools(self, sandbox, tmp_path):
+        from strands import Agent
+        from strands.models.openai import OpenAIModel
+
+        from lazy_tools import lazy_tools
+
+        community_tools = lazy_tools(str(tmp_path / "tool_specs.json"))
+        tools = sandbox.wrap(community_tools)
+        assert [type(tool) is SandboxedTool for tool in tools] == [True, True, False]
+        agent = Agent(model=OpenAIModel(client_args={"api_key": "k"}, model_id="m"), tools=tools, callback_handler=None)
+        result = agent.tool.calculator(expression="6*7", record_direct_tool_call=False)
+        assert result["status"] == "success"
+        assert "42" in _text(result)
+        # The calculator ran in the worker, not here.
+        assert not community_tools[0].loaded
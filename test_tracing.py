@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import json
+
+import pytest
+
+from tracing import Tracer, current_trace, finish_when_done, mark, span
+
+
+class TestTracer:
+    """Tests for per-request stage timelines"""
+
+    def test_stages_are_ordered_by_start(self):
+        tracer = Tracer(buffer_size=4)
+        trace = tracer.start("uuid", query="q")
+        with span("search") as stage:
+            mark("inside")
+            stage["results"] = 3
+        mark("after")
+        tracer.finish(trace)
+
+        result = tracer.get("uuid")
+        assert result["query"] == "q"
+        assert result["outcome"] == "completed"
+        assert [stage["name"] for stage in result["stages"]] == ["search", "inside", "after"]
+        assert result["stages"][0]["results"] == 3
+        assert result["stages"][0]["duration_ms"] >= 0
+
+    def test_span_records_errors(self):
+        tracer = Tracer(buffer_size=4)
+        trace = tracer.start("uuid")
+        with pytest.raises(ValueError):
+            with span("search"):
+                raise ValueError("down")
+        tracer.finish(trace, "failed")
+        assert tracer.get("uuid")["stages"][0]["error"] == "ValueError"
+
+    def test_ring_buffer_keeps_the_latest_traces(self):
+        tracer = Tracer(buffer_size=2)
+        for uuid in ["a", "b", "c"]:
+            tracer.finish(tracer.start(uuid))
+        assert tracer.get("a") is None
+        assert tracer.get("b") is not None and tracer.get("c") is not None
+        assert tracer.stats()["buffered"] == 2
+
+    def test_disabled_tracer_traces_nothing(self):
+        tracer = Tracer(buffer_size=0)
+        assert tracer.start("uuid") is None
+        assert Tracer(buffer_size=4).start("") is None
+        # Without a current trace, marks and spans do nothing.
+        def untraced():
+            mark("nothing")
+            with span("nothing") as stage:
+                stage["ignored"] = True
+            return current_trace()
+
+        assert contextvars.Context().run(untraced) is None
+
+    def test_sampled_traces_are_exported(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        tracer = Tracer(buffer_size=0, export_path=str(path), export_sample=1.0)
+        trace = tracer.start("uuid")
+        mark("search")
+        tracer.finish(trace)
+        tracer.finish(trace)
+        tracer.close()
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert len(records) == 1
+        assert records[0]["search_uuid"] == "uuid"
+        assert records[0]["stages"][0]["name"] == "search"
+
+    def test_slow_traces_are_always_exported(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        tracer = Tracer(buffer_size=0, export_path=str(path), export_sample=0.0, export_slow_ms=0)
+        tracer.finish(tracer.start("slow"))
+        tracer.close()
+        assert tracer.stats()["exported"] == 1
+        assert json.loads(path.read_text())["search_uuid"] == "slow"
+
+    def test_stream_outcomes(self):
+        tracer = Tracer(buffer_size=4)
+
+        async def chunks():
+            yield "a"
+            yield "b"
+
+        async def failing():
+            yield "a"
+            raise RuntimeError("down")
+
+        async def consume():
+            async for _ in finish_when_done(chunks(), tracer, tracer.start("completed")):
+                pass
+            with pytest.raises(RuntimeError):
+                async for _ in finish_when_done(failing(), tracer, tracer.start("failed")):
+                    pass
+            stream = finish_when_done(chunks(), tracer, tracer.start("abandoned"))
+            await stream.__anext__()
+            await stream.aclose()
+
+        asyncio.run(consume())
+        for outcome in ["completed", "failed", "abandoned"]:
+            assert tracer.get(outcome)["outcome"] == outcome
@@ -0,0 +1,349 @@
+"""
+Worker processes that run the python_repl and calculator tools.
+
+The answer agent's tools used to run in the serving process, so one tool call
+that spun on the CPU or grabbed memory slowed or stalled every other stream.
+With TOOL_SANDBOX_WORKERS > 0, calls of these tools go to a pool of worker
+processes instead. The workers are started with the app, import the tools
+once, and serve call after call; a call waits for an idle worker for at most
+TOOL_QUEUE_TIMEOUT seconds. Each call is limited to TOOL_CPU_SECONDS of CPU
+time and TOOL_CALL_TIMEOUT seconds of wall-clock time, and each worker to
+TOOL_MEMORY_MB of address space. A worker that exceeds a limit or crashes is
+replaced, and so is one that has served TOOL_WORKER_MAX_CALLS calls. Whatever
+happens, the model gets a tool result, an error one if need be.
+
+Workers start with a minimal environment, in a directory of their own, and
+python_repl starts every call with a fresh state, so no call sees the
+variables of another user's call. A clean environment doesn't keep the app's
+secrets from a worker that runs as the app's user, though: its code can still
+read /proc/<app pid>/environ and any file the app can read, such as .env. Set
+TOOL_WORKER_USER to a user of its own, without access to the app's files, to
+run the workers as; that needs the app to run as root, as it does in the
+Docker image.
+
+A worker reads calls from, and writes results to, the socket whose file
+descriptor is its first argument; its stdout goes to /dev/null, as the tools
+print panels.
+"""
+import asyncio
+import json
+import math
+import os
+import pwd
+import queue
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional
+
+from strands.types._events import ToolResultEvent
+from strands.types.tools import AgentTool
+
+from metrics import tool_call_duration, tool_calls, tool_queue_wait
+
+TOOL_SANDBOX_WORKERS = int(os.environ.get("TOOL_SANDBOX_WORKERS", "2"))
+TOOL_CPU_SECONDS = int(os.environ.get("TOOL_CPU_SECONDS", "5"))
+TOOL_CALL_TIMEOUT = float(os.environ.get("TOOL_CALL_TIMEOUT", "10"))
+TOOL_MEMORY_MB = int(os.environ.get("TOOL_MEMORY_MB", "1024"))
+TOOL_QUEUE_TIMEOUT = float(os.environ.get("TOOL_QUEUE_TIMEOUT", "5"))
+TOOL_WORKER_MAX_CALLS = int(os.environ.get("TOOL_WORKER_MAX_CALLS", "100"))
+# A user name; empty runs the workers as the app's user.
+TOOL_WORKER_USER = os.environ.get("TOOL_WORKER_USER", "")
+
+# The tools that run in the workers; http_request only waits on the network.
+SANDBOXED_TOOLS = ("calculator", "python_repl")
+
+# Seconds a new worker may take to import the tools.
+_START_TIMEOUT = 60.0
+# Passed on to the workers; everything else in the app's environment stays out.
+_INHERITED_ENV = ("PATH", "LANG", "LC_ALL", "TZ", "PYTHONPATH", "VIRTUAL_ENV")
+_WORKER_ENV = {
+    # No consent prompts, no PTY, and no state carried over from an earlier call.
+    "STRANDS_NON_INTERACTIVE": "true",
+    "PYTHON_REPL_INTERACTIVE": "false",
+    "PYTHON_REPL_RESET_STATE": "true",
+    "PYTHONDONTWRITEBYTECODE": "1",
+}
+
+
+def _error_result(tool_use: dict, message: str) -> dict:
+    return {"toolUseId": tool_use.get("toolUseId", ""), "status": "error", "content": [{"text": message}]}
+
+
+class _Worker:
+    """One worker process and its end of the socket."""
+
+    def __init__(self, tools, cpu_seconds: int, memory_mb: int, user: str = ""):
+        self.workdir = tempfile.mkdtemp(prefix="tool-worker-")
+        as_user = {}
+        if user:
+            account = pwd.getpwnam(user)
+            os.chown(self.workdir, account.pw_uid, account.pw_gid)
+            as_user = {"user": account.pw_uid, "group": account.pw_gid, "extra_groups": []}
+        parent, child = socket.socketpair()
+        env = {name: os.environ[name] for name in _INHERITED_ENV if name in os.environ}
+        env.update(
+            _WORKER_ENV, HOME=self.workdir, TMPDIR=self.workdir,
+            TOOL_CPU_SECONDS=str(cpu_seconds), TOOL_MEMORY_MB=str(memory_mb),
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child.fileno()), *tools],
+            pass_fds=(child.fileno(),), cwd=self.workdir, env=env,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, **as_user,
+        )
+        child.close()
+        self.conn = Connection(parent.detach())
+        self.ready = False
+        self.calls = 0
+
+    def wait_ready(self, timeout: float) -> bool:
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv_bytes() == b"ready"
+        return self.ready
+
+    def call(self, name: str, tool_use: dict, timeout: float) -> Optional[dict]:
+        """The result of the call, or None if the worker didn't answer within `timeout`."""
+        self.calls += 1
+        self.conn.send_bytes(json.dumps({"tool": name, "tool_use": tool_use}).encode("utf-8"))
+        if not self.conn.poll(timeout):
+            return None
+        return json.loads(self.conn.recv_bytes())
+
+    def stop(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.conn.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class ToolSandbox:
+    """A pool of `size` worker processes that run tool calls under per-call limits."""
+
+    def __init__(self, size: int, tools=SANDBOXED_TOOLS, cpu_seconds: int = 5, call_timeout: float = 10.0,
+                 memory_mb: int = 1024, queue_timeout: float = 5.0, max_calls: int = 100, user: str = ""):
+        self.size = size
+        self.tools = tuple(tools)
+        self.cpu_seconds = cpu_seconds
+        self.call_timeout = call_timeout
+        self.memory_mb = memory_mb
+        self.queue_timeout = queue_timeout
+        self.max_calls = max_calls
+        self.user = user
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.counts = {outcome: 0 for outcome in ("ok", "error", "cpu_limit", "timeout", "crashed", "rejected")}
+        self.waiting = 0
+        self.busy = 0
+        self.restarts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def start(self) -> None:
+        """Starts the workers; they import the tools in the background."""
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self.tools, self.cpu_seconds, self.memory_mb, self.user)
+
+    def _release(self, worker: _Worker) -> None:
+        if self._closed:
+            worker.stop()
+        elif worker.calls >= self.max_calls:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+
+    def _replace(self, worker: _Worker) -> None:
+        worker.stop()
+        with self._lock:
+            self.restarts += 1
+            closed = self._closed
+        if not closed:
+            self._idle.put(self._spawn())
+
+    def _count(self, name: str, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+        tool_calls.inc(name, outcome)
+
+    def call(self, name: str, tool_use: dict) -> dict:
+        """Runs a call of tool `name` in a worker and returns its ToolResult. Blocks."""
+        started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            worker = self._idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            worker = None
+        waited = time.monotonic() - started
+        tool_queue_wait.observe(waited)
+        with self._lock:
+            self.waiting -= 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if worker is not None:
+                self.busy += 1
+        if worker is None:
+            self._count(name, "rejected")
+            return _error_result(tool_use, f"All tool workers are busy; {name} was not run. Try again later.")
+        try:
+            return self._call(worker, name, tool_use)
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+    def _call(self, worker: _Worker, name: str, tool_use: dict) -> dict:
+        try:
+            if not worker.wait_ready(_START_TIMEOUT):
+                raise EOFError("the worker did not start")
+            started = time.monotonic()
+            reply = worker.call(name, tool_use, self.call_timeout)
+            tool_call_duration.observe(time.monotonic() - started, name)
+        except (EOFError, OSError):
+            reply = {}
+        if reply is None:
+            self._count(name, "timeout")
+            self._replace(worker)
+            return _error_result(tool_use, f"{name} was stopped after {self.call_timeout:g} seconds.")
+        if "error" in reply:
+            # The tool raised; the worker itself is fine.
+            self._count(name, "error")
+            self._release(worker)
+            return _error_result(tool_use, f"{name} failed: {reply['error']}")
+        if "result" not in reply:
+            try:
+                exited_with = worker.process.wait(1)
+            except subprocess.TimeoutExpired:
+                exited_with = None
+            outcome = "cpu_limit" if exited_with == -signal.SIGXCPU else "crashed"
+            self._count(name, outcome)
+            self._replace(worker)
+            if outcome == "cpu_limit":
+                return _error_result(tool_use, f"{name} was stopped after {self.cpu_seconds} seconds of CPU time.")
+            return _error_result(tool_use, f"{name} failed: the tool worker exited.")
+        self._count(name, "ok")
+        self._release(worker)
+        return reply["result"]
+
+    def wrap(self, tools: List[AgentTool]) -> List[AgentTool]:
+        """The given tools, those this sandbox runs replaced by stand-ins that call it."""
+        return [SandboxedTool(tool, self) if tool.tool_name in self.tools else tool for tool in tools]
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = sum(self.counts.values())
+            return {
+                **self.counts,
+                "workers": self.size,
+                "idle": self._idle.qsize(),
+                "busy": self.busy,
+                "waiting": self.waiting,
+                "restarts": self.restarts,
+                "avg_wait_ms": round(self.wait_seconds / calls * 1000, 1) if calls else None,
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 1),
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.stop()
+
+
+class SandboxedTool(AgentTool):
+    """Stands in for a tool, with its spec, and runs its calls in a `ToolSandbox`."""
+
+    def __init__(self, tool: AgentTool, sandbox: ToolSandbox):
+        super().__init__()
+        self._tool = tool
+        self.sandbox = sandbox
+
+    @property
+    def tool_name(self) -> str:
+        return self._tool.tool_name
+
+    @property
+    def tool_spec(self):
+        return self._tool.tool_spec
+
+    @property
+    def tool_type(self) -> str:
+        return self._tool.tool_type
+
+    async def stream(self, tool_use, invocation_state, **kwargs):
+        # Only the tool use crosses over; the invocation state holds the agent.
+        yield ToolResultEvent(await asyncio.to_thread(self.sandbox.call, self.tool_name, dict(tool_use)))
+
+
+def tool_sandbox_from_env() -> Optional[ToolSandbox]:
+    """The sandbox configured by the TOOL_* variables, or None with TOOL_SANDBOX_WORKERS=0."""
+    if TOOL_SANDBOX_WORKERS <= 0:
+        return None
+    return ToolSandbox(
+        TOOL_SANDBOX_WORKERS,
+        cpu_seconds=TOOL_CPU_SECONDS,
+        call_timeout=TOOL_CALL_TIMEOUT,
+        memory_mb=TOOL_MEMORY_MB,
+        queue_timeout=TOOL_QUEUE_TIMEOUT,
+        max_calls=TOOL_WORKER_MAX_CALLS,
+        user=TOOL_WORKER_USER,
+    )
+
+
+def _cpu_seconds_used() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def _run(tool: AgentTool, tool_use: dict) -> dict:
+    result = None
+    async for event in tool.stream(tool_use, {}):
+        if isinstance(event, ToolResultEvent):
+            result = event.tool_result
+    return result
+
+
+def _serve(fd: int, names: List[str]) -> None:
+    """The worker: imports the tools, then runs calls until the socket closes."""
+    from lazy_tools import _load
+
+    conn = Connection(fd)
+    tools: Dict[str, AgentTool] = {name: _load(name) for name in names}
+    memory = int(os.environ["TOOL_MEMORY_MB"]) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    cpu_seconds = int(os.environ.get("TOOL_CPU_SECONDS", TOOL_CPU_SECONDS))
+    _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    loop = asyncio.new_event_loop()
+    conn.send_bytes(b"ready")
+    while True:
+        try:
+            request = json.loads(conn.recv_bytes())
+        except EOFError:
+            return
+        # Past its share of CPU time the worker gets SIGXCPU, which ends it.
+        limit = math.ceil(_cpu_seconds_used()) + cpu_seconds
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, cpu_hard))
+        try:
+            reply = {"result": loop.run_until_complete(_run(tools[request["tool"]], request["tool_use"]))}
+        except Exception as e:
+            reply = {"error": f"{type(e).__name__}: {e}"}
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+        conn.send_bytes(json.dumps(reply, default=str).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    _serve(int(sys.argv[1]), sys.argv[2:])
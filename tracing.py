@@ -0,0 +1,199 @@
+"""
+Per-request stage timelines, retrievable by search_uuid.
+
+Aggregate metrics (see metrics.py) say that the p99 is slow, not why one given
+query was. A `Trace` records when each stage of one request happened: search,
+prompt building, agent checkout, first and last LLM token, related questions.
+Finished traces are kept in a bounded in-memory ring buffer, served at
+`GET /debug/trace/{search_uuid}`, and a sample of them, plus every trace slower
+than TRACE_EXPORT_SLOW_MS, is appended to the JSONL file at TRACE_EXPORT_PATH.
+
+The current trace is carried in a context variable, like the request deadline
+(see resilience.py), so that code down the call chain marks its stage with
+`mark(name)` or `span(name)` without being handed the trace. With tracing
+disabled (TRACE_BUFFER_SIZE=0 and no export), no trace is ever started and a
+mark costs one context variable lookup.
+"""
+import concurrent.futures
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "1024"))
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+TRACE_EXPORT_SAMPLE = float(os.environ.get("TRACE_EXPORT_SAMPLE", "0.01"))
+TRACE_EXPORT_SLOW_MS = float(os.environ.get("TRACE_EXPORT_SLOW_MS", "10000"))
+
+
+class Trace:
+    """The timeline of one request. Offsets are milliseconds since the request started."""
+
+    __slots__ = ("search_uuid", "attributes", "started_at", "_start", "stages", "outcome", "duration_ms")
+
+    def __init__(self, search_uuid: str, **attributes):
+        self.search_uuid = search_uuid
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.stages: List[dict] = []
+        self.outcome = None
+        self.duration_ms = None
+
+    def _offset(self, at: float) -> float:
+        return round((at - self._start) * 1000, 3)
+
+    def mark(self, name: str, **attributes) -> None:
+        """Records that stage `name` happened now."""
+        self.stages.append({"name": name, "at_ms": self._offset(time.monotonic()), **attributes})
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[dict]:
+        """
+        Records stage `name` over the `with` block. The block may add attributes
+        to the yielded stage.
+        """
+        start = time.monotonic()
+        stage = {"name": name, "at_ms": self._offset(start), **attributes}
+        try:
+            yield stage
+        except BaseException as e:
+            stage["error"] = type(e).__name__
+            raise
+        finally:
+            stage["duration_ms"] = round((time.monotonic() - start) * 1000, 3)
+            self.stages.append(stage)
+
+    def to_dict(self) -> dict:
+        return {
+            "search_uuid": self.search_uuid,
+            **self.attributes,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "outcome": self.outcome,
+            # Spans are appended when they end; order the timeline by start.
+            "stages": sorted(self.stages, key=lambda stage: stage["at_ms"]),
+        }
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def mark(name: str, **attributes) -> None:
+    """Marks stage `name` on the current trace, if any."""
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(name, **attributes)
+
+
+@contextmanager
+def _no_span() -> Iterator[dict]:
+    yield {}
+
+
+def span(name: str, **attributes):
+    """Records stage `name` over a `with` block on the current trace, if any."""
+    trace = _current.get()
+    if trace is None:
+        return _no_span()
+    return trace.span(name, **attributes)
+
+
+class Tracer:
+    """
+    Starts traces, keeps the last `buffer_size` finished ones by search_uuid and
+    exports a sample of them, plus the slow ones, to a JSONL file.
+    """
+
+    def __init__(self, buffer_size: int = 1024, export_path: str = "", export_sample: float = 0.01,
+                 export_slow_ms: float = 10000):
+        self.buffer_size = buffer_size
+        self.export_path = export_path
+        self.export_sample = export_sample
+        self.export_slow_ms = export_slow_ms
+        self.enabled = buffer_size > 0 or bool(export_path)
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+        # Writes happen off the serving threads, one at a time.
+        self._exporter = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export")
+            if export_path else None
+        )
+        self.started = 0
+        self.exported = 0
+
+    def start(self, search_uuid: str, **attributes) -> Optional[Trace]:
+        """
+        Starts a trace and makes it the current one. Returns None, and traces
+        nothing, when tracing is disabled or the request has no search_uuid.
+        """
+        if not self.enabled or not search_uuid:
+            return None
+        trace = Trace(search_uuid, **attributes)
+        _current.set(trace)
+        self.started += 1
+        return trace
+
+    def finish(self, trace: Optional[Trace], outcome: str = "completed") -> None:
+        """Stores a finished trace; only the first call for a trace counts."""
+        if trace is None or trace.outcome is not None:
+            return
+        trace.outcome = outcome
+        trace.duration_ms = trace._offset(time.monotonic())
+        if self.buffer_size > 0:
+            with self._lock:
+                self._traces[trace.search_uuid] = trace
+                self._traces.move_to_end(trace.search_uuid)
+                while len(self._traces) > self.buffer_size:
+                    self._traces.popitem(last=False)
+        if self._exporter is not None and (
+            trace.duration_ms >= self.export_slow_ms or random.random() < self.export_sample
+        ):
+            self.exported += 1
+            self._exporter.submit(self._export, trace.to_dict())
+
+    def _export(self, record: dict) -> None:
+        with open(self.export_path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def get(self, search_uuid: str) -> Optional[dict]:
+        with self._lock:
+            trace = self._traces.get(search_uuid)
+        return trace.to_dict() if trace is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            buffered = len(self._traces)
+        return {"enabled": self.enabled, "started": self.started, "buffered": buffered, "exported": self.exported}
+
+    def close(self) -> None:
+        if self._exporter is not None:
+            self._exporter.shutdown(wait=True)
+
+
+def tracer_from_env() -> Tracer:
+    """Builds the tracer configured by TRACE_BUFFER_SIZE and the TRACE_EXPORT_* variables."""
+    return Tracer(TRACE_BUFFER_SIZE, TRACE_EXPORT_PATH, TRACE_EXPORT_SAMPLE, TRACE_EXPORT_SLOW_MS)
+
+
+async def finish_when_done(stream, tracer: Tracer, trace: Trace):
+    """Streams `stream` and then finishes `trace`, as abandoned if the client went away."""
+    outcome = "abandoned"
+    try:
+        async for chunk in stream:
+            yield chunk
+        outcome = "completed"
+    except Exception:
+        outcome = "failed"
+        raise
+    finally:
+        tracer.finish(trace, outcome)